@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import serial
+
+from elmlib import ELM327
+
+ADAPTER_CACHE_FILE = "adapter_cache.json"
+# Most clones ship at 38400; the rest are the rates ELM327s are commonly set to with AT PP 0C / AT BRD.
+PROBE_BAUD_RATES = [38400, 9600, 115200, 57600, 230400, 500000]
+# AT DPN reports the protocol by number; 4 is ISO 14230-4 KWP (5 baud init), which is what the Sprinter uses.
+DEFAULT_PROTOCOL = "4"
+# The KWP protocols (5 baud and fast init); anything else the adapter reports (ex: 0 when it hasn't connected to an
+# ECU yet) isn't something the Sprinter talks, so monitoring falls back to DEFAULT_PROTOCOL.
+KWP_PROTOCOLS = ("4", "5")
+# What connect_monitor asks for (AT BRD) before monitoring; 38400 can't keep up with a busy bus in AT MA.
+MONITOR_BAUD_RATE = 115200
+
+"""
+ProbeResult:
+    What a successful probe found: the device path, a stable hardware ID for the port (so the adapter can be found
+    again if it comes back under a different path), the baud rate it answered at, the ATI identification string and
+    the protocol it reports, plus how long the probe took.
+"""
+class ProbeResult:
+    def __init__(self, device, hardware_id, baud_rate, identification, protocol, elapsed):
+        self.device = device
+        self.hardware_id = hardware_id
+        self.baud_rate = baud_rate
+        self.identification = identification
+        self.protocol = protocol
+        self.elapsed = elapsed
+
+    def to_dict(self):
+        return {"device": self.device, "hardware_id": self.hardware_id, "baud_rate": self.baud_rate,
+                "identification": self.identification, "protocol": self.protocol}
+
+    def __repr__(self):
+        return "{} @ {} baud: {} (protocol {}, {:.0f} ms)".format(
+            self.device, self.baud_rate, self.identification, self.protocol, self.elapsed * 1000.0)
+
+def _hardware_id(device):
+    try:
+        from serial.tools import list_ports
+        for port in list_ports.comports():
+            if port.device == device and port.hwid and port.hwid != "n/a":
+                return port.hwid
+    except ImportError:
+        pass
+    return None
+
+def _device_for_hardware_id(hardware_id):
+    if hardware_id is None:
+        return None
+    try:
+        from serial.tools import list_ports
+        for port in list_ports.comports():
+            if port.hwid == hardware_id:
+                return port.device
+    except ImportError:
+        pass
+    return None
+
+def _command(port, command, deadline):
+    port.reset_input_buffer()
+    port.write(command)
+    reply = bytearray()
+    while time.perf_counter() < deadline:
+        reply += port.read(port.in_waiting or 1)
+        if b'>' in reply:
+            return bytes(reply)
+    return None
+
+"""
+probe_device:
+    Checks whether an ELM327 is on a port, trying each baud rate with ATI under a short deadline. A port that isn't an
+    ELM327 (or is at a different rate) just doesn't answer with the prompt, so each wrong guess costs at most
+    deadline seconds. Returns a ProbeResult, or None if nothing answered.
+
+Parameters:
+    device: The serial device to probe.
+    baud_rates (default=PROBE_BAUD_RATES): Rates to try, in order.
+    deadline (default=0.3): Seconds to wait for an answer at each rate.
+    cancel (default=None): A threading.Event; once set, the probe gives up before trying the next rate.
+"""
+def probe_device(device, baud_rates=None, deadline=0.3, cancel=None):
+    tic = time.perf_counter()
+    for baud_rate in (baud_rates or PROBE_BAUD_RATES):
+        if cancel is not None and cancel.is_set():
+            return None
+        try:
+            port = serial.Serial(device, baud_rate, timeout=0.02, write_timeout=deadline)
+        except (serial.SerialException, OSError):
+            return None
+        try:
+            reply = _command(port, b"ATI\r", time.perf_counter() + deadline)
+            if reply is not None and b"ELM327" not in reply:
+                # An adapter still in monitor mode (or with a half-typed command) only answers "STOPPED" or "?" to
+                # the first command. (A bare return isn't used for this since it repeats the last command.)
+                reply = _command(port, b"ATI\r", time.perf_counter() + deadline)
+            if reply is None or b"ELM327" not in reply:
+                continue
+
+            identification = next((line.strip() for line in reply.decode('latin-1').split('\r') if "ELM327" in line), "ELM327")
+            protocol_reply = _command(port, b"AT DPN\r", time.perf_counter() + deadline)
+            protocol = DEFAULT_PROTOCOL
+            if protocol_reply is not None:
+                # The reply is the echo, then the protocol number (prefixed with A when it's on automatic search).
+                lines = [line.strip() for line in protocol_reply.decode('latin-1').replace('>', '').split('\r') if line.strip()]
+                if lines.__len__() > 0 and lines[-1].lstrip('A').isalnum() and lines[-1].__len__() <= 2:
+                    protocol = lines[-1].lstrip('A') or DEFAULT_PROTOCOL
+            return ProbeResult(device, _hardware_id(device), baud_rate, identification, protocol, time.perf_counter() - tic)
+        except (serial.SerialException, OSError):
+            return None
+        finally:
+            port.close()
+    return None
+
+"""
+probe_devices:
+    Probes every candidate port at the same time (one thread per port) and returns the ProbeResults of the ones that
+    answered, fastest first. The total time is about one probe_device, not the sum of them. With first_only set it
+    returns as soon as one ELM327 answers and the other probes are cancelled.
+"""
+def probe_devices(devices, baud_rates=None, deadline=0.3, first_only=False):
+    results = []
+    if devices.__len__() == 0:
+        return results
+    cancel = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=devices.__len__())
+    try:
+        futures = [executor.submit(probe_device, device, baud_rates, deadline, cancel) for device in devices]
+        for future in as_completed(futures):
+            result = future.result()
+            if result is not None:
+                results.append(result)
+                if first_only:
+                    cancel.set()
+                    break
+    finally:
+        # The cancelled probes finish their current rate on their own; there's no need to wait for them.
+        executor.shutdown(wait=not first_only)
+    return results
+
+def load_cached_adapter(cache_file=ADAPTER_CACHE_FILE):
+    try:
+        with open(cache_file) as cache:
+            return json.load(cache)
+    except (OSError, ValueError):
+        return None
+
+def _write_cache(cached, cache_file):
+    with open(cache_file, 'w') as cache:
+        json.dump(cached, cache, indent=4)
+
+"""
+save_cached_adapter:
+    Caches a probed adapter for the next connect. monitor_baud_rate is the rate it was switched to with AT BRD, if any;
+    the next connect tries that first, since the adapter stays there until it's power cycled.
+"""
+def save_cached_adapter(result, cache_file=ADAPTER_CACHE_FILE, monitor_baud_rate=None):
+    cached = result.to_dict()
+    if monitor_baud_rate is not None and monitor_baud_rate != result.baud_rate:
+        cached["monitor_baud_rate"] = monitor_baud_rate
+    _write_cache(cached, cache_file)
+
+# Records the rate the ELM327 ended up at after connecting, if the cache doesn't already say so.
+def _update_cached_rate(cached, elm327, cache_file):
+    if elm327.baud_rate == cached.get("monitor_baud_rate", cached["baud_rate"]):
+        return
+    if elm327.baud_rate == cached["baud_rate"]:
+        del cached["monitor_baud_rate"]
+    else:
+        cached["monitor_baud_rate"] = elm327.baud_rate
+    _write_cache(cached, cache_file)
+
+def _monitor_protocol(protocol):
+    return protocol if protocol in KWP_PROTOCOLS else DEFAULT_PROTOCOL
+
+def _cached_device(cached):
+    # Prefer finding the adapter by its hardware ID, since USB serial paths move around between plug-ins.
+    device = _device_for_hardware_id(cached.get("hardware_id"))
+    if device is None and os.path.exists(cached.get("device", "")):
+        device = cached["device"]
+    return device
+
+"""
+connect_monitor:
+    Opens the ELM327 and puts it in monitor mode, as fast as possible: if an adapter was cached by an earlier connect
+    and is still plugged in, it's opened straight away at the cached rate (the one it was switched to, if any, then
+    the one it was found at) without probing. Otherwise every candidate port is probed in parallel and the first ELM327
+    found is cached for next time. Monitoring uses the KWP protocol the adapter reported when it was probed (AT DPN),
+    or DEFAULT_PROTOCOL if it reported something else. Returns the ELM327, or None if no adapter was found.
+
+Parameters:
+    devices: Candidate serial devices (ex: get_serial_devices()).
+    cache_file (default=ADAPTER_CACHE_FILE): Where the adapter is cached. None disables the cache.
+    timeout (default=5): Read timeout for the ELM327.
+    debug (default=True): Passed on to the ELM327.
+    monitor_baud_rate (default=None): If set, the UART is switched to this rate before monitoring starts. If the
+                                      adapter refuses, monitoring runs at the rate it was found at.
+"""
+def connect_monitor(devices, cache_file=ADAPTER_CACHE_FILE, timeout=5, debug=True, monitor_baud_rate=None):
+    cached = load_cached_adapter(cache_file) if cache_file is not None else None
+    if cached is not None:
+        device = _cached_device(cached)
+        if device is not None:
+            # The rate it was switched to last time first; if it has been power cycled since, it's back at the probe rate.
+            baud_rates = [cached["baud_rate"]]
+            if cached.get("monitor_baud_rate") is not None:
+                baud_rates.insert(0, cached["monitor_baud_rate"])
+            for baud_rate in baud_rates:
+                try:
+                    elm327 = ELM327(debug, device, baud_rate, timeout)
+                    if b"ELM327" in elm327.identify().raw_value:
+                        if monitor_baud_rate is not None:
+                            elm327.negotiate_baud_rate(monitor_baud_rate)
+                        _update_cached_rate(cached, elm327, cache_file)
+                        elm327.configure_monitor_mode(_monitor_protocol(cached.get("protocol")))
+                        print("Connected to cached adapter {} at {} baud ({}).".format(device, elm327.baud_rate, cached.get("identification")))
+                        return elm327
+                    elm327.close()
+                    print("Cached adapter {} didn't answer at {} baud.".format(device, baud_rate))
+                except (serial.SerialException, OSError) as e:
+                    print("Cached adapter {} didn't open ({}).".format(device, e))
+                    break
+            print("Probing.")
+
+    tic = time.perf_counter()
+    results = probe_devices(devices, first_only=True)
+    print("Probed {} device(s) in {:.0f} ms: {}".format(devices.__len__(), (time.perf_counter() - tic) * 1000.0, results))
+    if results.__len__() == 0:
+        return None
+
+    result = results[0]
+    elm327 = ELM327(debug, result.device, result.baud_rate, timeout)
+    if monitor_baud_rate is not None:
+        elm327.negotiate_baud_rate(monitor_baud_rate)
+    if cache_file is not None:
+        save_cached_adapter(result, cache_file, elm327.baud_rate)
+    elm327.configure_monitor_mode(_monitor_protocol(result.protocol))
+    return elm327
+
+if __name__ == "__main__":
+    from sprinter_obdii_monitor import get_serial_devices
+
+    parser = argparse.ArgumentParser(description="Find ELM327 adapters on the serial ports.")
+    parser.add_argument("devices", nargs="*", help="Serial devices to probe (default: every matching USB serial device)")
+    parser.add_argument("--deadline", type=float, default=0.3, help="Seconds to wait for an answer at each baud rate")
+    parser.add_argument("--save", action="store_true", help="Cache the first adapter found for the next connect")
+    args = parser.parse_args()
+
+    devices = args.devices if args.devices.__len__() > 0 else get_serial_devices()
+    tic = time.perf_counter()
+    results = probe_devices(devices, deadline=args.deadline)
+    print("Probed {} device(s) in {:.0f} ms".format(devices.__len__(), (time.perf_counter() - tic) * 1000.0))
+    for result in results:
+        print("  ", result)
+    if args.save and results.__len__() > 0:
+        save_cached_adapter(results[0])
+        print("Cached", results[0].device, "in", ADAPTER_CACHE_FILE)
@@ -0,0 +1,247 @@
+import argparse
+import binascii
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from capture_format import CAPTURE_EXTENSION, RECORD_HEADER_SIZE, CaptureReader
+from capture_json import NDJSON_EXTENSION, iter_capture_file
+from sprinter_types import ConvertByteToKnownServiceIDs
+
+"""
+Vectorized KWP2000 decoding for whole captures. Instead of building a KWPacket per frame, every frame of a capture is
+packed into one flat uint8 buffer and the header fields are pulled out for all frames at once with NumPy, giving a
+structured array (one row per frame) that can be filtered and counted with array operations.
+
+NumPy is only needed for this module: pip3 install numpy
+"""
+
+"""
+FRAME_DTYPE:
+    One row per frame.
+        timestamp:       Receive time (seconds since the epoch, 0.0 for text logs that carry no timing).
+        frame_offset:    Where the frame starts in FrameBatch.data.
+        frame_length:    Number of bytes in the frame.
+        format_byte:     The first byte of the frame.
+        A0, A1:          The addressing mode flags from the format byte.
+        length:          The message length (service ID + payload), from the format byte or the extra length byte.
+        header_length:   3, or 4 when the length is carried in an extra header byte.
+        target, source:  The raw address bytes.
+        service_id:      The raw service ID byte.
+        checksum:        The checksum byte at the end of the frame.
+        checksum_valid:  True if checksum is the low byte of the sum of every byte before it.
+        complete:        False if the frame is too short for the length in its header (the other fields past the end
+                         of the frame are then 0).
+        payload_offset:  Where the payload (after the service ID, up to the checksum) starts in FrameBatch.data.
+        payload_length:  Number of payload bytes.
+"""
+FRAME_DTYPE = [
+    ("timestamp", "<f8"),
+    ("frame_offset", "<u8"),
+    ("frame_length", "<u2"),
+    ("format_byte", "u1"),
+    ("A0", "u1"),
+    ("A1", "u1"),
+    ("length", "u1"),
+    ("header_length", "u1"),
+    ("target", "u1"),
+    ("source", "u1"),
+    ("service_id", "u1"),
+    ("checksum", "u1"),
+    ("checksum_valid", "?"),
+    ("complete", "?"),
+    ("payload_offset", "<u8"),
+    ("payload_length", "<u2"),
+]
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("batch_decode needs NumPy (pip3 install numpy)")
+
+"""
+FrameBatch:
+    The result of a batch decode: records is the FRAME_DTYPE structured array and data is the uint8 buffer the
+    frame_offset/payload_offset fields point into.
+
+    batch.select(batch.records["service_id"] == 0x58) keeps only the matching frames (sharing the same data buffer).
+"""
+class FrameBatch:
+    def __init__(self, records, data):
+        self.records = records
+        self.data = data
+
+    def __len__(self):
+        return self.records.__len__()
+
+    def __getitem__(self, field):
+        return self.records[field]
+
+    def frame(self, index):
+        row = self.records[index]
+        return self.data[row["frame_offset"]:row["frame_offset"] + row["frame_length"]].tobytes()
+
+    def payload(self, index):
+        row = self.records[index]
+        return self.data[row["payload_offset"]:row["payload_offset"] + row["payload_length"]].tobytes()
+
+    def select(self, mask):
+        return FrameBatch(self.records[mask], self.data)
+
+    """
+    service_id_counts:
+        Returns {service_id: frame count} for every service ID seen.
+    """
+    def service_id_counts(self):
+        counts = np.bincount(self.records["service_id"][self.records["complete"]], minlength=256)
+        return {int(service_id): int(counts[service_id]) for service_id in np.flatnonzero(counts)}
+
+"""
+decode_frames:
+    The vectorized decode. Takes the frames already laid out in one buffer and fills in a FRAME_DTYPE row for each.
+
+Parameters:
+    data: A uint8 array holding the frame bytes.
+    frame_offsets: Start of each frame in data.
+    frame_lengths: Length of each frame.
+    timestamps (default=None): Receive time of each frame.
+"""
+def decode_frames(data, frame_offsets, frame_lengths, timestamps=None):
+    _require_numpy()
+    count = frame_offsets.__len__()
+    records = np.zeros(count, dtype=FRAME_DTYPE)
+    if count == 0:
+        return FrameBatch(records, data)
+
+    offsets = frame_offsets.astype(np.int64)
+    lengths = frame_lengths.astype(np.int64)
+    records["frame_offset"] = offsets
+    records["frame_length"] = lengths
+    if timestamps is not None:
+        records["timestamp"] = timestamps
+
+    # Byte i of every frame, or 0 where the frame is shorter than that. A zero byte is padded onto the end of data so
+    # the clamped index of a short final frame can't run off the buffer.
+    padded = np.concatenate((data, np.zeros(1, dtype=np.uint8)))
+    pad_index = data.__len__()
+    def byte_at(index_in_frame):
+        inside = index_in_frame < lengths
+        return padded[np.where(inside, offsets + index_in_frame, pad_index)]
+
+    format_byte = byte_at(0)
+    records["format_byte"] = format_byte
+    records["A0"] = (format_byte >> 6) & 0b1
+    records["A1"] = format_byte >> 7
+
+    short_length = format_byte & 0b00111111
+    extended = short_length == 0
+    msg_length = np.where(extended, byte_at(3), short_length).astype(np.int64)
+    header_length = np.where(extended, 4, 3)
+    checksum_index = header_length + msg_length
+
+    complete = (lengths >= 5) & (msg_length > 0) & (lengths > checksum_index)
+    records["complete"] = complete
+    records["length"] = msg_length
+    records["header_length"] = header_length
+    records["target"] = byte_at(1)
+    records["source"] = byte_at(2)
+    records["service_id"] = np.where(complete, byte_at(header_length), 0)
+    checksum = np.where(complete, byte_at(checksum_index), 0)
+    records["checksum"] = checksum
+
+    # Sum of the bytes before the checksum, from a running total over the whole buffer.
+    running_total = np.zeros(data.__len__() + 1, dtype=np.uint64)
+    np.cumsum(data, dtype=np.uint64, out=running_total[1:])
+    checksum_end = np.where(complete, offsets + checksum_index, offsets)
+    byte_sum = (running_total[checksum_end] - running_total[offsets]) & 0xFF
+    records["checksum_valid"] = complete & (byte_sum == checksum)
+
+    records["payload_offset"] = np.where(complete, offsets + header_length + 1, offsets)
+    records["payload_length"] = np.where(complete, msg_length - 1, 0)
+    return FrameBatch(records, data)
+
+"""
+frames_to_batch:
+    Packs an iterable of (timestamp, frame_bytes) into one buffer and decodes it.
+"""
+def frames_to_batch(frames):
+    _require_numpy()
+    buffer = bytearray()
+    timestamps = []
+    offsets = []
+    lengths = []
+    for timestamp, frame in frames:
+        offsets.append(buffer.__len__())
+        lengths.append(frame.__len__())
+        timestamps.append(timestamp)
+        buffer += frame
+
+    return decode_frames(
+        np.frombuffer(bytes(buffer), dtype=np.uint8),
+        np.array(offsets, dtype=np.uint64),
+        np.array(lengths, dtype=np.uint64),
+        np.array(timestamps, dtype=np.float64))
+
+"""
+capture_to_batch:
+    Loads and decodes a binary capture without going through Python objects per frame: the file is read into one array
+    and the timestamps and lengths are gathered straight out of the record headers.
+"""
+def capture_to_batch(path):
+    _require_numpy()
+    with CaptureReader(path) as reader:
+        record_offsets = np.frombuffer(reader.record_offsets, dtype=np.uint64).astype(np.int64)
+    data = np.fromfile(path, dtype=np.uint8)
+
+    header_bytes = data[record_offsets[:, None] + np.arange(RECORD_HEADER_SIZE)]
+    timestamps_ns = header_bytes[:, 0:8].copy().view("<i8").ravel()
+    lengths = header_bytes[:, 8:10].copy().view("<u2").ravel()
+    return decode_frames(data, record_offsets + RECORD_HEADER_SIZE, lengths, timestamps_ns / 1000000000)
+
+"""
+elm_log_to_batch:
+    Decodes a raw ELM327 monitor log (the adapter's text output, one "83 12 F3 30 40 01 F9" line per frame). Lines that
+    aren't hex frames (prompts, "NO DATA", ...) are skipped. The log has no timing, so every timestamp is 0.0.
+"""
+def elm_log_to_batch(path):
+    with open(path, 'rb') as log_file:
+        text = log_file.read()
+
+    frames = []
+    for line in text.replace(b'\n', b'\r').split(b'\r'):
+        try:
+            frame = binascii.unhexlify(line.translate(None, b' \t'))
+        except (binascii.Error, ValueError):
+            continue
+        if frame.__len__() > 0:
+            frames.append((0.0, frame))
+    return frames_to_batch(frames)
+
+"""
+load_batch:
+    Decodes any capture: .t1ncap, .json and .ndjson dumps, or (any other extension) a raw ELM327 text log.
+"""
+def load_batch(path):
+    if path.endswith(CAPTURE_EXTENSION):
+        return capture_to_batch(path)
+    if path.endswith(".json") or path.endswith(NDJSON_EXTENSION):
+        return frames_to_batch(iter_capture_file(path))
+    return elm_log_to_batch(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch decode a capture and print a summary.")
+    parser.add_argument("capture", help="A .t1ncap, .json or .ndjson capture, or a raw ELM327 text log")
+    parser.add_argument("--save", help="Save the decoded records to this .npy file")
+    args = parser.parse_args()
+
+    batch = load_batch(args.capture)
+    records = batch.records
+    print("Frames: {}; incomplete: {}; bad checksum: {}".format(
+        batch.__len__(), int((~records["complete"]).sum()), int((records["complete"] & ~records["checksum_valid"]).sum())))
+    for service_id, count in sorted(batch.service_id_counts().items(), key=lambda item: -item[1]):
+        print("  {:#04x} {:<32} {}".format(service_id, str(ConvertByteToKnownServiceIDs(service_id)), count))
+
+    if args.save:
+        np.save(args.save, records)
+        print("Records saved to", args.save)
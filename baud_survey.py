@@ -0,0 +1,106 @@
+import argparse
+import json
+import time
+
+from elmlib import ELM327, KWPFramer
+
+SURVEY_BAUD_RATES = [38400, 57600, 115200, 230400, 500000]
+
+"""
+survey_rate:
+    Monitors the bus for duration seconds at the adapter's current rate and measures what gets through: frames and
+    bytes per second, how often the adapter's buffer overflowed (BUFFER FULL) and what the framer had to throw away.
+"""
+def survey_rate(elm327, duration):
+    framer = KWPFramer()
+    overflows_before = elm327.buffer_full_count
+    elm327.configure_monitor_mode()
+
+    byte_count = 0
+    tic = time.perf_counter()
+    while time.perf_counter() - tic < duration:
+        received_response = elm327.try_read_serial(bytes_written=0)
+        byte_count += received_response.raw_value.__len__()
+        framer.feed(received_response.raw_value)
+    elapsed = time.perf_counter() - tic
+    elm327.stop_monitoring()
+
+    return {
+        "baud_rate": elm327.baud_rate,
+        "seconds": elapsed,
+        "frames": framer.good_count,
+        "frames_per_second": framer.good_count / elapsed,
+        "bytes_per_second": byte_count / elapsed,
+        "link_utilization": byte_count * 10.0 / elapsed / elm327.baud_rate,
+        "buffer_full": elm327.buffer_full_count - overflows_before,
+        "bad_frames": framer.bad_checksum_count + framer.truncated_count,
+    }
+
+"""
+survey_baud_rates:
+    Negotiates each rate in turn (see ELM327.negotiate_baud_rate) and measures monitor throughput at it. Rates the
+    adapter won't switch to are reported with negotiated set to False and not measured. The adapter is put back at
+    the rate it started at afterwards.
+
+Parameters:
+    elm327: An opened ELM327.
+    baud_rates (default=SURVEY_BAUD_RATES): The rates to try, in order.
+    duration (default=5.0): Seconds to monitor at each rate.
+"""
+def survey_baud_rates(elm327, baud_rates=None, duration=5.0):
+    start_baud_rate = elm327.baud_rate
+    results = []
+    for baud_rate in (baud_rates or SURVEY_BAUD_RATES):
+        tic = time.perf_counter()
+        negotiated = elm327.negotiate_baud_rate(baud_rate) == baud_rate
+        switch_seconds = time.perf_counter() - tic
+        if not negotiated:
+            results.append({"baud_rate": baud_rate, "negotiated": False, "switch_seconds": switch_seconds})
+            continue
+        result = survey_rate(elm327, duration)
+        result["negotiated"] = True
+        result["switch_seconds"] = switch_seconds
+        results.append(result)
+    elm327.negotiate_baud_rate(start_baud_rate)
+    return results
+
+def print_survey(results):
+    print("{:>8} {:>10} {:>10} {:>10} {:>8} {:>12} {:>10}".format("baud", "switch ms", "frames/s", "bytes/s", "link", "buffer full", "bad frames"))
+    for result in results:
+        if not result["negotiated"]:
+            print("{:>8} {:>10.1f} {:>10}".format(result["baud_rate"], result["switch_seconds"] * 1000.0, "refused"))
+            continue
+        print("{:>8} {:>10.1f} {:>10.1f} {:>10.0f} {:>7.0f}% {:>12} {:>10}".format(
+            result["baud_rate"], result["switch_seconds"] * 1000.0, result["frames_per_second"], result["bytes_per_second"],
+            result["link_utilization"] * 100.0, result["buffer_full"], result["bad_frames"]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure monitor throughput and buffer overflows at each UART rate.")
+    parser.add_argument("device", nargs="?", help="The ELM327 serial device")
+    parser.add_argument("--baud", type=int, default=38400, help="The rate the adapter is at now")
+    parser.add_argument("--rates", default=",".join(str(rate) for rate in SURVEY_BAUD_RATES), help="Comma separated rates to try")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds to monitor at each rate")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    parser.add_argument("--emulate", type=float, help="Survey an emulated adapter (see elm_emulator.py) streaming this many frames/s instead of a device")
+    args = parser.parse_args()
+
+    if args.device is None and args.emulate is None:
+        parser.error("Give a device or --emulate")
+
+    emulator = None
+    device = args.device
+    if args.emulate is not None:
+        from elm_emulator import ELM327Emulator
+        emulator = ELM327Emulator(load_rate=args.emulate, baud_rate=args.baud)
+        device = emulator.open()
+    elm327 = ELM327(False, device, args.baud, 1)
+    try:
+        results = survey_baud_rates(elm327, [int(rate) for rate in args.rates.split(",")], args.duration)
+    finally:
+        elm327.close()
+        if emulator is not None:
+            emulator.close()
+    print_survey(results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=4)
@@ -0,0 +1,221 @@
+import argparse
+import datetime
+import gc
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from capture_format import frame_to_string_value
+from capture_json import deserialize_packets, iter_capture_file, serialize_packet_buffer
+from elmlib import ELMRESPONSE, KWPacket, convert_str_to_byte_array
+from packet_buffer import PacketRingBuffer
+
+"""
+Benchmark suite for the per-frame hot paths: parsing adapter output, building KWPackets, turning responses back into
+text for the UI, serializing/deserializing dumps and listener dispatch.
+
+Every benchmark runs twice over each data set: once timed (frames/s) and once under tracemalloc over a smaller slice
+to get the memory kept alive per frame (bytes/frame) by whatever the benchmark produces. Results are written as JSON
+so two runs (ex: before and after a change) can be compared with --compare.
+
+    python3 benchmark.py                         # bundled dumps + a 1M frame synthetic capture
+    python3 benchmark.py --output before.json
+    python3 benchmark.py --compare before.json after.json
+"""
+BENCHMARK_FORMAT_VERSION = 1
+DEFAULT_SYNTHETIC_FRAMES = 1000000
+DEFAULT_MEMORY_FRAMES = 50000
+MIN_TIMED_FRAMES = 20000
+
+"""
+BenchmarkData:
+    One data set to run the benchmarks over: the (timestamp, frame_bytes) pairs plus the forms the individual
+    benchmarks take as input, built once up front so building them isn't part of the timing.
+"""
+class BenchmarkData:
+    def __init__(self, name, frames):
+        self.name = name
+        self.frames = frames
+        self.raw_lines = [bytes(frame_to_string_value(frame), 'ascii') for _, frame in frames]
+        self.decoded_lines = [line.decode() for line in self.raw_lines]
+        self.responses = [ELMRESPONSE(line, _date=timestamp, _parse_kwp=True) for line, (timestamp, _) in zip(self.raw_lines, frames)]
+
+        self.packet_buffer = PacketRingBuffer(max(1, frames.__len__()), arena_size=max(16, sum(f.__len__() for _, f in frames)))
+        for timestamp, frame in frames:
+            self.packet_buffer.append(timestamp, frame)
+        self.serialized = serialize_packet_buffer(self.packet_buffer)
+
+    def __len__(self):
+        return self.frames.__len__()
+
+def load_bundled_dumps(dump_dir):
+    frames = []
+    for path in sorted(glob.glob(os.path.join(dump_dir, "*.json"))):
+        frames.extend(iter_capture_file(path))
+    return frames
+
+"""
+make_synthetic_frames:
+    Repeats the given frames until there are frame_count of them, with timestamps advancing 10ms per frame so the
+    capture looks like a long monitoring session.
+"""
+def make_synthetic_frames(source_frames, frame_count, start_time=1650000000.0):
+    source_count = source_frames.__len__()
+    return [(start_time + i * 0.01, source_frames[i % source_count][1]) for i in range(0, frame_count)]
+
+def _dispatch_all(data):
+    # Imported here: the monitor module creates its log file on import.
+    import sprinter_obdii_monitor
+    from sprinter_types import KnownServiceIDs
+
+    subscriptions = []
+    for service_id in [KnownServiceIDs.GUESS_REQUEST_CODES, KnownServiceIDs.GUESS_CODES_RESPONSE, KnownServiceIDs.GUESS_REQUEST_INFO_ON_CODE]:
+        subscriptions.append(sprinter_obdii_monitor.elm327_add_listener(service_id, lambda msg_byte, byte_args: None))
+    try:
+        return [sprinter_obdii_monitor.process_response(r) for r in data.responses]
+    finally:
+        for subscription in subscriptions:
+            sprinter_obdii_monitor.elm327_remove_listener(subscription)
+
+"""
+BENCHMARKS:
+    name -> function(data) returning a list with one result per frame. The list is what gets measured for
+    bytes/frame, so each function should return what the real caller would keep.
+"""
+BENCHMARKS = {
+    "convert_str_to_byte_array": lambda data: [convert_str_to_byte_array(line) for line in data.decoded_lines],
+    "kwpacket_construct": lambda data: [KWPacket(line) for line in data.raw_lines],
+    "elmresponse_tostring": lambda data: [r.tostring() for r in data.responses],
+    "elmresponse_data_only_tostring": lambda data: [r.data_only_tostring() for r in data.responses],
+    "serialize_packets": lambda data: serialize_packet_buffer(data.packet_buffer),
+    "deserialize_packets": lambda data: deserialize_packets(data.serialized),
+    "listener_dispatch": _dispatch_all,
+}
+
+def _slice_data(data, frame_count):
+    if data.__len__() <= frame_count:
+        return data
+    return BenchmarkData(data.name, data.frames[:frame_count])
+
+def measure_bytes_per_frame(benchmark, data):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        results = benchmark(data)
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del results
+    return (after - before) / max(1, data.__len__())
+
+"""
+run_benchmark:
+    Times one benchmark over a data set. The best of repeat runs is reported, which keeps the numbers steady enough
+    to compare between commits on the same machine.
+"""
+def run_benchmark(name, data, memory_data, repeat=3):
+    benchmark = BENCHMARKS[name]
+    # Small data sets (the bundled dumps) are run several times per timing so the number isn't just timer noise.
+    passes = max(1, MIN_TIMED_FRAMES // max(1, data.__len__()))
+    best = None
+    for _ in range(0, repeat):
+        gc.collect()
+        start = time.perf_counter()
+        for _ in range(0, passes):
+            benchmark(data)
+        elapsed = (time.perf_counter() - start) / passes
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return {
+        "benchmark": name,
+        "dataset": data.name,
+        "frames": data.__len__(),
+        "seconds": best,
+        "frames_per_second": data.__len__() / best if best > 0 else 0.0,
+        "bytes_per_frame": measure_bytes_per_frame(benchmark, memory_data),
+    }
+
+def _git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(datasets, names=None, repeat=3, memory_frames=DEFAULT_MEMORY_FRAMES):
+    results = []
+    for data in datasets:
+        memory_data = _slice_data(data, memory_frames)
+        for name in (names or BENCHMARKS.keys()):
+            result = run_benchmark(name, data, memory_data, repeat)
+            print("{:<32} {:<12} {:>9} frames {:>12.0f} frames/s {:>9.1f} bytes/frame".format(
+                result["benchmark"], result["dataset"], result["frames"], result["frames_per_second"], result["bytes_per_frame"]))
+            results.append(result)
+
+    return {
+        "format_version": BENCHMARK_FORMAT_VERSION,
+        "git_revision": _git_revision(),
+        "date": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+"""
+compare_results:
+    Prints the change in frames/s and bytes/frame for every benchmark run over the same data set in both files.
+    Returns the number of benchmarks that slowed down by more than threshold (a fraction, 0.1 = 10%).
+"""
+def compare_results(old_path, new_path, threshold=0.1):
+    with open(old_path) as old_file:
+        old = json.load(old_file)
+    with open(new_path) as new_file:
+        new = json.load(new_file)
+
+    old_results = {(r["benchmark"], r["dataset"], r["frames"]): r for r in old["results"]}
+    regressions = 0
+    print("{} ({}) -> {} ({})".format(old_path, old.get("git_revision"), new_path, new.get("git_revision")))
+    for r in new["results"]:
+        previous = old_results.get((r["benchmark"], r["dataset"], r["frames"]))
+        if previous is None:
+            continue
+        speed_change = r["frames_per_second"] / previous["frames_per_second"] - 1.0 if previous["frames_per_second"] > 0 else 0.0
+        memory_change = r["bytes_per_frame"] - previous["bytes_per_frame"]
+        flag = ""
+        if speed_change < -threshold:
+            flag = "  <-- slower"
+            regressions += 1
+        print("{:<32} {:<12} {:>+8.1%} frames/s {:>+9.1f} bytes/frame{}".format(r["benchmark"], r["dataset"], speed_change, memory_change, flag))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the parse, serialize and dispatch hot paths.")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--frames", type=int, default=DEFAULT_SYNTHETIC_FRAMES, help="Size of the synthetic capture (0 to skip it)")
+    parser.add_argument("--memory-frames", type=int, default=DEFAULT_MEMORY_FRAMES, help="Frames measured for bytes/frame")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per benchmark; the best is reported")
+    parser.add_argument("--dumps", default="dumps", help="Directory of bundled JSON dumps")
+    parser.add_argument("--benchmark", action="append", choices=list(BENCHMARKS.keys()), help="Only run this benchmark (can be repeated)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Slowdown (fraction) reported as a regression by --compare")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare_results(args.compare[0], args.compare[1], args.threshold) > 0 else 0)
+
+    bundled = load_bundled_dumps(args.dumps)
+    datasets = [BenchmarkData("dumps", bundled)]
+    if args.frames > 0 and bundled.__len__() > 0:
+        datasets.append(BenchmarkData("synthetic", make_synthetic_frames(bundled, args.frames)))
+
+    report = run_suite(datasets, args.benchmark, args.repeat, args.memory_frames)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=4)
+        print("Results written to", args.output)
@@ -0,0 +1,206 @@
+import json
+import mmap
+import os
+import struct
+import sys
+
+from array import array
+
+"""
+Binary capture format (.t1ncap):
+    A 16 byte file header followed by length-prefixed frame records, all little-endian.
+
+    Header: magic (8 bytes, b"T1NCAP\r\n"), version (uint16), header size (uint16), flags (uint32, reserved)
+    Record: timestamp in nanoseconds since the epoch (int64), frame length (uint16), then the decoded frame bytes.
+
+    Compared to the JSON dumps this stores each byte once instead of as an indented integer on its own line, and the
+    ELM-style string_value is dropped entirely since it can be rebuilt from the bytes.
+"""
+CAPTURE_EXTENSION = ".t1ncap"
+CAPTURE_MAGIC = b"T1NCAP\r\n"
+CAPTURE_VERSION = 1
+
+_HEADER = struct.Struct('<8sHHI')
+_RECORD = struct.Struct('<qH')
+RECORD_HEADER_SIZE = _RECORD.size
+
+"""
+seconds_to_ns / ns_to_seconds:
+    Convert between float timestamps (as stored in the JSON dumps) and integer nanoseconds. The conversion is done
+    with exact integer arithmetic so float -> ns -> float always gives back the same float.
+"""
+def seconds_to_ns(timestamp):
+    numerator, denominator = float(timestamp).as_integer_ratio()
+    return (numerator * 2000000000 + denominator) // (2 * denominator)
+
+def ns_to_seconds(timestamp_ns):
+    return timestamp_ns / 1000000000
+
+# The ELM327-style text for a frame, same as the string_value field of the JSON dumps.
+def frame_to_string_value(frame):
+    if frame.__len__() == 0:
+        return ""
+    return frame.hex(' ').upper() + ' \r'
+
+"""
+CaptureWriter:
+    Writes frames to a binary capture file. Can be used as a context manager.
+
+Parameters:
+    path: The capture file to write.
+    append (default=False): Add to an existing capture instead of starting a new one.
+"""
+class CaptureWriter:
+    def __init__(self, path, append=False):
+        self.path = path
+        self.frame_count = 0
+        if append and os.path.exists(path) and os.path.getsize(path) >= _HEADER.size:
+            with open(path, 'rb') as existing:
+                _check_header(existing.read(_HEADER.size), path)
+            self._file = open(path, 'ab')
+        else:
+            self._file = open(path, 'wb')
+            self._file.write(_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, _HEADER.size, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    """
+    write_frame:
+        Appends one frame.
+
+    Parameters:
+        timestamp: Receive time as a float (seconds since the epoch).
+        frame: The decoded frame bytes (or a list of byte values).
+    """
+    def write_frame(self, timestamp, frame):
+        self._file.write(_RECORD.pack(seconds_to_ns(timestamp), frame.__len__()))
+        self._file.write(bytes(frame))
+        self.frame_count += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+def _check_header(header_bytes, path):
+    if header_bytes.__len__() < _HEADER.size:
+        raise ValueError("{} is too short to be a capture file".format(path))
+    magic, version, header_size, _ = _HEADER.unpack_from(header_bytes)
+    if magic != CAPTURE_MAGIC:
+        raise ValueError("{} is not a capture file".format(path))
+    if version > CAPTURE_VERSION:
+        raise ValueError("{} is capture version {}, only up to {} is supported".format(path, version, CAPTURE_VERSION))
+    return header_size
+
+"""
+CaptureReader:
+    Memory-maps a binary capture file for random access by frame index. Opening only walks the record headers to build
+    the offset index; frame bytes are not touched until they are asked for. A partially written final record (ex: the
+    writer was killed) is ignored. Can be used as a context manager.
+
+Parameters:
+    path: The capture file to read.
+"""
+class CaptureReader:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        file_size = os.fstat(self._file.fileno()).st_size
+        if file_size < _HEADER.size:
+            self._file.close()
+            raise ValueError("{} is too short to be a capture file".format(path))
+
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = _check_header(self._map[:_HEADER.size], path)
+
+        self._offsets = array('Q')
+        unpack_from = _RECORD.unpack_from
+        record_size = _RECORD.size
+        while offset + record_size <= file_size:
+            _, length = unpack_from(self._map, offset)
+            if offset + record_size + length > file_size:
+                break
+            self._offsets.append(offset)
+            offset += record_size + length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._offsets.__len__()
+
+    # File offset of every record header, in frame order (an array('Q'), usable as a buffer).
+    @property
+    def record_offsets(self):
+        return self._offsets
+
+    def timestamp(self, index):
+        return ns_to_seconds(_RECORD.unpack_from(self._map, self._offsets[index])[0])
+
+    """
+    __getitem__:
+        Returns (timestamp, frame_bytes) for a frame index. Negative indexes count from the end.
+    """
+    def __getitem__(self, index):
+        offset = self._offsets[index]
+        timestamp_ns, length = _RECORD.unpack_from(self._map, offset)
+        start = offset + _RECORD.size
+        return ns_to_seconds(timestamp_ns), self._map[start:start + length]
+
+    def iter_frames(self, start=0, stop=None):
+        if stop is None:
+            stop = self.__len__()
+        for i in range(start, stop):
+            yield self[i]
+
+    def close(self):
+        if not self._map.closed:
+            self._map.close()
+        self._file.close()
+
+"""
+json_to_capture:
+    Converts a JSON dump (dumps/*.json: date, string_value, raw_byte_packet) to a binary capture. Empty packets are
+    kept so the conversion back is lossless. Returns the number of frames written.
+"""
+def json_to_capture(json_path, capture_path):
+    with open(json_path) as json_file:
+        packets = json.load(json_file)
+    with CaptureWriter(capture_path) as writer:
+        for p in packets:
+            writer.write_frame(p["date"], bytes(p["raw_byte_packet"]))
+        return writer.frame_count
+
+"""
+capture_to_json:
+    Converts a binary capture back to the JSON dump format, laid out the same way the Debug Monitor exports it.
+    Returns the number of frames written.
+"""
+def capture_to_json(capture_path, json_path):
+    with CaptureReader(capture_path) as reader:
+        packets = []
+        for timestamp, frame in reader.iter_frames():
+            packets.append({"date": timestamp, "string_value": frame_to_string_value(frame), "raw_byte_packet": list(frame)})
+    with open(json_path, 'w') as json_file:
+        json_file.write(json.dumps(packets, indent=4))
+    return packets.__len__()
+
+if __name__ == "__main__":
+    if sys.argv.__len__() != 3:
+        print("Usage: python3 capture_format.py <input.json|input{0}> <output{0}|output.json>".format(CAPTURE_EXTENSION))
+        sys.exit(1)
+
+    if sys.argv[1].endswith(CAPTURE_EXTENSION):
+        count = capture_to_json(sys.argv[1], sys.argv[2])
+    else:
+        count = json_to_capture(sys.argv[1], sys.argv[2])
+    print("Converted {} frames: {} -> {}".format(count, sys.argv[1], sys.argv[2]))
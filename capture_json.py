@@ -0,0 +1,288 @@
+import codecs
+import datetime
+import json
+import os
+import threading
+import time
+
+from capture_format import CAPTURE_EXTENSION, CaptureReader, CaptureWriter, frame_to_string_value
+from capture_store import CAPTURE_STORE_EXTENSION, CaptureStore, CaptureStoreWriter
+from elmlib import ELMRESPONSE
+from sprinter_log import debug_enabled, log_debug
+
+NDJSON_EXTENSION = ".ndjson"
+
+"""
+JsonPacketReader:
+    Streams packets out of a JSON dump one at a time instead of loading the whole file. Handles both the regular
+    dump layout (a JSON array, as written by the Debug Monitor export) and newline-delimited JSON (one packet object
+    per line). Memory use stays at roughly one read chunk no matter how big the file is.
+    bytes_read/total_bytes can be read from another thread to report progress.
+
+Parameters:
+    path: The .json or .ndjson file to read.
+    chunk_size (default=256 KiB): How much of the file to read at a time.
+"""
+class JsonPacketReader:
+    def __init__(self, path, chunk_size=256 * 1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.total_bytes = os.path.getsize(path)
+        self.bytes_read = 0
+
+    def __iter__(self):
+        with open(self.path, 'rb') as json_file:
+            first_chunk = self._read_chunk(json_file, codecs.getincrementaldecoder('utf-8')())
+            if first_chunk.lstrip().startswith('['):
+                yield from self._iter_array(json_file, first_chunk)
+            else:
+                yield from self._iter_lines(json_file, first_chunk)
+
+    def _read_chunk(self, json_file, decoder):
+        data = json_file.read(self.chunk_size)
+        self.bytes_read += data.__len__()
+        return decoder.decode(data, final=(data.__len__() == 0))
+
+    def _iter_lines(self, json_file, buffered):
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        while True:
+            lines = buffered.split('\n')
+            buffered = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+
+            chunk = self._read_chunk(json_file, decoder)
+            if chunk.__len__() == 0:
+                break
+            buffered += chunk
+
+        if buffered.strip():
+            yield json.loads(buffered)
+
+    def _iter_array(self, json_file, buffered):
+        utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+        json_decoder = json.JSONDecoder()
+        idx = buffered.index('[') + 1
+        eof = False
+
+        while True:
+            # Skip the whitespace and commas between packets.
+            while idx < buffered.__len__() and buffered[idx] in ' \t\r\n,':
+                idx += 1
+
+            if idx < buffered.__len__():
+                if buffered[idx] == ']':
+                    return
+                try:
+                    packet, end = json_decoder.raw_decode(buffered, idx)
+                except json.JSONDecodeError:
+                    # The packet runs past the end of what has been read so far.
+                    if eof:
+                        raise
+                else:
+                    yield packet
+                    idx = end
+                    continue
+            elif eof:
+                raise ValueError("{} ended before the closing ']'".format(self.path))
+
+            # Drop what has already been parsed and read more.
+            chunk = self._read_chunk(json_file, utf8_decoder)
+            eof = chunk.__len__() == 0
+            buffered = buffered[idx:] + chunk
+            idx = 0
+
+"""
+JsonPacketWriter:
+    Writes packets one at a time, either as a JSON array laid out exactly like json.dumps(packets, indent=4) (the
+    existing dump format) or, with ndjson set, as one compact packet object per line.
+
+Parameters:
+    path: The file to write.
+    ndjson (default=False): Write newline-delimited JSON instead of a JSON array.
+"""
+class JsonPacketWriter:
+    def __init__(self, path, ndjson=False):
+        self.path = path
+        self.ndjson = ndjson
+        self.packet_count = 0
+        self._file = open(path, 'w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write_packet(self, packet):
+        if self.ndjson:
+            self._file.write(json.dumps(packet))
+            self._file.write('\n')
+        else:
+            self._file.write('[\n    ' if self.packet_count == 0 else ',\n    ')
+            self._file.write(json.dumps(packet, indent=4).replace('\n', '\n    '))
+        self.packet_count += 1
+
+    def write_frame(self, timestamp, frame):
+        self.write_packet({"date": timestamp, "string_value": frame_to_string_value(frame), "raw_byte_packet": list(frame)})
+
+    def close(self):
+        if self._file.closed:
+            return
+        if not self.ndjson:
+            self._file.write('[]' if self.packet_count == 0 else '\n]')
+        self._file.close()
+
+"""
+serialize_packet_buffer:
+    Turns every frame of a PacketRingBuffer into the dump layout (date, string_value, raw_byte_packet) for json.dump.
+"""
+def serialize_packet_buffer(packets):
+    rval = []
+    for _, timestamp, frame in packets.iter_frames():
+        rval.append({"date": timestamp, "string_value": frame_to_string_value(frame), "raw_byte_packet": list(frame)})
+    return rval
+
+"""
+deserialize_packets:
+    The reverse of serialize_packet_buffer: rebuilds an ELMRESPONSE (with its parsed KWPacket) for every non-empty
+    packet of a loaded dump.
+"""
+def deserialize_packets(serialized_packets):
+    rval = []
+    for p in serialized_packets:
+        if p["raw_byte_packet"].__len__() > 0:
+            converted_packets = numbers_to_bytestr(p["raw_byte_packet"])
+            if debug_enabled():
+                log_debug("Packet: ", p["raw_byte_packet"], "; Converted Packet: ", converted_packets)
+            rval.append(ELMRESPONSE(converted_packets, _date=datetime.datetime.fromtimestamp(p["date"]), _parse_kwp=True))
+    return rval
+
+def numbers_to_bytestr(input_num_arr):
+    return bytes(frame_to_string_value(bytes(input_num_arr)), "ascii")
+
+"""
+iter_capture_file:
+    Yields (timestamp, frame_bytes) for every non-empty frame in a .t1ncap, .sqlite, .json or .ndjson capture.
+    progress, if given, is a CaptureIOJob whose progress fraction is updated as the file is read.
+"""
+def iter_capture_file(path, progress=None):
+    if path.endswith(CAPTURE_STORE_EXTENSION):
+        with CaptureStore(path) as store:
+            total = max(1, store.__len__())
+            for i, (_, timestamp, frame) in enumerate(store.query()):
+                if progress is not None and (i & 0xFFF) == 0:
+                    progress.progress = i / total
+                if frame.__len__() > 0:
+                    yield timestamp, frame
+        return
+
+    if path.endswith(CAPTURE_EXTENSION):
+        with CaptureReader(path) as reader:
+            total = max(1, reader.__len__())
+            for i, (timestamp, frame) in enumerate(reader.iter_frames()):
+                if progress is not None and (i & 0xFFF) == 0:
+                    progress.progress = i / total
+                if frame.__len__() > 0:
+                    yield timestamp, frame
+        return
+
+    reader = JsonPacketReader(path)
+    total = max(1, reader.total_bytes)
+    for p in reader:
+        if progress is not None:
+            progress.progress = reader.bytes_read / total
+        if p["raw_byte_packet"].__len__() > 0:
+            yield p["date"], bytes(p["raw_byte_packet"])
+
+"""
+open_capture_writer:
+    Opens the writer that matches the file extension (.t1ncap, .sqlite, .ndjson or .json). Every writer has write_frame
+    and close.
+"""
+def open_capture_writer(path):
+    if path.endswith(CAPTURE_STORE_EXTENSION):
+        return CaptureStoreWriter(path, block_when_full=True)
+    if path.endswith(CAPTURE_EXTENSION):
+        return CaptureWriter(path)
+    return JsonPacketWriter(path, ndjson=path.endswith(NDJSON_EXTENSION))
+
+"""
+CaptureIOJob:
+    Runs an import or export on a background thread so the UI keeps drawing. The worker function is called as
+    target(job, *args) and can update job.progress (0.0 - 1.0) and check job.cancelled. Once done is set, result holds
+    the return value or error holds the exception.
+"""
+class CaptureIOJob:
+    def __init__(self, name, target, *args):
+        self.name = name
+        self.progress = 0.0
+        self.done = False
+        self.cancelled = False
+        self.result = None
+        self.error = None
+        self.started_at = time.perf_counter()
+        self.elapsed = 0.0
+        self._target = target
+        self._args = args
+        self._thread = threading.Thread(target=self._run, name="CaptureIOJob-" + name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self.result = self._target(self, *self._args)
+        except Exception as e:
+            self.error = e
+        self.elapsed = time.perf_counter() - self.started_at
+        self.progress = 1.0
+        self.done = True
+
+    def cancel(self):
+        self.cancelled = True
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+"""
+import_capture_job:
+    CaptureIOJob worker that streams a capture file into a FrameQueue (which the UI drains into _tracked_packets once
+    per frame). If the queue is full it waits for the UI to catch up instead of dropping frames. Returns the number
+    of frames imported.
+"""
+def import_capture_job(job, path, frame_queue):
+    count = 0
+    for timestamp, frame in iter_capture_file(path, progress=job):
+        if job.cancelled:
+            break
+        while not frame_queue.push((timestamp, frame)):
+            if job.cancelled:
+                return count
+            time.sleep(0.005)
+        count += 1
+    return count
+
+"""
+export_capture_job:
+    CaptureIOJob worker that writes every frame of a PacketRingBuffer (pass a copy, not the live buffer) to a file
+    in the format matching its extension. Returns the number of frames written.
+"""
+def export_capture_job(job, path, packets):
+    export_dir = os.path.dirname(path)
+    if export_dir and not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+
+    total = max(1, packets.__len__())
+    count = 0
+    writer = open_capture_writer(path)
+    try:
+        for _, timestamp, frame in packets.iter_frames():
+            if job.cancelled:
+                break
+            writer.write_frame(timestamp, frame)
+            count += 1
+            if (count & 0xFFF) == 0:
+                job.progress = count / total
+    finally:
+        writer.close()
+    return count
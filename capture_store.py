@@ -0,0 +1,288 @@
+import argparse
+import sqlite3
+import threading
+import time
+
+from capture_format import ns_to_seconds, seconds_to_ns
+from elmlib import ELMRESPONSE
+from packet_buffer import FrameQueue
+
+"""
+Capture store (.sqlite):
+    An SQLite database with one row per frame, for sessions too long to load or scan as a dump. The row ID is the
+    frame's sequence number (in the order frames were stored), the timestamp is kept as integer nanoseconds (the same
+    as the .t1ncap format, so conversions are exact) and the header fields are pulled out into their own columns so
+    they can be indexed:
+
+        frames(id, timestamp_ns, service_id, target, source, frame)
+
+    Indexes cover time ranges, service IDs (within a time range) and source/target pairs. The database is in WAL
+    mode, so it can be queried (ex: by the Debug Monitor) while the read thread is still writing to it.
+"""
+CAPTURE_STORE_EXTENSION = ".sqlite"
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS frames (id INTEGER PRIMARY KEY, timestamp_ns INTEGER NOT NULL, service_id INTEGER, "
+    "target INTEGER, source INTEGER, frame BLOB NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS frames_by_time ON frames (timestamp_ns)",
+    "CREATE INDEX IF NOT EXISTS frames_by_service ON frames (service_id, timestamp_ns)",
+    "CREATE INDEX IF NOT EXISTS frames_by_address ON frames (source, target, timestamp_ns)",
+]
+
+def _connect(path):
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    # In WAL mode NORMAL only risks the last transactions on power loss, never corruption.
+    connection.execute("PRAGMA synchronous=NORMAL")
+    for statement in _SCHEMA:
+        connection.execute(statement)
+    connection.commit()
+    return connection
+
+# The indexed columns of one frame: (timestamp_ns, service_id, target, source, frame). Short frames get NULLs.
+def _frame_row(timestamp, frame):
+    frame = bytes(frame)
+    service_id = None
+    if frame.__len__() > 3:
+        service_id = frame[4] if (frame[0] & 0x3F) == 0 and frame.__len__() > 4 else frame[3]
+    target = frame[1] if frame.__len__() > 1 else None
+    source = frame[2] if frame.__len__() > 2 else None
+    return (seconds_to_ns(timestamp), service_id, target, source, frame)
+
+"""
+CaptureStoreWriter:
+    Stores frames in a capture store from the read thread without ever waiting on the disk there: write_frame only
+    pushes onto a FrameQueue, and a writer thread inserts whatever has queued up every flush_interval seconds (or as
+    soon as batch_size frames are waiting) in one transaction. It has the same write_frame/close interface as the
+    other capture writers (see capture_json.open_capture_writer).
+
+    Counters: frame_count (stored), batch_count, insert_time (seconds spent inserting) and the queue's dropped_count.
+
+Parameters:
+    path: The .sqlite file. Frames are added to it if it already exists.
+    batch_size (default=2048): Frames per transaction at most.
+    flush_interval (default=0.25): Longest a frame waits before it's stored.
+    queue_capacity (default=262144): Frames that can be waiting before write_frame starts dropping them.
+    block_when_full (default=False): Make write_frame wait for room instead of dropping (ex: converting a file, where
+                                     nothing is lost by waiting).
+"""
+class CaptureStoreWriter:
+    def __init__(self, path, batch_size=2048, flush_interval=0.25, queue_capacity=262144, block_when_full=False):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block_when_full = block_when_full
+        self.frame_count = 0
+        self.batch_count = 0
+        self.insert_time = 0.0
+        self.error = None
+
+        self._connection = _connect(path)
+        self._queue = FrameQueue(queue_capacity)
+        self._wakeup = threading.Event()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="CaptureStoreWriter", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    """
+    write_frame:
+        Queues one frame to be stored. Returns False if the queue was full and the frame was dropped.
+    """
+    def write_frame(self, timestamp, frame):
+        item = (timestamp, bytes(frame))
+        if self.block_when_full:
+            while self._queue.__len__() >= self._queue.capacity:
+                self._wakeup.set()
+                time.sleep(0.01)
+        if not self._queue.push(item):
+            return False
+        if self._queue.__len__() >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def _insert_pending(self):
+        while self._queue.__len__() > 0:
+            batch = self._queue.drain(self.batch_size)
+            tic = time.perf_counter()
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT INTO frames (timestamp_ns, service_id, target, source, frame) VALUES (?, ?, ?, ?, ?)",
+                    [_frame_row(timestamp, frame) for timestamp, frame in batch])
+            self.insert_time += time.perf_counter() - tic
+            self.frame_count += batch.__len__()
+            self.batch_count += 1
+
+    def _run(self):
+        while self._running:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self._insert_pending()
+            except sqlite3.Error as e:
+                # Keep the read thread going; the failure shows up in stats_string.
+                self.error = e
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._running = False
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        self._insert_pending()
+        self._connection.close()
+
+    def stats_string(self):
+        return "Stored: {} frames in {} batches ({:.1f} ms inserting); waiting: {}; dropped: {}{}".format(
+            self.frame_count, self.batch_count, self.insert_time * 1000.0, self._queue.__len__(), self._queue.dropped_count,
+            "; error: {}".format(self.error) if self.error is not None else "")
+
+"""
+CaptureStore:
+    Reads a capture store. Queries return rows lazily (SQLite steps through the matching rows as the result is
+    iterated), so scanning a multi-hour session for one service ID never loads more than a few rows at a time.
+
+    Every query takes the same filters:
+        start / end: Time range as float timestamps (start inclusive, end exclusive).
+        service_ids: A service ID byte or a list of them (KnownServiceIDs members work too).
+        target / source: Address bytes.
+
+Parameters:
+    path: The .sqlite file.
+"""
+class CaptureStore:
+    def __init__(self, path):
+        self.path = path
+        self._connection = _connect(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM frames").fetchone()[0]
+
+    def _where(self, start, end, service_ids, target, source):
+        clauses = []
+        parameters = []
+        if service_ids is not None:
+            if not isinstance(service_ids, (list, tuple, set)):
+                service_ids = [service_ids]
+            service_ids = [getattr(service_id, "value", service_id) for service_id in service_ids]
+            clauses.append("service_id IN ({})".format(", ".join("?" * service_ids.__len__())))
+            parameters.extend(service_ids)
+        if source is not None:
+            clauses.append("source = ?")
+            parameters.append(getattr(source, "value", source))
+        if target is not None:
+            clauses.append("target = ?")
+            parameters.append(getattr(target, "value", target))
+        if start is not None:
+            clauses.append("timestamp_ns >= ?")
+            parameters.append(seconds_to_ns(start))
+        if end is not None:
+            clauses.append("timestamp_ns < ?")
+            parameters.append(seconds_to_ns(end))
+        return (" WHERE " + " AND ".join(clauses) if clauses.__len__() > 0 else ""), parameters
+
+    """
+    query:
+        Yields (seq, timestamp, frame_bytes) for every frame matching the filters, oldest first (the same tuples as
+        PacketRingBuffer.iter_frames). offset/limit select a window of the matches.
+    """
+    def query(self, start=None, end=None, service_ids=None, target=None, source=None, offset=0, limit=None):
+        where, parameters = self._where(start, end, service_ids, target, source)
+        sql = "SELECT id, timestamp_ns, frame FROM frames" + where + " ORDER BY timestamp_ns, id"
+        if limit is not None or offset > 0:
+            sql += " LIMIT ? OFFSET ?"
+            parameters.extend([-1 if limit is None else limit, offset])
+        for seq, timestamp_ns, frame in self._connection.execute(sql, parameters):
+            yield seq, ns_to_seconds(timestamp_ns), frame
+
+    def count(self, start=None, end=None, service_ids=None, target=None, source=None):
+        where, parameters = self._where(start, end, service_ids, target, source)
+        return self._connection.execute("SELECT COUNT(*) FROM frames" + where, parameters).fetchone()[0]
+
+    """
+    page:
+        One page of query results as a list, for paging through a capture in the UI: rows offset to offset + limit.
+    """
+    def page(self, offset, limit, start=None, end=None, service_ids=None, target=None, source=None):
+        return list(self.query(start, end, service_ids, target, source, offset, limit))
+
+    def time_range(self):
+        first, last = self._connection.execute("SELECT MIN(timestamp_ns), MAX(timestamp_ns) FROM frames").fetchone()
+        if first is None:
+            return None
+        return ns_to_seconds(first), ns_to_seconds(last)
+
+    """
+    get_packet:
+        Rebuilds the ELMRESPONSE (with its parsed KWPacket) for a sequence number, like PacketRingBuffer.get_packet.
+    """
+    def get_packet(self, seq):
+        row = self._connection.execute("SELECT timestamp_ns, frame FROM frames WHERE id = ?", (seq,)).fetchone()
+        if row is None:
+            raise IndexError("Packet {} is not in the store".format(seq))
+        return ELMRESPONSE(bytes(row[1].hex(' ').upper() + ' \r', 'ascii'), _date=ns_to_seconds(row[0]), _parse_kwp=True)
+
+    def close(self):
+        self._connection.close()
+
+"""
+import_capture:
+    Stores every frame of a capture file (dumps/*.json, .ndjson or .t1ncap) in a capture store. Returns the number of
+    frames stored.
+"""
+def import_capture(capture_path, store_path):
+    from capture_json import iter_capture_file
+
+    with CaptureStoreWriter(store_path, block_when_full=True) as writer:
+        for timestamp, frame in iter_capture_file(capture_path):
+            writer.write_frame(timestamp, frame)
+    return writer.frame_count
+
+def _parse_byte_list(text):
+    if text is None:
+        return None
+    return [int(value, 16) for value in text.replace(",", " ").split()]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Store captures in SQLite and query them by time, service ID and address.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="Store a capture file (.json, .ndjson or .t1ncap)")
+    import_parser.add_argument("capture")
+    import_parser.add_argument("store")
+    query_parser = commands.add_parser("query", help="Print the frames matching the filters")
+    query_parser.add_argument("store")
+    query_parser.add_argument("--service", help="Service IDs in hex, ex: '57' or '18,58'")
+    query_parser.add_argument("--source", help="Source address in hex")
+    query_parser.add_argument("--target", help="Target address in hex")
+    query_parser.add_argument("--start", type=float, help="Start time (seconds since the epoch)")
+    query_parser.add_argument("--end", type=float, help="End time (seconds since the epoch)")
+    query_parser.add_argument("--limit", type=int, help="Print at most this many frames")
+    args = parser.parse_args()
+
+    tic = time.perf_counter()
+    if args.command == "import":
+        frame_count = import_capture(args.capture, args.store)
+        print("Stored {} frames in {:.3f}s".format(frame_count, time.perf_counter() - tic))
+    else:
+        source = _parse_byte_list(args.source)
+        target = _parse_byte_list(args.target)
+        with CaptureStore(args.store) as store:
+            match_count = 0
+            for seq, timestamp, frame in store.query(args.start, args.end, _parse_byte_list(args.service),
+                                                     target[0] if target else None, source[0] if source else None,
+                                                     limit=args.limit):
+                print("{:>10} {:.6f} {}".format(seq, timestamp, frame.hex(' ').upper()))
+                match_count += 1
+        print("{} frames in {:.1f} ms".format(match_count, (time.perf_counter() - tic) * 1000.0))
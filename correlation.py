@@ -0,0 +1,190 @@
+import math
+
+from sprinter_types import ConvertByteToKnownServiceIDs
+
+NEGATIVE_RESPONSE_SID = 0x7F
+# Positive responses are the request service ID with this bit set (0x30 -> 0x70, 0x18 -> 0x58, 0x3E -> 0x7E).
+RESPONSE_SID_BIT = 0x40
+
+"""
+LatencyHistogram:
+    A streaming histogram of round-trip times with logarithmic buckets (buckets_per_doubling buckets for every doubling
+    of the latency), so it stays a fixed size no matter how many samples go in and keeps the same relative precision
+    from sub-millisecond keepalives to multi-second replies. count, min, max and mean are exact; percentiles are
+    accurate to the bucket width (about 19% with the default of 4 buckets per doubling).
+
+Parameters:
+    min_latency (default=0.0001): Anything faster than this (seconds) goes in the first bucket.
+    max_latency (default=60.0): Anything slower than this goes in the last bucket.
+    buckets_per_doubling (default=4): Resolution of the buckets.
+"""
+class LatencyHistogram:
+    def __init__(self, min_latency=0.0001, max_latency=60.0, buckets_per_doubling=4):
+        self.min_latency = min_latency
+        self.buckets_per_doubling = buckets_per_doubling
+        self.bucket_count = int(math.ceil(math.log2(max_latency / min_latency) * buckets_per_doubling)) + 1
+        self.counts = [0] * self.bucket_count
+
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, latency):
+        if latency <= self.min_latency:
+            return 0
+        return min(self.bucket_count - 1, int(math.log2(latency / self.min_latency) * self.buckets_per_doubling))
+
+    # Upper edge of a bucket, in seconds.
+    def bucket_limit(self, bucket):
+        return self.min_latency * 2.0 ** ((bucket + 1) / self.buckets_per_doubling)
+
+    def add(self, latency):
+        self.counts[self._bucket(latency)] += 1
+        self.count += 1
+        self.total += latency
+        if self.min is None or latency < self.min:
+            self.min = latency
+        if self.max is None or latency > self.max:
+            self.max = latency
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else 0.0
+
+    """
+    percentile:
+        Returns the latency below which p percent (0 - 100) of the samples fall, to bucket precision.
+    """
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        rank = max(1, int(math.ceil(self.count * p / 100.0)))
+        seen = 0
+        for bucket, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(self.max, max(self.min, self.bucket_limit(bucket)))
+        return self.max
+
+    def summary_string(self):
+        if self.count == 0:
+            return "no samples"
+        return "n={} min={:.1f}ms p50={:.1f}ms p90={:.1f}ms p99={:.1f}ms max={:.1f}ms".format(
+            self.count, self.min * 1000.0, self.percentile(50) * 1000.0, self.percentile(90) * 1000.0,
+            self.percentile(99) * 1000.0, self.max * 1000.0)
+
+class ServiceStats:
+    def __init__(self):
+        self.requests = 0
+        self.responses = 0
+        self.negative_responses = 0
+        self.timeouts = 0
+        self.orphan_responses = 0
+        self.latency = LatencyHistogram()
+
+"""
+RequestCorrelator:
+    Pairs every request on the bus with its response and keeps per-service round-trip statistics.
+    A response matches the outstanding request with service ID (response - 0x40) and the addresses swapped (the
+    request went to 0x12 from 0xF3, so the response comes from 0x12 to 0xF3). A negative response (0x7F) matches the
+    request whose service ID is its first payload byte.
+
+    Requests with no response within timeout seconds (of frame time) count as timeouts, as do requests that get
+    superseded by the next request for the same service before any response. Responses with no outstanding request
+    count as orphans.
+
+Parameters:
+    timeout (default=2.0): Seconds a request waits for its response.
+    on_pair (default=None): Called as on_pair(request_sid, latency, request_frame, response_frame) for every match.
+"""
+class RequestCorrelator:
+    def __init__(self, timeout=2.0, on_pair=None):
+        self.timeout = timeout
+        self.on_pair = on_pair
+        # (target, source, service ID) of the request -> (timestamp, KWPFrame)
+        self._outstanding = {}
+        # Request service ID -> ServiceStats
+        self.services = {}
+
+        self.pair_count = 0
+        self.timeout_count = 0
+        self.orphan_count = 0
+
+    def _stats(self, service_id):
+        stats = self.services.get(service_id)
+        if stats is None:
+            stats = ServiceStats()
+            self.services[service_id] = stats
+        return stats
+
+    def outstanding_count(self):
+        return self._outstanding.__len__()
+
+    """
+    expire:
+        Counts requests that have waited longer than timeout as timed out. Called on every feed().
+    """
+    def expire(self, now):
+        if self._outstanding.__len__() == 0:
+            return
+        for key in [k for k, (sent_at, _) in self._outstanding.items() if now - sent_at > self.timeout]:
+            del self._outstanding[key]
+            self._stats(key[2]).timeouts += 1
+            self.timeout_count += 1
+
+    """
+    feed:
+        Takes one decoded frame (a KWPFrame) and its receive time.
+    """
+    def feed(self, decoded, timestamp):
+        self.expire(timestamp)
+        service_id = decoded.ServiceID_Raw
+
+        if service_id == NEGATIVE_RESPONSE_SID:
+            if decoded.payload.__len__() == 0:
+                return
+            request_sid = decoded.payload[0]
+        elif service_id & RESPONSE_SID_BIT:
+            request_sid = service_id & ~RESPONSE_SID_BIT
+        else:
+            key = (decoded.MsgTarget_Raw, decoded.MsgSource_Raw, service_id)
+            if key in self._outstanding:
+                self._stats(service_id).timeouts += 1
+                self.timeout_count += 1
+            self._outstanding[key] = (timestamp, decoded)
+            self._stats(service_id).requests += 1
+            return
+
+        # The response travels the other way, so its source is the request's target.
+        request = self._outstanding.pop((decoded.MsgSource_Raw, decoded.MsgTarget_Raw, request_sid), None)
+        stats = self._stats(request_sid)
+        if request is None:
+            stats.orphan_responses += 1
+            self.orphan_count += 1
+            return
+
+        latency = timestamp - request[0]
+        if service_id == NEGATIVE_RESPONSE_SID:
+            stats.negative_responses += 1
+        else:
+            stats.responses += 1
+        stats.latency.add(latency)
+        self.pair_count += 1
+        if self.on_pair is not None:
+            self.on_pair(request_sid, latency, request[1], decoded)
+
+    """
+    report_lines:
+        One line per request service ID: counts and the latency distribution.
+    """
+    def report_lines(self):
+        lines = []
+        for service_id, stats in sorted(list(self.services.items())):
+            lines.append("{:#04x} {:<36} req={} resp={} neg={} timeout={} orphan={} {}".format(
+                service_id, str(ConvertByteToKnownServiceIDs(service_id)), stats.requests, stats.responses,
+                stats.negative_responses, stats.timeouts, stats.orphan_responses, stats.latency.summary_string()))
+        return lines
+
+    def stats_string(self):
+        return "Pairs: {}; outstanding: {}; timeouts: {}; orphans: {}".format(
+            self.pair_count, self._outstanding.__len__(), self.timeout_count, self.orphan_count)
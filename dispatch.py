@@ -0,0 +1,194 @@
+import queue
+import threading
+import time
+
+from sprinter_log import log_error
+
+"""
+Subscription:
+    One handler subscribed to a service ID on a DispatchBus, optionally only for frames to/from given addresses.
+    Keeps its own timing and drop counters: call_count, error_count, dropped_count (its worker queue was full),
+    total_time and max_time (seconds spent inside the handler).
+"""
+class Subscription:
+    def __init__(self, service_id, handler, target=None, source=None, worker=None):
+        self.service_id = service_id
+        self.handler = handler
+        self.target = target
+        self.source = source
+        self.worker = worker
+
+        self.call_count = 0
+        self.error_count = 0
+        self.dropped_count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def matches(self, target, source):
+        return (self.target is None or self.target == target) and (self.source is None or self.source == source)
+
+    def call(self, service_id, payload):
+        start = time.perf_counter()
+        try:
+            self.handler(service_id, payload)
+        except Exception as e:
+            self.error_count += 1
+            log_error("Listener {} failed on service ID {:#04x}: {}".format(self.name(), service_id, e))
+        elapsed = time.perf_counter() - start
+        self.call_count += 1
+        self.total_time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+
+    def name(self):
+        return getattr(self.handler, "__name__", repr(self.handler))
+
+    def stats_string(self):
+        mean = self.total_time / self.call_count if self.call_count > 0 else 0.0
+        return "{:#04x} {:<40} {} calls={} mean={:.3f}ms max={:.3f}ms errors={} dropped={}".format(
+            self.service_id, self.name(), "worker" if self.worker is not None else "inline", self.call_count,
+            mean * 1000.0, self.max_time * 1000.0, self.error_count, self.dropped_count)
+
+"""
+HandlerWorker:
+    A thread that runs the handlers assigned to it from a bounded queue, so a slow handler only holds up its own
+    worker and never the read path. Each subscription always goes to the same worker, so its calls stay in order.
+"""
+class HandlerWorker:
+    def __init__(self, name, queue_size):
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def submit(self, subscription, service_id, payload):
+        try:
+            self._queue.put_nowait((subscription, service_id, payload))
+        except queue.Full:
+            subscription.dropped_count += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            subscription, service_id, payload = item
+            subscription.call(service_id, payload)
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+"""
+DispatchBus:
+    Hands each complete message to every handler subscribed to its service ID. Lookups go through a 256-entry table
+    (one tuple of subscriptions per service ID byte) that is rebuilt whenever a subscription is added or removed, so
+    publish() never has to search or lock anything.
+
+    Handlers are called as handler(service_id, payload), the same as the elm327_add_listener handlers. Subscribing
+    with threaded=True runs the handler on one of the bus's worker threads instead of inline on the read path; its
+    payload is copied first, and if the worker's queue is full the message is dropped (and counted) rather than
+    blocking the caller.
+
+Parameters:
+    worker_count (default=2): Number of worker threads for threaded handlers. They're started on first use.
+    queue_size (default=1024): Messages each worker can have waiting.
+"""
+class DispatchBus:
+    def __init__(self, worker_count=2, queue_size=1024):
+        self.worker_count = worker_count
+        self.queue_size = queue_size
+        self.published_count = 0
+        self.unhandled_count = 0
+
+        self._table = [()] * 256
+        self._subscriptions = []
+        self._workers = []
+        self._next_worker = 0
+        self._lock = threading.Lock()
+
+    def _rebuild_table(self):
+        table = [[] for _ in range(0, 256)]
+        for subscription in self._subscriptions:
+            table[subscription.service_id].append(subscription)
+        self._table = [tuple(entry) for entry in table]
+
+    def _assign_worker(self):
+        if self._workers.__len__() == 0:
+            self._workers = [HandlerWorker("DispatchWorker-{}".format(i), self.queue_size) for i in range(0, max(1, self.worker_count))]
+        worker = self._workers[self._next_worker % self._workers.__len__()]
+        self._next_worker += 1
+        return worker
+
+    """
+    subscribe:
+        Adds a handler and returns its Subscription (pass it to unsubscribe to remove it again).
+
+    Parameters:
+        service_id: The service ID byte (or a KnownServiceIDs member).
+        handler: Called as handler(service_id, payload).
+        target (default=None): Only messages sent to this address byte.
+        source (default=None): Only messages sent from this address byte.
+        threaded (default=False): Run the handler on a worker thread instead of inline.
+    """
+    def subscribe(self, service_id, handler, target=None, source=None, threaded=False):
+        service_id = getattr(service_id, "value", service_id)
+        target = getattr(target, "value", target)
+        source = getattr(source, "value", source)
+        with self._lock:
+            subscription = Subscription(service_id, handler, target, source, self._assign_worker() if threaded else None)
+            self._subscriptions.append(subscription)
+            self._rebuild_table()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+                self._rebuild_table()
+
+    def subscriptions(self):
+        return list(self._subscriptions)
+
+    """
+    publish:
+        Delivers one message. target/source are the address bytes of the message; subscriptions that filter on an
+        address never match a message published without one.
+    """
+    def publish(self, service_id, payload, target=None, source=None):
+        self.published_count += 1
+        subscriptions = self._table[service_id]
+        if subscriptions.__len__() == 0:
+            self.unhandled_count += 1
+            return
+
+        copied_payload = None
+        for subscription in subscriptions:
+            if not subscription.matches(target, source):
+                continue
+            if subscription.worker is None:
+                subscription.call(service_id, payload)
+            else:
+                # The payload can be a view into a buffer that gets reused once publish returns.
+                if copied_payload is None:
+                    copied_payload = bytes(payload)
+                subscription.worker.submit(subscription, service_id, copied_payload)
+
+    """
+    close:
+        Stops the worker threads once they have run everything already queued.
+    """
+    def close(self):
+        workers = self._workers
+        self._workers = []
+        for worker in workers:
+            worker.stop()
+
+    def stats_lines(self):
+        lines = ["Published: {}; unhandled: {}; worker queue depth: {}".format(
+            self.published_count, self.unhandled_count, [worker.depth() for worker in self._workers])]
+        for subscription in self.subscriptions():
+            lines.append(subscription.stats_string())
+        return lines
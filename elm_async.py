@@ -0,0 +1,234 @@
+import asyncio
+import time
+
+import serial
+
+from elmlib import ELMRESPONSE, KWPFramer, SerialLineBuffer
+
+"""
+AsyncELM327:
+    An asyncio version of elmlib.ELM327. Reads are driven by the event loop (the serial port's file descriptor is
+    registered with loop.add_reader, or polled on platforms that can't do that), so nothing ever blocks waiting on the
+    adapter: commands are awaitable and monitored frames come out of an async iterator.
+
+    Several tasks can share one adapter. Commands are queued on a lock and run one at a time, since the ELM327 only
+    handles one at a time, but waiting for a command doesn't hold up anything else on the loop. If the adapter is in
+    monitor mode when a command comes in, monitoring is interrupted (any byte sent stops AT MA), the command runs, and
+    monitoring is started again, so a keepalive or request can be sent while another task keeps reading frames.
+
+    Works with anything pyserial can open, including a pty (ex: the emulator's /dev/pts/N).
+
+Parameters:
+    device: The serial device to open.
+    baud: The baud rate.
+    command_timeout (default=2): Seconds to wait for the '>' prompt after a command.
+    frame_queue_size (default=4096): Frames buffered for the frames() iterator; once it's full the oldest are
+                                     dropped (and counted in dropped_frames) so a slow consumer can't stall reads.
+"""
+class AsyncELM327:
+    command_timeout = 2
+    read_poll_interval = 0.01
+
+    def __init__(self, device, baud, command_timeout=2, frame_queue_size=4096):
+        self.specified_device = device
+        self.baud = baud
+        self.command_timeout = command_timeout
+        self.echo_enabled = True
+        self.monitor_all_mode = False
+        self.command_latencies = []
+        self.dropped_frames = 0
+        self.framer = KWPFramer()
+
+        self.serial = None
+        self._loop = None
+        self._poll_task = None
+        self._rx = SerialLineBuffer()
+        self._command_lock = None
+        self._reply = None
+        self._frames = None
+        self._frame_queue_size = frame_queue_size
+
+    """
+    open:
+        Opens the port and starts reading. Must be called (awaited) from the loop that will use the adapter.
+    """
+    async def open(self):
+        self._loop = asyncio.get_running_loop()
+        self._command_lock = asyncio.Lock()
+        self._frames = asyncio.Queue(maxsize=self._frame_queue_size)
+        self.serial = serial.Serial(self.specified_device, self.baud, timeout=0, write_timeout=self.command_timeout)
+        try:
+            self._loop.add_reader(self.serial.fileno(), self._on_readable)
+        except (NotImplementedError, AttributeError, OSError):
+            # Windows event loops (and ports without a file descriptor) can't watch the port, so poll it instead.
+            self._poll_task = self._loop.create_task(self._poll_loop())
+        return self
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def is_open(self):
+        return self.serial is not None and self.serial.is_open
+
+    async def close(self):
+        if self.serial is None:
+            return
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            self._poll_task = None
+        else:
+            self._loop.remove_reader(self.serial.fileno())
+        self.serial.close()
+        if self._reply is not None and not self._reply[0].done():
+            self._reply[0].cancel()
+        # Wake up anything waiting on frames().
+        self._put_frame(None)
+
+    async def _poll_loop(self):
+        while True:
+            self._on_readable()
+            await asyncio.sleep(self.read_poll_interval)
+
+    def _on_readable(self):
+        try:
+            data = self.serial.read(self.serial.in_waiting or 1)
+        except (serial.SerialException, OSError):
+            return
+        if not data:
+            return
+
+        if self._reply is None:
+            self._feed_frames(data)
+            return
+
+        # A command is waiting for its reply; everything up to the terminator belongs to it.
+        future, terminator = self._reply
+        self._rx.feed(data)
+        reply = self._rx.pop_until(terminator)
+        if reply is not None:
+            self._reply = None
+            if not future.done():
+                future.set_result(reply)
+            leftover = self._rx.pop_all()
+            if leftover:
+                self._feed_frames(leftover)
+
+    def _feed_frames(self, data):
+        timestamp = time.time()
+        for decoded in self.framer.feed(data):
+            self._put_frame((timestamp, decoded))
+
+    def _put_frame(self, item):
+        if self._frames.full():
+            self._frames.get_nowait()
+            self.dropped_frames += 1
+        self._frames.put_nowait(item)
+
+    """
+    frames:
+        Async iterator of (timestamp, KWPFrame) for every checksum-valid frame the adapter prints while monitoring.
+        Ends when the adapter is closed.
+    """
+    async def frames(self):
+        while True:
+            item = await self._frames.get()
+            if item is None:
+                return
+            yield item
+
+    async def _send_and_wait(self, command, terminator, timeout):
+        future = self._loop.create_future()
+        self._reply = (future, terminator) if terminator is not None else None
+        self.serial.write(command.encode('ascii'))
+        if terminator is None:
+            return b'', True
+        try:
+            return await asyncio.wait_for(future, timeout), True
+        except asyncio.TimeoutError:
+            self._reply = None
+            return self._rx.pop_all(), False
+
+    """
+    execute_command:
+        Sends an AT (or OBD) command and waits for the '>' prompt without blocking the loop. Returns an ELMRESPONSE
+        with everything the adapter printed in reply. The time each command took is appended to command_latencies as
+        (command, seconds, got_prompt).
+
+    Parameters:
+        command: The full command string, including the trailing line ending.
+        timeout (default=command_timeout): Seconds to wait for the prompt.
+        wait_for_prompt (default=True): Commands that don't return to the prompt (AT MA) only wait for their echo.
+        resume_monitor (default=True): If monitoring was interrupted for this command, start it again afterwards.
+    """
+    async def execute_command(self, command, timeout=None, wait_for_prompt=True, resume_monitor=True):
+        if timeout is None:
+            timeout = self.command_timeout
+
+        async with self._command_lock:
+            interrupted_monitor = self.monitor_all_mode
+            if interrupted_monitor:
+                # Any byte stops AT MA; the adapter answers with "STOPPED" and the prompt.
+                await self._send_and_wait("\r", b'>', timeout)
+                self.monitor_all_mode = False
+
+            tic = time.perf_counter()
+            if wait_for_prompt:
+                terminator = b'>'
+            elif self.echo_enabled:
+                terminator = b'\r'
+            else:
+                terminator = None
+            reply, got_prompt = await self._send_and_wait(command, terminator, timeout)
+            elapsed = time.perf_counter() - tic
+            self.command_latencies.append((command.strip(), elapsed, got_prompt))
+
+            if interrupted_monitor and resume_monitor:
+                await self._send_and_wait("AT MA\r\n", b'\r' if self.echo_enabled else None, timeout)
+                self.monitor_all_mode = True
+
+        return ELMRESPONSE(reply)
+
+    async def set_kwp2000(self):
+        return await self.execute_command("AT SP 4\r\n")
+
+    async def set_show_headers(self, show_headers):
+        return await self.execute_command("AT H1\r\n" if show_headers else "AT H0\r\n")
+
+    async def set_echo_enabled(self, e_enabled):
+        response = await self.execute_command("AT E1\r\n" if e_enabled else "AT E0\r\n")
+        self.echo_enabled = e_enabled
+        return response
+
+    async def send_reset(self):
+        return await self.execute_command("AT PC\r\n")
+
+    async def set_monitor_all(self):
+        # AT MA never returns to the prompt; the adapter starts printing bus traffic straight away. If it's already
+        # monitoring, execute_command stops it first, and resuming afterwards would send a second AT MA into the
+        # running monitor (its first byte would just stop it again).
+        response = await self.execute_command("AT MA\r\n", wait_for_prompt=False, resume_monitor=False)
+        self.monitor_all_mode = True
+        return response
+
+    """
+    send_message:
+        Sends a KWP message (a list of data bytes, ex: [0x3E] for a keepalive) and returns the adapter's reply lines.
+        Monitoring, if it was running, is picked back up afterwards.
+    """
+    async def send_message(self, data_bytes, timeout=None):
+        return await self.execute_command(" ".join("{:02X}".format(b) for b in data_bytes) + "\r\n", timeout)
+
+    """
+    configure_monitor_mode:
+        The same startup sequence as ELM327.configure_monitor_mode (KWP2000, headers on, monitor all). Returns the
+        time it took.
+    """
+    async def configure_monitor_mode(self):
+        tic = time.perf_counter()
+        await self.set_kwp2000()
+        await self.set_show_headers(True)
+        await self.set_monitor_all()
+        return time.perf_counter() - tic
@@ -0,0 +1,459 @@
+import argparse
+import os
+import select
+import threading
+import time
+
+from capture_format import frame_to_string_value
+from capture_json import iter_capture_file
+from elmlib import kwp_checksum
+
+ELM327_IDENTIFICATION = b"ELM327 v1.5"
+TESTER_ADDRESS = 0xF3
+ECU_ADDRESS = 0x12
+
+"""
+build_frame:
+    A KWP2000 frame with the length in the format byte and the checksum on the end.
+"""
+def build_frame(target, source, service_id, payload=b''):
+    frame = bytes([0x80 | (payload.__len__() + 1), target, source, service_id]) + bytes(payload)
+    return frame + bytes([kwp_checksum(frame)])
+
+"""
+iter_load_frames:
+    Endless synthetic traffic for load tests: tester present (0x3E) and its 0x7E reply, alternating with read DTCs by
+    status (0x18) and a 0x58 reply listing 0-4 made up codes, as (request, response) frame pairs.
+"""
+def iter_load_frames():
+    tester_present = build_frame(ECU_ADDRESS, TESTER_ADDRESS, 0x3E)
+    tester_present_reply = build_frame(TESTER_ADDRESS, ECU_ADDRESS, 0x7E)
+    read_codes = build_frame(ECU_ADDRESS, TESTER_ADDRESS, 0x18, b'\x02\xFF\x00')
+    code_replies = []
+    for code_count in range(0, 5):
+        payload = bytearray([code_count])
+        for i in range(0, code_count):
+            payload += bytes([0x01, 0x00 + i * 0x11, 0x24])
+        code_replies.append(build_frame(TESTER_ADDRESS, ECU_ADDRESS, 0x58, payload))
+
+    i = 0
+    while True:
+        yield tester_present
+        yield tester_present_reply
+        yield read_codes
+        yield code_replies[i % code_replies.__len__()]
+        i += 1
+
+"""
+ELM327Emulator:
+    A stand-in ELM327 on a pseudo-terminal, for testing the driver, the monitor and MonitorData without a van. open()
+    returns the pty's device path, which can be opened like any USB serial adapter (ELM327(..., device, 38400)).
+
+    It answers the AT commands the project sends (Z, I, E0/E1, H0/H1, SP, DPN, PC, BI, SW, SH, MA, BRD/BRT) after
+    command_delay, and answers messages sent with write_bytes after message_delay (0x3E gets 0x7E, 0x18 gets a 0x58
+    code list, anything else a negative response). In AT MA it prints bus traffic, either a capture played back with
+    its recorded timing (divided by speed, looping forever) or, with load_rate set, synthetic traffic from
+    iter_load_frames at load_rate frames per second. Any byte sent while monitoring stops it with "STOPPED" and is used
+    up doing so, like the real adapter.
+
+    Output goes through a transmit buffer of tx_buffer_size bytes. If baud_rate is set, it drains at baud_rate / 10
+    bytes per second like a real UART; either way, once the host stops reading the buffer fills up, and a frame that
+    doesn't fit stops monitoring with "BUFFER FULL", again like the real adapter.
+
+    Counters: frames_sent, bytes_sent, commands_received, buffer_full_count, interrupt_count (times monitoring was
+    stopped by a byte from the host), and send_times (perf_counter time each frame went out, in order, kept only if
+    record_send_times is set) for latency measurements.
+
+Parameters:
+    capture_path (default=None): A capture to stream in monitor mode (dumps/*.json, .ndjson or .t1ncap).
+    load_rate (default=None): Frames per second of synthetic traffic instead of a capture.
+    speed (default=1.0): Playback speed of the capture.
+    command_delay (default=0.005): Seconds before an AT command is answered.
+    message_delay (default=0.05): Seconds before a sent message is answered (the ECU's reply time).
+    baud_rate (default=None): Simulated UART rate; None sends as fast as the pty takes it.
+    tx_buffer_size (default=512): Bytes of output the adapter can hold.
+"""
+class ELM327Emulator:
+    def __init__(self, capture_path=None, load_rate=None, speed=1.0, command_delay=0.005, message_delay=0.05,
+                 baud_rate=None, tx_buffer_size=512, record_send_times=False):
+        if capture_path is None and load_rate is None:
+            raise ValueError("The emulator needs a capture to stream or a load rate")
+        if load_rate is not None and load_rate <= 0:
+            raise ValueError("The load rate must be greater than 0")
+
+        self.capture_path = capture_path
+        self.load_rate = load_rate
+        self.speed = speed
+        self.command_delay = command_delay
+        self.message_delay = message_delay
+        self.baud_rate = baud_rate
+        self.tx_buffer_size = tx_buffer_size
+        self.record_send_times = record_send_times
+        self.device = None
+
+        self.echo_enabled = True
+        self.show_headers = False
+        self.protocol = b"0"
+        self.monitor_all_mode = False
+        self.handshake_timeout = 0.075
+
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.interrupt_count = 0
+        self.commands_received = 0
+        self.buffer_full_count = 0
+        self.send_times = []
+
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+        self._input = bytearray()
+        self._output = bytearray()
+        self._frames = None
+        self._pending_frame = None
+        self._monitor_start = 0.0
+        self._tx_credit = 0.0
+        self._last_drain = 0.0
+
+    """
+    open:
+        Creates the pty and starts answering on it. Returns the device path to open.
+    """
+    def open(self):
+        import pty
+        import tty
+
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self.device = os.ttyname(self._slave)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="ELM327Emulator", daemon=True)
+        self._thread.start()
+        return self.device
+
+    def close(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = None
+        self._slave = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Yields (seconds after monitoring started, frame); the capture loops forever, each pass carrying on after the last.
+    def _iter_capture_frames(self):
+        pass_offset = 0.0
+        while True:
+            first_timestamp = None
+            last_timestamp = None
+            for timestamp, frame in iter_capture_file(self.capture_path):
+                if first_timestamp is None:
+                    first_timestamp = timestamp
+                last_timestamp = timestamp
+                yield pass_offset + (timestamp - first_timestamp) / self.speed, frame
+            if first_timestamp is None:
+                return
+            pass_offset += (last_timestamp - first_timestamp) / self.speed + 0.01
+
+    def _start_monitoring(self):
+        self.monitor_all_mode = True
+        now = time.perf_counter()
+        if self.load_rate is not None:
+            self._frames = ((i / self.load_rate, frame) for i, frame in enumerate(iter_load_frames()))
+        else:
+            self._frames = self._iter_capture_frames()
+        self._monitor_start = now
+        self._pending_frame = next(self._frames, None)
+
+    def _format_frame(self, frame):
+        if not self.show_headers:
+            header_length = 4 if (frame[0] & 0x3F) == 0 else 3
+            frame = frame[header_length:-1]
+        return frame_to_string_value(frame).encode('ascii')
+
+    def _queue_output(self, data):
+        self._output += data
+
+    def _queue_frame(self, frame):
+        line = self._format_frame(frame)
+        if self._output.__len__() + line.__len__() > self.tx_buffer_size:
+            self.buffer_full_count += 1
+            self.monitor_all_mode = False
+            self._queue_output(b"BUFFER FULL\r\r>")
+            return
+        self._queue_output(line)
+        self.frames_sent += 1
+        if self.record_send_times:
+            self.send_times.append(time.perf_counter())
+
+    def _emit_due_frames(self, now):
+        while self.monitor_all_mode and self._pending_frame is not None:
+            offset, frame = self._pending_frame
+            if self._monitor_start + offset > now:
+                return self._monitor_start + offset
+            self._queue_frame(frame)
+            self._pending_frame = next(self._frames, None)
+        return None
+
+    def _drain_output(self, now):
+        if self._output.__len__() == 0:
+            self._last_drain = now
+            self._tx_credit = 0.0
+            return
+        allowed = self._output.__len__()
+        if self.baud_rate is not None:
+            # Never more than a few ms worth of credit, so a long pause doesn't turn into a burst.
+            self._tx_credit = min(self._tx_credit + (now - self._last_drain) * self.baud_rate / 10.0, self.baud_rate / 1000.0 + 1)
+            allowed = min(allowed, int(self._tx_credit))
+        self._last_drain = now
+        if allowed <= 0:
+            return
+        try:
+            written = os.write(self._master, self._output[:allowed])
+        except (BlockingIOError, OSError):
+            return
+        del self._output[:written]
+        self.bytes_sent += written
+        self._tx_credit -= written
+
+    def _run(self):
+        while self._running:
+            now = time.perf_counter()
+            next_due = self._emit_due_frames(now)
+            self._drain_output(now)
+
+            timeout = 0.05 if next_due is None else max(0.0, next_due - time.perf_counter())
+            if self._output.__len__() > 0:
+                timeout = min(timeout, 0.001)
+            readable, _, _ = select.select([self._master], [], [], timeout)
+            if readable:
+                try:
+                    data = os.read(self._master, 1024)
+                except (BlockingIOError, OSError):
+                    continue
+                self._on_input(data)
+
+    def _on_input(self, data):
+        if self.monitor_all_mode:
+            # Any byte stops monitoring, and like the real adapter that byte is used up doing it: a command sent
+            # straight into a running monitor arrives without its first character. Whatever hadn't gone out yet is
+            # dropped.
+            self.monitor_all_mode = False
+            self.interrupt_count += 1
+            self._output.clear()
+            self._queue_output(b"STOPPED\r\r>")
+            data = data[1:]
+            if data.__len__() == 0:
+                return
+
+        self._input += data
+        while b"\r" in self._input:
+            line, _, rest = bytes(self._input).partition(b"\r")
+            self._input = bytearray(rest.lstrip(b"\n"))
+            self._on_command(line.strip())
+
+    def _on_command(self, line):
+        self.commands_received += 1
+        echo = line + b"\r" if self.echo_enabled else b""
+        command = line.upper().replace(b" ", b"")
+        if command.__len__() == 0:
+            self._queue_output(b">")
+            return
+
+        if not command.startswith(b"AT"):
+            time.sleep(self.message_delay)
+            self._queue_output(echo + self._answer_message(command) + b"\r>")
+            return
+
+        time.sleep(self.command_delay)
+        at = command[2:]
+        if at == b"MA":
+            self._queue_output(echo)
+            self._start_monitoring()
+            return
+        if at.startswith(b"BRD"):
+            self._negotiate_baud_rate(echo, at[3:])
+            return
+
+        reply = b"OK"
+        if at == b"Z":
+            self.echo_enabled = True
+            self.show_headers = False
+            reply = b"\r" + ELM327_IDENTIFICATION
+        elif at == b"I":
+            reply = ELM327_IDENTIFICATION
+        elif at in (b"E0", b"E1"):
+            self.echo_enabled = at == b"E1"
+        elif at in (b"H0", b"H1"):
+            self.show_headers = at == b"H1"
+        elif at.startswith(b"SP"):
+            self.protocol = at[2:] or b"0"
+        elif at == b"DPN":
+            reply = self.protocol
+        elif at.startswith(b"BRT"):
+            self.handshake_timeout = int(at[3:] or b"0F", 16) * 0.005
+        elif at in (b"PC", b"BI") or at.startswith(b"SW") or at.startswith(b"SH"):
+            pass
+        else:
+            reply = b"?"
+        self._queue_output(echo + reply + b"\r\r>")
+
+    def _answer_message(self, command):
+        try:
+            data = bytes.fromhex(command.decode('ascii'))
+        except ValueError:
+            return b"?\r"
+        if data.__len__() == 0:
+            return b"?\r"
+
+        service_id = data[0]
+        if service_id == 0x3E:
+            reply = build_frame(TESTER_ADDRESS, ECU_ADDRESS, 0x7E)
+        elif service_id == 0x18:
+            reply = build_frame(TESTER_ADDRESS, ECU_ADDRESS, 0x58, b'\x01\x01\x00\x24')
+        else:
+            # serviceNotSupported
+            reply = build_frame(TESTER_ADDRESS, ECU_ADDRESS, 0x7F, bytes([service_id, 0x11]))
+        return self._format_frame(reply)
+
+    # The real handshake: OK at the old rate, a BRT period for the host to switch its UART, the ID string at the new
+    # rate, then another BRT period for the host's CR before going back to the old rate.
+    def _negotiate_baud_rate(self, echo, divisor):
+        # A pty doesn't care about the rate, so the handshake is played out but only the simulated UART rate changes.
+        old_baud_rate = self.baud_rate
+        self._queue_output(echo + b"OK\r")
+        self._flush_output()
+        time.sleep(self.handshake_timeout)
+        if self.baud_rate is not None:
+            self.baud_rate = 4000000.0 / max(1, int(divisor or b"68", 16))
+        self._queue_output(ELM327_IDENTIFICATION + b"\r")
+        self._flush_output()
+
+        confirmed = False
+        deadline = time.perf_counter() + self.handshake_timeout
+        while not confirmed:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select([self._master], [], [], remaining)
+            if not readable:
+                break
+            try:
+                confirmed = b"\r" in os.read(self._master, 64)
+            except BlockingIOError:
+                pass
+            except OSError:
+                break
+        if not confirmed:
+            self.baud_rate = old_baud_rate
+        self._queue_output(b"OK\r\r>" if confirmed else b"\r>")
+
+    # Sends everything queued before going on, at the simulated rate (giving up after a second if nobody reads it).
+    def _flush_output(self):
+        deadline = time.perf_counter() + 1.0
+        while self._output.__len__() > 0 and time.perf_counter() < deadline:
+            self._drain_output(time.perf_counter())
+            if self._output.__len__() > 0:
+                time.sleep(0.001)
+
+    def stats_string(self):
+        return "Frames sent: {}; bytes sent: {}; commands: {}; buffer full: {}".format(
+            self.frames_sent, self.bytes_sent, self.commands_received, self.buffer_full_count)
+
+"""
+measure_read_path:
+    Monitors the emulator through the real ELM327 driver and KWPFramer for duration seconds and returns
+    (frames read, frames per second, LatencyHistogram of the time from the emulator sending each frame to the framer
+    releasing it). The emulator has to have been created with record_send_times set.
+"""
+def measure_read_path(emulator, duration, baud_rate=38400):
+    from correlation import LatencyHistogram
+    from elmlib import ELM327, KWPFramer
+
+    elm327 = ELM327(False, emulator.device, baud_rate, 0.1)
+    framer = KWPFramer()
+    latency = LatencyHistogram(min_latency=0.00001)
+    # Not configure_monitor_mode: its flush would throw away frames and the count would no longer line up with
+    # send_times.
+    elm327.set_kwp2000()
+    elm327.set_show_headers(True)
+    first_frame = emulator.frames_sent
+    elm327.set_monitor_all()
+    received = 0
+
+    tic = time.perf_counter()
+    while time.perf_counter() - tic < duration:
+        received_response = elm327.try_read_serial(bytes_written=0)
+        now = time.perf_counter()
+        for decoded in framer.feed(received_response.raw_value):
+            index = first_frame + received
+            if index < emulator.send_times.__len__():
+                latency.add(now - emulator.send_times[index])
+            received += 1
+    elapsed = time.perf_counter() - tic
+    elm327.close()
+    return received, received / elapsed, latency
+
+"""
+check_baud_negotiation:
+    Runs ELM327.negotiate_baud_rate against the emulator and returns (the rate in use afterwards, seconds the switch
+    took), so a change on either side of the AT BRD handshake can be checked without an adapter.
+"""
+def check_baud_negotiation(emulator, baud_rate, start_baud_rate=38400):
+    from elmlib import ELM327
+
+    elm327 = ELM327(False, emulator.device, start_baud_rate, 0.1)
+    try:
+        tic = time.perf_counter()
+        negotiated = elm327.negotiate_baud_rate(baud_rate)
+        elapsed = time.perf_counter() - tic
+    finally:
+        elm327.close()
+    return negotiated, elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="A pty stand-in ELM327 that streams recorded or synthetic ECU traffic.")
+    parser.add_argument("capture", nargs="?", help="A capture to stream in monitor mode (dumps/*.json, .ndjson or .t1ncap)")
+    parser.add_argument("--load", type=float, help="Stream synthetic 0x3E/0x7E and 0x18/0x58 traffic at this many frames/s instead")
+    parser.add_argument("--speed", type=float, default=1.0, help="Capture playback speed")
+    parser.add_argument("--command-delay", type=float, default=0.005, help="Seconds before an AT command is answered")
+    parser.add_argument("--message-delay", type=float, default=0.05, help="Seconds before a sent message is answered")
+    parser.add_argument("--baud", type=float, help="Simulate a UART at this rate (default: unlimited)")
+    parser.add_argument("--measure", type=float, help="Read the emulator through the ELM327 driver for this many seconds and report throughput and latency")
+    parser.add_argument("--check-baud", type=int, help="Check that the ELM327 driver can negotiate this rate (AT BRD) with the emulator")
+    args = parser.parse_args()
+
+    if args.capture is None and args.load is None:
+        parser.error("Give a capture to stream or --load")
+
+    emulator = ELM327Emulator(args.capture, args.load, args.speed, args.command_delay, args.message_delay,
+                              args.baud, record_send_times=args.measure is not None)
+    device = emulator.open()
+    try:
+        if args.check_baud is not None:
+            negotiated, elapsed = check_baud_negotiation(emulator, args.check_baud)
+            print("Negotiated {} baud in {:.1f} ms".format(negotiated, elapsed * 1000.0))
+            assert negotiated == args.check_baud, "AT BRD {} failed".format(args.check_baud)
+        if args.measure is not None:
+            received, frames_per_second, latency = measure_read_path(emulator, args.measure)
+            print("Read {} frames ({:.0f} frames/s); latency: {}".format(received, frames_per_second, latency.summary_string()))
+        elif args.check_baud is None:
+            print("Emulating an ELM327 on {} (set SPRINTER_SERIAL_DEVICES={} to use it); Ctrl+C to stop.".format(device, device))
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(emulator.stats_string())
+        emulator.close()
@@ -1,9 +1,13 @@
+import binascii
 import datetime
 import serial
 import io
 import time
 
-from sprinter_types import ConvertByteToKnownServiceIDs, ConvertByteToTargetAddressByte, KnownServiceIDs, SourceAddressByte
+from collections import namedtuple
+
+from sprinter_log import log_debug
+from sprinter_types import ConvertByteToKnownServiceIDs, ConvertByteToSourceAddressByte, ConvertByteToTargetAddressByte, KnownServiceIDs, SourceAddressByte
 
 """
 convert_str_to_byte_array:
@@ -91,6 +95,9 @@ Parameters:
 def test_checksum(converted, header_msg_length):
     if header_msg_length != 0:
         return converted[3 + header_msg_length]
+    # A length of 0 in the format byte means the real length is in an extra fourth header byte.
+    if converted.__len__() > 4 and converted[3] != 0 and converted.__len__() > 4 + converted[3]:
+        return converted[4 + converted[3]]
     return None
 
 """
@@ -103,27 +110,122 @@ Parameters:
                        the checksum byte should be.
 """
 def test_service_id(converted, header_msg_length):
-    print("header_msg_length: {}; bytes: {}".format(header_msg_length, converted))
+    log_debug("header_msg_length:", header_msg_length, "; bytes:", converted)
     if header_msg_length != 0:
         return converted[2 + 1]
+    if converted.__len__() > 4:
+        return converted[4]
     return None
 
-class KWPacket:
-    raw_packet = []
-    converted_packet = []
+"""
+decode_hex_frame:
+    Converts the adapter's ASCII hex output (b"82 82\r") straight into the frame bytes (b"\x82\x82") without building
+    any intermediate strings. Spaces and line endings are ignored. Returns None if the input is not a hex frame
+    (prompts, "NO DATA", "BUFFER FULL", etc.)
+
+Parameters:
+    raw: The raw bytes (or bytearray/memoryview) read from the ELM327.
+"""
+def decode_hex_frame(raw):
+    if not isinstance(raw, (bytes, bytearray)):
+        raw = bytes(raw)
+    try:
+        return binascii.unhexlify(raw.translate(None, b' \r\n'))
+    except (binascii.Error, ValueError):
+        return None
+
+KWPFrame = namedtuple('KWPFrame', ['frame', 'A0', 'A1', 'HeaderMsgLength', 'MsgTarget_Raw', 'MsgSource_Raw', 'ServiceID_Raw', 'payload', 'Checksum'])
+
+# The KWP2000 checksum: the low byte of the sum of every byte before the checksum.
+def kwp_checksum(frame_bytes):
+    return sum(frame_bytes) & 0xFF
 
-    A0 = False
-    A1 = False
-    HeaderMsgLength = 0
-    MsgTarget = SourceAddressByte.UNKNOWN
-    MsgTarget_Raw = 0x00
+"""
+decode_kwp_frame:
+    Decodes a KWP2000 frame from the adapter's raw output in one pass and returns a KWPFrame, or None if the input
+    is not a complete frame. The payload is a memoryview over the decoded frame (the bytes after the service ID, up to
+    but not including the checksum), so listeners can read it without another copy.
+    A header length of 0 means the length is carried in an extra fourth header byte.
+
+Parameters:
+    raw: The raw bytes (or bytearray/memoryview) read from the ELM327, or already-decoded frame bytes if
+         already_decoded is set.
+    already_decoded (default=False): Skip the hex decode step.
+"""
+def decode_kwp_frame(raw, already_decoded=False):
+    frame = raw if already_decoded else decode_hex_frame(raw)
+    if frame is None or frame.__len__() < 5:
+        return None
+
+    format_byte = frame[0]
+    msg_length = format_byte & 0b00111111
+    header_length = 3
+    if msg_length == 0:
+        msg_length = frame[3]
+        header_length = 4
 
-    MsgSource = SourceAddressByte.UNKNOWN
-    MsgSource_Raw = 0x00
+    checksum_index = header_length + msg_length
+    if msg_length == 0 or frame.__len__() <= checksum_index:
+        return None
 
-    ServiceID = KnownServiceIDs.UNKNOWN
-    ServiceID_Raw = 0x00
-    Checksum = 0
+    return KWPFrame(
+        frame,
+        (format_byte >> 6) & 0b1,
+        format_byte >> 7,
+        msg_length,
+        frame[1],
+        frame[2],
+        frame[header_length],
+        memoryview(frame)[header_length + 1:checksum_index],
+        frame[checksum_index])
+
+"""
+KWPacket:
+    An immutable, compact record of one decoded KWP2000 frame. Only the frame bytes and the raw header values are
+    stored (as a tuple, no per-instance __dict__); the enum lookups, the adapter-style text and the display strings
+    are all derived when they are asked for.
+    Blank or malformed packets decode to a record with a HeaderMsgLength of 0.
+
+Parameters:
+    raw_packet: The raw bytes from the ELM327 (or the decoded string form, b"81 12 F3 3E C4 \r".decode())
+"""
+class KWPacket(namedtuple('KWPacket', ['converted_packet', 'A0', 'A1', 'HeaderMsgLength', 'MsgTarget_Raw', 'MsgSource_Raw', 'ServiceID_Raw', 'Checksum'])):
+    __slots__ = ()
+
+    def __new__(cls, raw_packet):
+        if raw_packet is None or raw_packet.__len__() == 0:
+            print("Skipping blank packet.")
+            return _BLANK_KWPACKET
+
+        # Accept the decoded string form as well as the raw bytes from the adapter.
+        if isinstance(raw_packet, str):
+            raw_packet = raw_packet.encode('ascii', errors='ignore')
+
+        decoded = decode_kwp_frame(raw_packet)
+        if decoded is None:
+            print("Skipping malformed packet: ", raw_packet)
+            return _BLANK_KWPACKET
+
+        return super().__new__(cls, decoded.frame, decoded.A0, decoded.A1, decoded.HeaderMsgLength,
+                               decoded.MsgTarget_Raw, decoded.MsgSource_Raw, decoded.ServiceID_Raw, decoded.Checksum)
+
+    @property
+    def raw_packet(self):
+        if self.converted_packet.__len__() == 0:
+            return ''
+        return self.converted_packet.hex(' ').upper() + ' \r'
+
+    @property
+    def MsgTarget(self):
+        return ConvertByteToTargetAddressByte(self.MsgTarget_Raw)
+
+    @property
+    def MsgSource(self):
+        return ConvertByteToSourceAddressByte(self.MsgSource_Raw)
+
+    @property
+    def ServiceID(self):
+        return ConvertByteToKnownServiceIDs(self.ServiceID_Raw)
 
     def service_id_string(self):
         return "{} (0x{})".format(self.ServiceID.name, hex(self.ServiceID_Raw).upper()[2:])
@@ -134,82 +236,262 @@ class KWPacket:
     def msg_source_string(self):
         return "{} (0x{})".format(self.MsgSource.name, hex(self.MsgSource_Raw).upper()[2:])
 
-    def __init__(self, raw_packet):
-        if raw_packet is None or raw_packet.__len__() == 0:
-            print("Skipping blank packet.")
-            # self = None
-            return
-
-        self.raw_packet = raw_packet
-        self.converted_packet = convert_str_to_byte_array(self.raw_packet)
-        self.A0, self.A1 = test_format_byte(self.converted_packet[0])
-        self.HeaderMsgLength = test_data_length(self.converted_packet[0])
-        self.MsgTarget, self.MsgTarget_Raw = test_target(self.converted_packet)
-        self.MsgSource, self.MsgSource_Raw = test_source(self.converted_packet)
-        self.ServiceID_Raw = test_service_id(self.converted_packet, self.HeaderMsgLength)
-
-        self.ServiceID = ConvertByteToKnownServiceIDs(self.ServiceID_Raw)
-        self.Checksum = test_checksum(self.converted_packet, self.HeaderMsgLength)
-        # print("   Service ID: ", self.ServiceID)
-
-
-# Convenience class for quickly stripping echo'ed characters and getting a sane output
-class ELMRESPONSE:
-    raw_value = b''
-    bytes_written = 0
-    date = 0
-    parsed_packet = None
-
-    def __init__(self, raw_response, bytes_written=0, _date=0, _parse_kwp=False):
-        self.raw_value = raw_response
-        self.bytes_written = bytes_written
+_BLANK_KWPACKET = tuple.__new__(KWPacket, (b'', False, False, 0, 0x00, 0x00, 0x00, 0))
+
+"""
+ELMRESPONSE:
+    Convenience class for quickly stripping echo'ed characters and getting a sane output.
+    Like KWPacket this is an immutable tuple record; the receive time is kept as a float timestamp and only turned
+    into a datetime when date is read.
+
+Parameters:
+    raw_response: The raw bytes read from the ELM327.
+    bytes_written (default=0): The length of the command just written, so its echo can be stripped by tostring().
+    _date (default=0): A datetime or float timestamp for the response. 0 means now.
+    _parse_kwp (default=False): Also decode the response into a KWPacket (parsed_packet).
+"""
+class ELMRESPONSE(namedtuple('ELMRESPONSE', ['raw_value', 'bytes_written', 'timestamp', 'parsed_packet'])):
+    __slots__ = ()
+
+    def __new__(cls, raw_response, bytes_written=0, _date=0, _parse_kwp=False):
         if _date == 0:
-            self.date = datetime.datetime.now()
-        else: # TODO: Check for actual Py date object.
-            self.date = _date
-        
+            timestamp = time.time()
+        elif isinstance(_date, datetime.datetime):
+            timestamp = _date.timestamp()
+        else:
+            timestamp = float(_date)
+
+        parsed_packet = None
         if _parse_kwp:
-            # try:
-            self.parsed_packet = KWPacket(self.raw_value.decode())
-            # except:
-                # self.parsed_packet = None
-                # print("Exception while trying to parse KWPacket in ELMRESPONSE: ", self.raw_value.decode())
+            parsed_packet = KWPacket(raw_response)
+
+        return super().__new__(cls, raw_response, bytes_written, timestamp, parsed_packet)
+
+    @property
+    def date(self):
+        return datetime.datetime.fromtimestamp(self.timestamp)
 
     def tostring(self):
-        rstr = ''
+        # Latin-1 maps every byte straight to the character of the same value, same as chr(c) did byte by byte.
         if self.bytes_written > 0:
-            subbed = self.raw_value[self.bytes_written - 1:]
-            for c in subbed:
-                rstr += chr(c)
-        else:
-            for c in self.raw_value:
-                rstr += chr(c)
-        
-        return str(rstr)
+            return self.raw_value[self.bytes_written - 1:].decode('latin-1')
+        return self.raw_value.decode('latin-1')
 
     def data_only_tostring(self):
-        rstr = ''
-
         if(self.raw_value.__len__() > (6 * 2)):
-            for c in self.raw_value[(4 * 3):self.raw_value.__len__() - 5]:
-                rstr += chr(c)
-        else:
-            print("ERROR:", self.raw_value)
-        
-        return str(rstr)
+            return self.raw_value[(4 * 3):self.raw_value.__len__() - 5].decode('latin-1')
+
+        print("ERROR:", self.raw_value)
+        return ''
 
     def printme(self):
         print("Response:\n\t", self.raw_value, "\n\t", self.tostring())
 
+"""
+SerialLineBuffer:
+    A reusable receive buffer for the ELM327 read path. Bytes are appended in bulk as they arrive from the serial port
+    and complete terminator-delimited lines are split off the front. The scan position is remembered between calls, so
+    a partial line is never searched twice while we wait for the rest of it.
+"""
+class SerialLineBuffer:
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scan_pos = 0
+        self._scan_terminator = b'\r'
+
+    def __len__(self):
+        return self._buffer.__len__()
+
+    def feed(self, data):
+        self._buffer += data
+
+    """
+    pop_until:
+        Removes and returns everything up to and including the first terminator, or None if no complete line has
+        arrived yet.
+
+    Parameters:
+        terminator (default=b'\r'): The byte string that ends a line.
+    """
+    def pop_until(self, terminator=b'\r'):
+        if terminator != self._scan_terminator:
+            self._scan_terminator = terminator
+            self._scan_pos = 0
+
+        idx = self._buffer.find(terminator, self._scan_pos)
+        if idx < 0:
+            # Nothing before the tail can start a terminator, so the next search can skip it.
+            self._scan_pos = max(0, self._buffer.__len__() - terminator.__len__() + 1)
+            return None
+
+        end = idx + terminator.__len__()
+        line = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        self._scan_pos = 0
+        return line
+
+    def pop_line(self):
+        return self.pop_until(b'\r')
+
+    def pop_all(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        self._scan_pos = 0
+        return data
+
+"""
+KWPFramer:
+    Splits a stream into KWP2000 frames incrementally, instead of assuming every line holds exactly one well-formed
+    frame. Bytes are consumed as they arrive; a frame is released once its checksum byte is in and the sum-mod-256
+    checksum matches. Both header forms are handled (length in the format byte, or a length of 0 and the length in an
+    extra fourth header byte).
+
+    When a frame fails its checksum the framer drops one byte and hunts forward from there for the next plausible
+    format byte (one with the address bit set). It keeps a read position into what it has buffered, so nothing that
+    has already been looked at is scanned again. The first good frame after a loss of sync counts as resynced.
+
+    feed() takes the adapter's text output ("83 12 F3 30 40 01 F9 \r"), where a line end is also a hard frame
+    boundary: whatever was left of an unfinished frame is counted as truncated and dropped. feed_bytes() takes bytes
+    that are already decoded (no line boundaries).
+
+    Counters: good_count, bad_checksum_count, truncated_count, resync_count, skipped_bytes and noise_lines (lines
+    that weren't hex at all, ex: "BUFFER FULL").
+"""
+class KWPFramer:
+    max_pending = 4096
+
+    def __init__(self):
+        self._lines = SerialLineBuffer()
+        self._pending = bytearray()
+        self._pos = 0
+        self._hunting = False
+
+        self.good_count = 0
+        self.bad_checksum_count = 0
+        self.truncated_count = 0
+        self.resync_count = 0
+        self.skipped_bytes = 0
+        self.noise_lines = 0
+
+    """
+    feed:
+        Consumes ELM327 text output and returns the KWPFrames completed by it (possibly none).
+    """
+    def feed(self, data):
+        self._lines.feed(data)
+        frames = []
+        line = self._lines.pop_line()
+        while line is not None:
+            # The adapter's prompt can end up at the front of the next line.
+            frame_bytes = decode_hex_frame(line.lstrip(b'>'))
+            if frame_bytes is None:
+                if line.strip(b' \r\n>'):
+                    self.noise_lines += 1
+            else:
+                frames.extend(self.feed_bytes(frame_bytes))
+            self.end_of_line()
+            line = self._lines.pop_line()
+        return frames
+
+    """
+    feed_bytes:
+        Consumes already-decoded bytes and returns the KWPFrames completed by them (possibly none).
+    """
+    def feed_bytes(self, data):
+        self._pending += data
+        frames = []
+        pending = self._pending
+        pos = self._pos
+        available = pending.__len__()
+
+        while pos < available:
+            format_byte = pending[pos]
+            if self._hunting and not (format_byte & 0x80):
+                pos += 1
+                self.skipped_bytes += 1
+                continue
+
+            msg_length = format_byte & 0b00111111
+            header_length = 3
+            if msg_length == 0:
+                if available - pos < 4:
+                    break
+                msg_length = pending[pos + 3]
+                header_length = 4
+                if msg_length == 0:
+                    pos = self._lose_sync(pos)
+                    continue
+
+            checksum_index = header_length + msg_length
+            if available - pos <= checksum_index:
+                break
+
+            if kwp_checksum(pending[pos:pos + checksum_index]) != pending[pos + checksum_index]:
+                self.bad_checksum_count += 1
+                pos = self._lose_sync(pos)
+                continue
+
+            frames.append(decode_kwp_frame(bytes(pending[pos:pos + checksum_index + 1]), already_decoded=True))
+            pos += checksum_index + 1
+            self.good_count += 1
+            if self._hunting:
+                self._hunting = False
+                self.resync_count += 1
+
+        # Drop what has been consumed once it's worth the copy, rather than on every call.
+        if pos >= 1024 or pos == available:
+            del pending[:pos]
+            pos = 0
+        if pending.__len__() - pos > self.max_pending:
+            self.skipped_bytes += pending.__len__() - pos
+            pending.clear()
+            pos = 0
+            self._hunting = True
+        self._pos = pos
+        return frames
+
+    def _lose_sync(self, pos):
+        self._hunting = True
+        self.skipped_bytes += 1
+        return pos + 1
+
+    """
+    end_of_line:
+        Marks a hard frame boundary (the adapter ended a line). An unfinished frame is counted as truncated and dropped.
+    """
+    def end_of_line(self):
+        remaining = self._pending.__len__() - self._pos
+        if remaining > 0:
+            # Leftovers of a frame that already failed its checksum aren't counted a second time.
+            if not self._hunting:
+                self.truncated_count += 1
+            self.skipped_bytes += remaining
+        self._pending.clear()
+        self._pos = 0
+        # The next line starts a fresh frame, so there's nothing left to hunt through.
+        self._hunting = False
+
+    def reset(self):
+        self.__init__()
+
+    def stats_string(self):
+        return "Frames good: {}; bad checksum: {}; truncated: {}; resynced: {}; skipped bytes: {}; noise lines: {}".format(
+            self.good_count, self.bad_checksum_count, self.truncated_count, self.resync_count, self.skipped_bytes, self.noise_lines)
+
 class ELM327:
     serial = ''
     specified_device = ''
     debug_mode = False
     string_io = ''
     specified_timeout = 5
+    command_timeout = 2
+    read_poll_interval = 0.05
     echo_enabled = True
     bypass_initialization = False
     monitor_all_mode = False
+    startup_time = 0
+    baud_rate = 38400
+    buffer_full_count = 0
 
     def dprint(self, *args):
         if self.debug_mode: print(args)
@@ -218,40 +500,100 @@ class ELM327:
         self.specified_device = device
         self.specified_timeout = timeout
         self.debug_mode = debug
+        self.baud_rate = baud
+        self.command_latencies = []
 
-        self.serial = serial.Serial(device, baud, timeout=timeout)
+        # The serial timeout only bounds a single blocking read. Callers enforce their own deadlines on top of it,
+        # so keeping it short lets a command return as soon as its deadline passes.
+        self.serial = serial.Serial(device, baud, timeout=min(timeout, self.read_poll_interval))
+        self._rx = SerialLineBuffer()
         self.string_io = io.TextIOWrapper(io.BufferedRWPair(self.serial, self.serial))
         #time.sleep(1)
         if self.debug_mode:
             print("ELM327 Initialized: ", self.serial.is_open, "; Timeout: ", timeout)
         #time.sleep(1)
 
-    def _wait_response(self, bytes_written):
+    """
+    _execute_command:
+        Writes an AT command and reads the response until the ELM327 '>' prompt arrives or the deadline passes.
+        The time each command took is appended to command_latencies as (command, seconds, got_prompt).
+
+    Parameters:
+        command: The full command string, including the trailing line ending.
+        timeout (default=command_timeout): Seconds to wait for the prompt before giving up.
+        wait_for_prompt (default=True): Commands that do not return to the prompt (AT MA) only wait for their echo.
+    """
+    def _execute_command(self, command, timeout=None, wait_for_prompt=True):
+        if timeout is None:
+            timeout = self.command_timeout
+
+        tic = time.perf_counter()
+        deadline = tic + timeout
+        bytes_written = self.string_io.write(command)
         self.string_io.flush()
-        time.sleep(1)
-        return self.try_read_serial(bytes_written=bytes_written)
+
+        if wait_for_prompt:
+            terminator = b'>'
+        elif self.echo_enabled:
+            terminator = b'\r'
+        else:
+            terminator = None
+
+        buff = b''
+        got_prompt = terminator is None
+        if terminator is not None:
+            buff = self._rx.pop_until(terminator)
+            while buff is None and time.perf_counter() < deadline:
+                self._fill_rx_buffer()
+                buff = self._rx.pop_until(terminator)
+
+            got_prompt = buff is not None
+            if buff is None:
+                buff = self._rx.pop_all()
+
+        elapsed = time.perf_counter() - tic
+        self.command_latencies.append((command.strip(), elapsed, got_prompt))
+        self.dprint("Command", command.strip(), "took {:.1f} ms".format(elapsed * 1000.0), "" if got_prompt else "(timed out)")
+        return ELMRESPONSE(buff, bytes_written=(bytes_written if self.echo_enabled else 0))
+
+    """
+    identify:
+        Asks the adapter for its identification string (ATI, ex: "ELM327 v1.5"). An adapter left in monitor mode by
+        an earlier session answers the first command with "STOPPED" instead, so in that case ATI is sent again.
+    """
+    def identify(self):
+        response = self._execute_command("ATI\r\n", timeout=0.5)
+        if b"ELM327" not in response.raw_value:
+            response = self._execute_command("ATI\r\n", timeout=0.5)
+        return response
 
     def set_bypass_initialization(self, _byp_init):
         self.bypass_initialization = _byp_init
-        bytes_written = self.string_io.write("AT BI\r\n")
-        test_response = self._wait_response(bytes_written)
-
+        test_response = self._execute_command("AT BI\r\n")
+        return test_response
 
     def set_kwp2000(self):
         print("Setting KWP2000 mode.....")
 
-        bytes_written = self.string_io.write("AT SP 4\r\n")
-        self.string_io.flush()
-        time.sleep(1)
-        test_response = self.try_read_serial(bytes_written=bytes_written)
+        test_response = self._execute_command("AT SP 4\r\n")
         return test_response;
+
+    """
+    set_protocol:
+        Sets the OBD protocol by its AT SP number (ex: "4" for ISO 14230-4 KWP with the 5 baud init, "5" for KWP with
+        the fast init).
+    """
+    def set_protocol(self, protocol):
+        if protocol == "4":
+            return self.set_kwp2000()
+        return self._execute_command("AT SP " + protocol + "\r\n")
         # print("Response:\n\t", test_response, "\n\t", test_response.tostring(), "\n\t", test_response.raw_value)
 
     def _clamp(self, a, min, max):
         return (min if a < min else (max if a > max else a))
 
     def _number_to_padded_hex(self, number, places):
-        return "{0:#0{1}}".format(number, places)
+        return "{0:0{1}X}".format(number, places)
     
     def _number_array_to_hex_msg(self, num_array):
         msg = ""
@@ -264,43 +606,63 @@ class ELM327:
         command = 'AT SW ' + wakeup_interval + '\r\n'
         print("Wakeup Interval: ", command)
         
-        bytes_written = self.string_io.write(command)
-        self.string_io.flush()
-        time.sleep(1)
-        test_response = self.try_read_serial(bytes_written=bytes_written)
+        test_response = self._execute_command(command)
         print("Response:\n\t", test_response.raw_value, "\n\t", test_response.tostring())
     
     def set_show_headers(self, show_headers):
         # TODO: Something with the argument
         command = 'AT H1\r\n'
-        bytes_written = self.string_io.write(command)
-        self.string_io.flush()
-        time.sleep(1)
-        test_response = self.try_read_serial(bytes_written=bytes_written)
+        test_response = self._execute_command(command)
         return test_response
 
     def send_reset(self):
         command = 'AT PC\r\n'
-        bytes_written = self.string_io.write(command)
-        test_response = self._wait_response(bytes_written)
+        test_response = self._execute_command(command)
         # test_response.printme()
         return test_response
 
     def set_monitor_all(self):
         self.monitor_all_mode = True
         command = 'AT MA\r\n'
-        bytes_written = self.string_io.write(command)
-        test_response = self._wait_response(bytes_written)
+        # AT MA never returns to the prompt; the adapter starts printing bus traffic straight away.
+        test_response = self._execute_command(command, wait_for_prompt=False)
         # test_response.printme()
         return test_response
 
-    def try_read_until_timeout(self, timeout=5):
-        tic = time.time()
-        buff = b''
+    """
+    configure_monitor_mode:
+        Runs the startup sequence used by the monitor (KWP2000, headers on, monitor all) and flushes whatever the
+        adapter printed along the way. The total time is stored in startup_time.
+    """
+    def configure_monitor_mode(self, protocol="4"):
+        tic = time.perf_counter()
+        first_command = self.command_latencies.__len__()
+        self.set_protocol(protocol)
+        self.set_show_headers(True)
+        self.set_monitor_all()
+        self.try_read_until_timeout(timeout=1) # Flush
+        self.startup_time = time.perf_counter() - tic
+
+        print("ELM327 startup took {:.1f} ms".format(self.startup_time * 1000.0))
+        for command, elapsed, got_prompt in self.command_latencies[first_command:]:
+            print("\t{}: {:.1f} ms{}".format(command, elapsed * 1000.0, "" if got_prompt else " (timed out)"))
+        return self.startup_time
 
+    """
+    _fill_rx_buffer:
+        Pulls everything the adapter has already sent in one read. If nothing is waiting, a single byte read is issued
+        instead so the call still blocks for up to the serial timeout rather than spinning.
+    """
+    def _fill_rx_buffer(self):
+        data = self.serial.read(self.serial.in_waiting or 1)
+        if data:
+            self._rx.feed(data)
+        return data.__len__()
+
+    def try_read_until_timeout(self, timeout=5):
         while self.serial.in_waiting:
-            buff += self.serial.read(1)
-        return ELMRESPONSE(buff, bytes_written=0)
+            self._fill_rx_buffer()
+        return ELMRESPONSE(self._rx.pop_all(), bytes_written=0)
 
     """
     try_read_serial:
@@ -310,32 +672,161 @@ class ELM327:
         bytes_written (default=0): If you have recently written a command to the ELM327, you can pass the bytes written to ensure they are stripped out of your response message.
     """
     def try_read_serial(self, bytes_written=0, _parse_kwp=0):
-        tic = time.time()
-        buff = b''
-        
-        while((time.time() - tic) < self.specified_timeout) and (not b'\r' in buff):
-            buff += self.serial.read(1)
+        deadline = time.time() + self.specified_timeout
+        buff = self._rx.pop_line()
+
+        while buff is None and time.time() < deadline:
+            self._fill_rx_buffer()
+            buff = self._rx.pop_line()
+
+        # A partial line stays buffered so the next call can complete it.
+        if buff is None:
+            buff = b''
+        elif self.monitor_all_mode and b"BUFFER FULL" in buff:
+            # The adapter's transmit buffer overflowed (the bus is sending faster than the UART can carry the text):
+            # it stops monitoring and goes back to the prompt, so monitoring has to be started again.
+            self.buffer_full_count += 1
+            self.dprint("BUFFER FULL; restarting monitor mode")
+            self._execute_command("", timeout=0.5)
+            self.set_monitor_all()
         return ELMRESPONSE(buff, bytes_written=(bytes_written if self.echo_enabled else 0), _parse_kwp=_parse_kwp)
         
     def set_echo_enabled(self, e_enabled):
-        self.string_io.write("E1\r\n" if e_enabled else "E0\r\n")
+        test_response = self._execute_command("AT E1\r\n" if e_enabled else "AT E0\r\n")
         self.echo_enabled = e_enabled
-        test_response = self.try_read_serial()
         print("Response:\n\t", test_response.raw_value, "\n\t", test_response.tostring())
 
-    def set_data_header(self, data_header):
-        # TODO: Specify header length somehow? Maybe by current standard?
+    """
+    set_data_header:
+        Sets the header the adapter puts in front of every message sent with write_bytes (AT SH). For KWP2000 that is
+        the format byte, target and source, ex: [0x81, 0x12, 0xF3] to talk to the ECM as the DAD. Monitoring, if it was
+        running, is started again afterwards unless resume_monitor is False.
+    """
+    def set_data_header(self, data_header, resume_monitor=True):
         proper_length = data_header[0:3]
-        print("Data Header: ", proper_length)
-
-    def write_bytes(self, data_byte_array):
-        asmsg = self._number_array_to_hex_msg(data_byte_array)
-        print("Input: ", data_byte_array)
-        print("Transformed: ", asmsg)
-        # TODO: Actually re-enable byte writing
-        #self.string_io.write(data_header)
-        #test_response = self.try_read_serial()
-        #print("Response:\n\t", test_response.raw_value, "\n\t", test_response.tostring())
+        command = 'AT SH ' + self._number_array_to_hex_msg(proper_length).strip() + '\r\n'
+        self.dprint("Data Header: ", command.strip())
+        return self._execute_between_monitoring(command, resume_monitor)
+
+    # Runs one command with monitoring stopped, then puts the adapter back in AT MA if it was monitoring before (like
+    # AsyncELM327.execute_command), so a reader waiting on bus traffic doesn't silently stop getting any.
+    def _execute_between_monitoring(self, command, resume_monitor):
+        interrupted_monitor = self.monitor_all_mode
+        self.stop_monitoring()
+        response = self._execute_command(command)
+        if interrupted_monitor and resume_monitor:
+            self.set_monitor_all()
+        return response
+
+    """
+    stop_monitoring:
+        Takes the adapter out of AT MA and waits for the prompt; does nothing if it isn't monitoring. Any byte sent
+        while the adapter is in AT MA stops the monitor (it prints "STOPPED" and the prompt), so sending has to do this
+        first so the reply to the message isn't mixed in with bus traffic.
+    """
+    def stop_monitoring(self):
+        if self.monitor_all_mode:
+            self._execute_command("\r")
+            self.monitor_all_mode = False
+
+    """
+    write_bytes:
+        Sends the data bytes of one message (ex: [0x3E] for tester present) behind the header from set_data_header and
+        waits for the prompt. Returns the ELMRESPONSE holding the reply lines. If the adapter was monitoring, monitoring
+        is stopped for the message and started again once the reply is in, unless resume_monitor is False.
+
+        Nothing here locks the port: if another thread reads the same ELM327 (ex: MonitorData's read thread), the caller
+        has to hold the lock that thread reads under (see RequestScheduler's lock).
+    """
+    def write_bytes(self, data_byte_array, resume_monitor=True):
+        asmsg = self._number_array_to_hex_msg(data_byte_array).strip()
+        self.dprint("Input: ", data_byte_array, "; Transformed: ", asmsg)
+        return self._execute_between_monitoring(asmsg + '\r\n', resume_monitor)
+
+    """
+    _read_line_containing:
+        Reads lines until one contains any of the tokens or the deadline passes. Returns that line, or None.
+    """
+    def _read_line_containing(self, tokens, deadline):
+        while time.perf_counter() < deadline:
+            line = self._rx.pop_line()
+            if line is None:
+                self._fill_rx_buffer()
+                continue
+            if any(token in line for token in tokens):
+                return line
+        return None
+
+    """
+    negotiate_baud_rate:
+        Switches the UART to a faster rate with the AT BRD handshake, so the text the adapter prints in monitor mode
+        doesn't overflow its buffer on a busy bus. The adapter answers OK at the old rate and switches, then sends its
+        ID string at the new rate; if a return comes back within the AT BRT window it stays at the new rate, otherwise
+        it goes back to the old one by itself. On any failure this side goes back to the old rate too and checks that
+        the adapter answers there again, so the link is never left dead.
+
+        The adapter only has rates of 4 MHz / divisor; a rate it can't get within max_error of is refused up front.
+        Returns the rate in use afterwards (the old one if the switch didn't take). Clones that don't know AT BRD
+        answer "?", which is treated the same as a failed handshake.
+
+    Parameters:
+        baud_rate: The rate to switch to (ex: 115200, 230400, 500000).
+        handshake_timeout (default=0.075): Seconds the adapter waits for the return at the new rate (AT BRT).
+        max_error (default=0.03): Largest allowed difference between baud_rate and the closest rate the adapter has.
+    """
+    def negotiate_baud_rate(self, baud_rate, handshake_timeout=0.075, max_error=0.03):
+        old_baud_rate = self.baud_rate
+        if baud_rate == old_baud_rate:
+            return old_baud_rate
+
+        divisor = self._clamp(int(round(4000000.0 / baud_rate)), 8, 255)
+        if abs(4000000.0 / divisor - baud_rate) / baud_rate > max_error:
+            print("Can't negotiate {} baud: the closest the adapter has is {:.0f}".format(baud_rate, 4000000.0 / divisor))
+            return old_baud_rate
+
+        self.stop_monitoring()
+        brt = self._clamp(int(round(handshake_timeout * 1000.0 / 5.0)), 1, 255)
+        self._execute_command("AT BRT " + self._number_to_padded_hex(brt, 2) + "\r\n")
+
+        tic = time.perf_counter()
+        self._rx.pop_all()
+        self.string_io.write("AT BRD " + self._number_to_padded_hex(divisor, 2) + "\r")
+        self.string_io.flush()
+        switched = False
+        reply = self._read_line_containing([b"OK", b"?"], tic + self.command_timeout)
+        if reply is not None and b"OK" in reply:
+            # The adapter is switching right now; the ID string is the first thing it sends at the new rate.
+            self.serial.baudrate = baud_rate
+            self._rx.pop_all()
+            self.serial.reset_input_buffer()
+            if self._read_line_containing([b"ELM327"], time.perf_counter() + 0.5) is not None:
+                self.serial.write(b"\r")
+                self.serial.flush()
+                reply = self._rx.pop_until(b'>')
+                deadline = time.perf_counter() + self.command_timeout
+                while reply is None and time.perf_counter() < deadline:
+                    self._fill_rx_buffer()
+                    reply = self._rx.pop_until(b'>')
+                switched = reply is not None and b"OK" in reply
+        elif reply is not None:
+            # "?": AT BRD isn't supported; the prompt follows at the old rate.
+            self._execute_command("", timeout=0.2)
+
+        if switched:
+            self.baud_rate = baud_rate
+        else:
+            # Whatever state the adapter is in, it is back at the old rate once the handshake window has passed.
+            self.serial.baudrate = old_baud_rate
+            time.sleep(handshake_timeout * 2)
+            self.serial.reset_input_buffer()
+            self._rx.pop_all()
+            if b"ELM327" not in self.identify().raw_value:
+                print("WARNING: The adapter didn't answer at {} baud after a failed switch to {}".format(old_baud_rate, baud_rate))
+
+        elapsed = time.perf_counter() - tic
+        self.command_latencies.append(("AT BRD {:02X} ({} baud)".format(divisor, baud_rate), elapsed, switched))
+        self.dprint("Baud rate", baud_rate, "negotiated" if switched else "refused", "in {:.1f} ms".format(elapsed * 1000.0))
+        return self.baud_rate
 
     def get_bytes_in_debug(self):
         return self.try_read_serial(0)
@@ -0,0 +1,221 @@
+import argparse
+import heapq
+import threading
+import time
+
+from collections import deque
+
+from elmlib import ELM327, KWPFramer
+from packet_buffer import FrameQueue
+
+"""
+DeviceReader:
+    Reads one adapter on its own thread: frames go through the reader's own KWPFramer and into its own FrameQueue, so
+    no two adapters ever share a lock or a buffer. Anything with the ELM327 read interface works as the adapter (ex: a
+    replay.ReplaySource).
+
+    Counters: frame_count, byte_count, the queue's dropped_count, the framer's counters, and frames_per_second().
+
+Parameters:
+    tag: The name frames from this adapter are tagged with in the merged stream (ex: the device path).
+    adapter: An opened ELM327 (or stand-in), already configured for monitoring.
+    queue_capacity (default=65536): Frames this reader can have waiting for the merge before it starts dropping.
+"""
+class DeviceReader:
+    def __init__(self, tag, adapter, queue_capacity=65536):
+        self.tag = tag
+        self.adapter = adapter
+        self.framer = KWPFramer()
+        self.queue = FrameQueue(queue_capacity)
+        self.frame_count = 0
+        self.byte_count = 0
+        self.started_at = 0.0
+        self.error = None
+
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self.started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._read_loop, name="DeviceReader-" + str(self.tag), daemon=True)
+        self._thread.start()
+
+    def _read_loop(self):
+        try:
+            while self._running:
+                received_response = self.adapter.try_read_serial(bytes_written=0)
+                self.byte_count += received_response.raw_value.__len__()
+                for decoded in self.framer.feed(received_response.raw_value):
+                    if self.queue.push((received_response.timestamp, decoded)):
+                        self.frame_count += 1
+                if getattr(self.adapter, "finished", False):
+                    break
+        except Exception as e:
+            self.error = e
+        self._running = False
+
+    def is_running(self):
+        return self._running
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.adapter.is_open():
+            self.adapter.close()
+
+    def frames_per_second(self):
+        elapsed = time.perf_counter() - self.started_at
+        return self.frame_count / elapsed if elapsed > 0 else 0.0
+
+    def stats_string(self):
+        return "{}: {} frames ({:.0f}/s), {} bytes, dropped: {}; {}{}".format(
+            self.tag, self.frame_count, self.frames_per_second(), self.byte_count, self.queue.dropped_count,
+            self.framer.stats_string(), "; error: {}".format(self.error) if self.error is not None else "")
+
+"""
+MultiMonitor:
+    Monitors several adapters at once and merges their frames into one stream ordered by timestamp, each tagged with
+    the adapter it came from.
+
+    Each DeviceReader hands frames over through its own lock-free queue; the merge runs on the consumer side only.
+    Frames are released in timestamp order up to the watermark, the oldest "latest frame" among the adapters that
+    are still sending, so a frame from a slower adapter can't end up behind a later one from a faster adapter. An
+    adapter that hasn't produced anything for idle_timeout seconds (or has stopped) stops holding the merge back.
+
+Parameters:
+    readers: The DeviceReaders to merge.
+    idle_timeout (default=0.25): Seconds of silence after which an adapter no longer holds back the merge.
+"""
+class MultiMonitor:
+    def __init__(self, readers, idle_timeout=0.25):
+        self.readers = list(readers)
+        self.idle_timeout = idle_timeout
+        self.merged_count = 0
+        self.out_of_order_count = 0
+
+        self._pending = [deque() for _ in self.readers]
+        self._latest = [None] * self.readers.__len__()
+        self._last_activity = [0.0] * self.readers.__len__()
+        self._last_released = None
+
+    def start(self):
+        now = time.perf_counter()
+        for i, reader in enumerate(self.readers):
+            self._last_activity[i] = now
+            reader.start()
+
+    def stop(self):
+        for reader in self.readers:
+            reader.stop()
+
+    def is_running(self):
+        return any(reader.is_running() for reader in self.readers)
+
+    def _watermark(self, now, flush):
+        watermark = None
+        for i, reader in enumerate(self.readers):
+            if flush or not reader.is_running() or now - self._last_activity[i] > self.idle_timeout:
+                continue
+            if self._latest[i] is None:
+                # Hasn't sent anything yet but might any moment; nothing can be released past it.
+                return float('-inf')
+            if watermark is None or self._latest[i] < watermark:
+                watermark = self._latest[i]
+        return float('inf') if watermark is None else watermark
+
+    """
+    drain:
+        Collects what every reader has queued and returns the frames that can be released in order, as a list of
+        (timestamp, tag, KWPFrame). Pass flush=True to release everything regardless of the watermark (ex: on stop).
+    """
+    def drain(self, flush=False):
+        now = time.perf_counter()
+        for i, reader in enumerate(self.readers):
+            batch = reader.queue.drain()
+            if batch.__len__() > 0:
+                self._pending[i].extend(batch)
+                self._latest[i] = batch[-1][0]
+                self._last_activity[i] = now
+
+        watermark = self._watermark(now, flush)
+        heads = [(pending[0][0], i) for i, pending in enumerate(self._pending) if pending.__len__() > 0]
+        heapq.heapify(heads)
+
+        merged = []
+        while heads.__len__() > 0 and heads[0][0] <= watermark:
+            timestamp, i = heapq.heappop(heads)
+            _, decoded = self._pending[i].popleft()
+            if self._last_released is not None and timestamp < self._last_released:
+                self.out_of_order_count += 1
+            self._last_released = timestamp
+            merged.append((timestamp, self.readers[i].tag, decoded))
+            if self._pending[i].__len__() > 0:
+                heapq.heappush(heads, (self._pending[i][0][0], i))
+
+        self.merged_count += merged.__len__()
+        return merged
+
+    def stats_lines(self):
+        lines = ["Merged: {}; out of order: {}; held back: {}".format(
+            self.merged_count, self.out_of_order_count, sum(pending.__len__() for pending in self._pending))]
+        for reader in self.readers:
+            lines.append(reader.stats_string())
+        return lines
+
+"""
+open_elm327_readers:
+    Opens and configures an ELM327 in monitor mode on every device and wraps each in a DeviceReader.
+"""
+def open_elm327_readers(devices, baud_rate=38400, timeout=5):
+    readers = []
+    for device in devices:
+        elm327 = ELM327(False, device, baud_rate, timeout)
+        elm327.configure_monitor_mode()
+        readers.append(DeviceReader(device, elm327))
+    return readers
+
+if __name__ == "__main__":
+    from sprinter_obdii_monitor import get_serial_devices
+
+    parser = argparse.ArgumentParser(description="Monitor several ELM327 adapters at once as one merged stream.")
+    parser.add_argument("devices", nargs="*", help="Serial devices (default: every matching USB serial device)")
+    parser.add_argument("--baud", type=int, default=38400)
+    parser.add_argument("--replay", action="append", default=[], help="Add a capture replayed in real time as a device (for testing)")
+    parser.add_argument("--quiet", action="store_true", help="Only print the counters, not every frame")
+    parser.add_argument("--stats-interval", type=float, default=5.0, help="Seconds between counter reports")
+    args = parser.parse_args()
+
+    devices = args.devices if args.devices.__len__() > 0 or args.replay.__len__() > 0 else get_serial_devices()
+    readers = open_elm327_readers(devices, args.baud)
+    if args.replay.__len__() > 0:
+        from replay import ReplaySource
+        readers.extend(DeviceReader(path, ReplaySource(path)) for path in args.replay)
+    if readers.__len__() == 0:
+        print("No devices to monitor.")
+        exit(1)
+
+    monitor = MultiMonitor(readers)
+    monitor.start()
+    next_stats = time.perf_counter() + args.stats_interval
+    try:
+        while monitor.is_running():
+            for timestamp, tag, decoded in monitor.drain():
+                if not args.quiet:
+                    print("{:.3f} [{}] {}".format(timestamp, tag, decoded.frame.hex(' ').upper()))
+            if time.perf_counter() >= next_stats:
+                for line in monitor.stats_lines():
+                    print(line)
+                next_stats += args.stats_interval
+            time.sleep(0.01)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.stop()
+        for timestamp, tag, decoded in monitor.drain(flush=True):
+            if not args.quiet:
+                print("{:.3f} [{}] {}".format(timestamp, tag, decoded.frame.hex(' ').upper()))
+        for line in monitor.stats_lines():
+            print(line)
@@ -0,0 +1,245 @@
+import time
+
+from array import array
+from collections import deque
+
+from elmlib import ELMRESPONSE, decode_hex_frame
+
+"""
+PacketRingBuffer:
+    A bounded, columnar store for captured KWP frames. Timestamps, frame offsets and frame lengths live in flat arrays
+    and the frame bytes themselves are packed back to back in one circular bytearray, so a long session costs a fixed
+    amount of memory instead of one Python object per packet.
+    When either the slot count or the byte arena is full the oldest frames are evicted. Pass on_evict to spill them
+    somewhere (ex: a file) before they are dropped.
+
+    Every frame gets a sequence number when it is appended. Sequence numbers never change, so they can be held on to
+    (selection, scroll position) while older frames are evicted underneath. first_seq/next_seq give the valid range.
+
+Parameters:
+    capacity: Maximum number of frames kept.
+    arena_size (default=capacity * 16): Size in bytes of the frame storage.
+    on_evict (default=None): Called as on_evict(timestamp, frame_bytes) for each frame before it is evicted.
+"""
+class PacketRingBuffer:
+    def __init__(self, capacity, arena_size=None, on_evict=None):
+        if capacity < 1:
+            raise ValueError("PacketRingBuffer capacity must be at least 1")
+
+        self.capacity = capacity
+        self.arena_size = arena_size if arena_size is not None else capacity * 16
+        self.on_evict = on_evict
+        self.evicted_count = 0
+
+        self._timestamps = array('d', bytes(8 * capacity))
+        self._offsets = array('Q', bytes(8 * capacity))
+        self._lengths = array('H', bytes(2 * capacity))
+        self._arena = bytearray(self.arena_size)
+
+        self._first_seq = 0
+        self._next_seq = 0
+        # Absolute (never wrapped) arena positions of the oldest frame and of the next write.
+        self._arena_head = 0
+        self._arena_tail = 0
+
+    def __len__(self):
+        return self._next_seq - self._first_seq
+
+    @property
+    def first_seq(self):
+        return self._first_seq
+
+    @property
+    def next_seq(self):
+        return self._next_seq
+
+    def clear(self):
+        self._first_seq = self._next_seq
+        self._arena_head = self._arena_tail
+
+    """
+    copy:
+        Returns an independent copy of the buffer (without the on_evict callback). The storage is copied in a few
+        bulk operations, so this is cheap enough to snapshot the capture for a background export.
+    """
+    def copy(self):
+        duplicate = PacketRingBuffer.__new__(PacketRingBuffer)
+        duplicate.__dict__.update(self.__dict__)
+        duplicate.on_evict = None
+        duplicate._timestamps = array('d', self._timestamps)
+        duplicate._offsets = array('Q', self._offsets)
+        duplicate._lengths = array('H', self._lengths)
+        duplicate._arena = bytearray(self._arena)
+        return duplicate
+
+    def _evict_oldest(self):
+        slot = self._first_seq % self.capacity
+        if self.on_evict is not None:
+            self.on_evict(self._timestamps[slot], self._read_arena(self._offsets[slot], self._lengths[slot]))
+
+        self._first_seq += 1
+        self.evicted_count += 1
+        if self._first_seq == self._next_seq:
+            self._arena_head = self._arena_tail
+        else:
+            self._arena_head = self._offsets[self._first_seq % self.capacity]
+
+    def _read_arena(self, offset, length):
+        pos = offset % self.arena_size
+        first = min(length, self.arena_size - pos)
+        if first == length:
+            return bytes(self._arena[pos:pos + length])
+        return bytes(self._arena[pos:]) + bytes(self._arena[:length - first])
+
+    """
+    append:
+        Stores one frame and returns its sequence number.
+
+    Parameters:
+        timestamp: Receive time of the frame as a float (seconds since the epoch).
+        frame: The decoded frame bytes.
+    """
+    def append(self, timestamp, frame):
+        length = frame.__len__()
+        if length > self.arena_size or length > 0xFFFF:
+            raise ValueError("Frame of {} bytes does not fit in the packet buffer".format(length))
+
+        while self.__len__() == self.capacity or (self._arena_tail - self._arena_head) + length > self.arena_size:
+            self._evict_oldest()
+
+        pos = self._arena_tail % self.arena_size
+        first = min(length, self.arena_size - pos)
+        self._arena[pos:pos + first] = frame[:first]
+        if first < length:
+            self._arena[:length - first] = frame[first:]
+
+        seq = self._next_seq
+        slot = seq % self.capacity
+        self._timestamps[slot] = timestamp
+        self._offsets[slot] = self._arena_tail
+        self._lengths[slot] = length
+
+        self._arena_tail += length
+        self._next_seq += 1
+        return seq
+
+    """
+    append_response:
+        Decodes an ELMRESPONSE from the adapter and stores it. Responses that are not hex frames (timeouts, prompts,
+        "NO DATA") are skipped. Returns the sequence number, or None if nothing was stored.
+    """
+    def append_response(self, response):
+        frame = decode_hex_frame(response.raw_value)
+        if not frame:
+            return None
+        return self.append(response.timestamp, frame)
+
+    """
+    get_frame:
+        Returns (timestamp, frame_bytes) for a sequence number. Raises IndexError if it has been evicted.
+    """
+    def get_frame(self, seq):
+        if seq < self._first_seq or seq >= self._next_seq:
+            raise IndexError("Packet {} is not in the buffer ({}-{})".format(seq, self._first_seq, self._next_seq - 1))
+        slot = seq % self.capacity
+        return self._timestamps[slot], self._read_arena(self._offsets[slot], self._lengths[slot])
+
+    """
+    get_packet:
+        Rebuilds the ELMRESPONSE (with its parsed KWPacket) for a sequence number.
+    """
+    def get_packet(self, seq):
+        timestamp, frame = self.get_frame(seq)
+        return ELMRESPONSE(bytes(frame.hex(' ').upper() + ' \r', 'ascii'), _date=timestamp, _parse_kwp=True)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.__len__()
+        if index < 0 or index >= self.__len__():
+            raise IndexError("Packet index out of range")
+        return self.get_packet(self._first_seq + index)
+
+    """
+    iter_frames:
+        Yields (seq, timestamp, frame_bytes) from start_seq (default: the oldest frame) to the newest.
+    """
+    def iter_frames(self, start_seq=None):
+        seq = self._first_seq if start_seq is None else max(start_seq, self._first_seq)
+        while seq < self._next_seq:
+            timestamp, frame = self.get_frame(seq)
+            yield seq, timestamp, frame
+            seq += 1
+
+"""
+FrameQueue:
+    A single-producer/single-consumer handoff between the serial read thread and the render loop. The producer pushes
+    items as they arrive and the consumer drains them in one batch per frame; neither side ever takes a lock, so a slow
+    frame can't hold up serial draining (and vice versa). This relies on deque.append/popleft being atomic.
+
+    Counters are each written by only one side: pushed_count, dropped_count and max_depth by the producer,
+    drained_count and max_stall (the longest any item waited in the queue, in seconds) by the consumer.
+
+Parameters:
+    capacity (default=65536): Items beyond this are dropped (and counted) rather than growing the queue.
+"""
+class FrameQueue:
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self._items = deque()
+
+        self.pushed_count = 0
+        self.dropped_count = 0
+        self.max_depth = 0
+
+        self.drained_count = 0
+        self.max_stall = 0.0
+
+    def __len__(self):
+        return self._items.__len__()
+
+    @property
+    def depth(self):
+        return self._items.__len__()
+
+    """
+    push:
+        Producer side. Returns False if the queue was full and the item was dropped.
+    """
+    def push(self, item):
+        depth = self._items.__len__()
+        if depth >= self.capacity:
+            self.dropped_count += 1
+            return False
+
+        self._items.append((time.perf_counter(), item))
+        self.pushed_count += 1
+        if depth + 1 > self.max_depth:
+            self.max_depth = depth + 1
+        return True
+
+    """
+    drain:
+        Consumer side. Removes and returns up to max_items queued items (default: everything queued right now).
+    """
+    def drain(self, max_items=None):
+        count = self._items.__len__()
+        if max_items is not None and max_items < count:
+            count = max_items
+        if count == 0:
+            return []
+
+        now = time.perf_counter()
+        popleft = self._items.popleft
+        batch = [None] * count
+        for i in range(0, count):
+            queued_at, item = popleft()
+            if i == 0 and now - queued_at > self.max_stall:
+                self.max_stall = now - queued_at
+            batch[i] = item
+
+        self.drained_count += count
+        return batch
+
+    def stats_string(self):
+        return "Queue depth: {} (max {}); dropped: {}; max stall: {:.1f} ms".format(
+            self.depth, self.max_depth, self.dropped_count, self.max_stall * 1000.0)
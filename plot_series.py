@@ -0,0 +1,334 @@
+from array import array
+
+from elmlib import decode_kwp_frame
+
+"""
+MinMaxRing:
+    A fixed-size ring of (time, min, max) entries in flat arrays, oldest first. Times are expected to only go up,
+    which is what makes lower_bound's binary search valid.
+"""
+class MinMaxRing:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.mins = array('d', bytes(8 * capacity))
+        self.maxs = array('d', bytes(8 * capacity))
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, minimum, maximum):
+        if self._count < self.capacity:
+            slot = (self._start + self._count) % self.capacity
+            self._count += 1
+        else:
+            slot = self._start
+            self._start = (self._start + 1) % self.capacity
+        self.times[slot] = timestamp
+        self.mins[slot] = minimum
+        self.maxs[slot] = maximum
+
+    def slot(self, index):
+        return (self._start + index) % self.capacity
+
+    def first_time(self):
+        return self.times[self._start] if self._count > 0 else None
+
+    # Index (0 = oldest) of the first entry at or after timestamp.
+    def lower_bound(self, timestamp):
+        low = 0
+        high = self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[(self._start + middle) % self.capacity] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def clear(self):
+        self._start = 0
+        self._count = 0
+
+"""
+PlotSeries:
+    One value pulled out of the payload of every frame with a given service ID (and optionally target/source), kept
+    for plotting. The value is length bytes starting at offset into the payload (the bytes after the service ID), read
+    as an integer and then scaled: value = raw * scale + bias.
+
+    Samples are kept at several levels of detail. Level 0 holds the newest capacity samples as they came in; each
+    level above holds one (min, max) entry per lod_factor entries of the level below, also capacity of them, so every
+    level reaches lod_factor times further back. A long session keeps its whole history at a coarser resolution
+    while memory stays fixed. The rings are searched by time, so samples older than the newest one are dropped (and
+    counted in out_of_order_count); clear() the series before feeding it a different capture.
+
+Parameters:
+    name: The label shown on the plot.
+    service_id: The service ID byte (or a KnownServiceIDs member) whose frames carry the value.
+    offset: Index of the first payload byte of the value.
+    length (default=1): Number of bytes (1-8).
+    signed (default=False): Read the bytes as a two's complement integer.
+    big_endian (default=True): Byte order of multi-byte values.
+    scale / bias (default=1.0 / 0.0): value = raw * scale + bias.
+    target / source (default=None): Only frames to/from this address byte.
+    capacity (default=16384): Entries kept at each level.
+    lod_factor (default=8): Entries of one level that make up one entry of the next.
+    levels (default=5): Number of levels (5 levels of 16384 with a factor of 8 reach back 67M samples).
+"""
+class PlotSeries:
+    def __init__(self, name, service_id, offset, length=1, signed=False, big_endian=True, scale=1.0, bias=0.0,
+                 target=None, source=None, capacity=16384, lod_factor=8, levels=5):
+        if length < 1 or length > 8:
+            raise ValueError("A plotted value must be 1 to 8 bytes long")
+        self.name = name
+        self.service_id = getattr(service_id, "value", service_id)
+        self.offset = offset
+        self.length = length
+        self.signed = signed
+        self.byteorder = 'big' if big_endian else 'little'
+        self.scale = scale
+        self.bias = bias
+        self.target = getattr(target, "value", target)
+        self.source = getattr(source, "value", source)
+        self.lod_factor = lod_factor
+
+        self.sample_count = 0
+        self.short_count = 0
+        self.out_of_order_count = 0
+        self.last_time = None
+        self.last_value = None
+        self.minimum = None
+        self.maximum = None
+
+        self._levels = [MinMaxRing(capacity) for _ in range(0, levels)]
+        # The block each level above 0 is still filling: [entries so far, first time, min, max].
+        self._partial = [[0, 0.0, 0.0, 0.0] for _ in range(0, levels)]
+
+    def matches(self, target, source):
+        return (self.target is None or self.target == target) and (self.source is None or self.source == source)
+
+    """
+    extract:
+        The scaled value from one payload, or None if the payload is too short to hold it.
+    """
+    def extract(self, payload):
+        end = self.offset + self.length
+        if payload.__len__() < end:
+            self.short_count += 1
+            return None
+        raw = int.from_bytes(payload[self.offset:end], self.byteorder, signed=self.signed)
+        return raw * self.scale + self.bias
+
+    def append(self, timestamp, value):
+        if self.last_time is not None and timestamp < self.last_time:
+            self.out_of_order_count += 1
+            return
+        self.last_time = timestamp
+        self.sample_count += 1
+        self.last_value = value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+        self._levels[0].append(timestamp, value, value)
+        minimum = maximum = value
+        for level in range(1, self._levels.__len__()):
+            partial = self._partial[level]
+            if partial[0] == 0:
+                partial[1] = timestamp
+                partial[2] = minimum
+                partial[3] = maximum
+            else:
+                if minimum < partial[2]:
+                    partial[2] = minimum
+                if maximum > partial[3]:
+                    partial[3] = maximum
+            partial[0] += 1
+            if partial[0] < self.lod_factor:
+                return
+            # The block is complete: it becomes one entry of this level and one step towards the next level's block.
+            self._levels[level].append(partial[1], partial[2], partial[3])
+            timestamp, minimum, maximum = partial[1], partial[2], partial[3]
+            partial[0] = 0
+
+    def clear(self):
+        for ring in self._levels:
+            ring.clear()
+        for partial in self._partial:
+            partial[0] = 0
+        self.sample_count = 0
+        self.short_count = 0
+        self.out_of_order_count = 0
+        self.last_time = None
+        self.last_value = None
+        self.minimum = None
+        self.maximum = None
+
+    def latest_time(self):
+        ring = self._levels[0]
+        return ring.times[ring.slot(ring.__len__() - 1)] if ring.__len__() > 0 else None
+
+    """
+    decimate:
+        Min/max decimation of the last window_seconds (up to end_time, default: the newest sample) into columns
+        buckets: each bucket becomes its min and max (in the order they came in), so spikes survive however many
+        samples fall into one column. Returns array('f') of 2 * columns points, ready for imgui.plot_lines, or None if
+        there is nothing to draw. Columns nothing fell into repeat the last value.
+
+        The work is bounded by the plot, not by the session: the finest level that has no more than
+        lod_factor entries per column over the window is the one that gets read, so at most about
+        lod_factor * columns entries are looked at. Windows that reach back past what a level still holds use a
+        coarser one.
+    """
+    def decimate(self, columns, window_seconds, end_time=None):
+        if end_time is None:
+            end_time = self.latest_time()
+        if end_time is None or columns < 1:
+            return None
+        start_time = end_time - window_seconds
+
+        ring = None
+        level = 0
+        first = 0
+        for candidate_level, candidate in enumerate(self._levels):
+            if candidate.__len__() == 0:
+                break
+            index = candidate.lower_bound(start_time)
+            # A level whose oldest entry is already inside the window doesn't reach back far enough, unless it's
+            # the last level that has anything at all.
+            reaches_back = index > 0 or candidate.first_time() <= start_time
+            ring = candidate
+            level = candidate_level
+            first = index
+            if reaches_back and candidate.__len__() - index <= self.lod_factor * columns:
+                break
+        if ring is None:
+            return None
+
+        entries = self._iter_entries(ring, first)
+        if level > 0:
+            # The newest samples are still in the unfinished blocks of this level and the ones below it (oldest
+            # first going down), not yet in the ring.
+            entries = self._chain(entries, [(partial[1], partial[2], partial[3]) for partial in self._partial[level:0:-1] if partial[0] > 0])
+
+        bucket_width = window_seconds / columns
+        mins = [None] * columns
+        maxs = [None] * columns
+        min_first = [True] * columns
+        for timestamp, low, high in entries:
+            if timestamp > end_time:
+                break
+            column = int((timestamp - start_time) / bucket_width)
+            if column < 0:
+                continue
+            if column >= columns:
+                column = columns - 1
+            if mins[column] is None:
+                mins[column] = low
+                maxs[column] = high
+            else:
+                if low < mins[column]:
+                    mins[column] = low
+                    min_first[column] = False
+                if high > maxs[column]:
+                    maxs[column] = high
+                    min_first[column] = True
+
+        points = array('f', bytes(8 * columns))
+        last = None
+        for column in range(0, columns):
+            if mins[column] is None:
+                if last is None:
+                    # Nothing yet; the line starts at the first value instead of at 0.
+                    last = next((value for value in mins if value is not None), 0.0)
+                points[2 * column] = last
+                points[2 * column + 1] = last
+                continue
+            if min_first[column]:
+                points[2 * column] = mins[column]
+                points[2 * column + 1] = maxs[column]
+                last = maxs[column]
+            else:
+                points[2 * column] = maxs[column]
+                points[2 * column + 1] = mins[column]
+                last = mins[column]
+        return points
+
+    def _iter_entries(self, ring, first):
+        times = ring.times
+        mins = ring.mins
+        maxs = ring.maxs
+        capacity = ring.capacity
+        slot = ring.slot(first)
+        for _ in range(first, ring.__len__()):
+            yield times[slot], mins[slot], maxs[slot]
+            slot += 1
+            if slot == capacity:
+                slot = 0
+
+    def _chain(self, entries, extra):
+        yield from entries
+        yield from extra
+
+    def stats_string(self):
+        return "{}: {} samples; last: {}; min: {}; max: {}{}{}".format(
+            self.name, self.sample_count, self.last_value, self.minimum, self.maximum,
+            "; too short: {}".format(self.short_count) if self.short_count > 0 else "",
+            "; out of order: {}".format(self.out_of_order_count) if self.out_of_order_count > 0 else "")
+
+"""
+PlotSet:
+    The series being plotted. feed() takes every decoded frame and hands its payload to the series that want its
+    service ID; a 256-entry table (rebuilt when series are added or removed) keeps that a single lookup per frame.
+"""
+class PlotSet:
+    def __init__(self):
+        self.series = []
+        self._table = [()] * 256
+
+    def _rebuild_table(self):
+        table = [[] for _ in range(0, 256)]
+        for series in self.series:
+            table[series.service_id].append(series)
+        self._table = [tuple(entry) for entry in table]
+
+    def add(self, series):
+        self.series.append(series)
+        self._rebuild_table()
+        return series
+
+    def remove(self, series):
+        if series in self.series:
+            self.series.remove(series)
+            self._rebuild_table()
+
+    # Empties every series (keeping the series themselves), ex: before an import or replay starts over in time.
+    def clear(self):
+        for series in self.series:
+            series.clear()
+
+    """
+    feed:
+        Takes one frame (the decoded frame bytes, as queued by the read thread) and appends to every series it
+        carries a value for.
+    """
+    def feed(self, timestamp, frame):
+        if frame.__len__() < 4:
+            return
+        # The service ID sits after a 3 byte header, or a 4 byte one when the length is in its own byte.
+        service_id = frame[4] if (frame[0] & 0x3F) == 0 and frame.__len__() > 4 else frame[3]
+        wanted = self._table[service_id]
+        if wanted.__len__() == 0:
+            return
+        decoded = decode_kwp_frame(bytes(frame), already_decoded=True)
+        if decoded is None:
+            return
+        for series in wanted:
+            if not series.matches(decoded.MsgTarget_Raw, decoded.MsgSource_Raw):
+                continue
+            value = series.extract(decoded.payload)
+            if value is not None:
+                series.append(timestamp, value)
@@ -0,0 +1,142 @@
+import time
+
+"""
+DEFAULT_LENGTH_RULES:
+    Rules for how long a complete message is, per service ID. Each rule is called with the payload received so far
+    (at least one byte) and returns the total payload length of the whole message, or None if it can't tell yet.
+    Service IDs without a rule are always delivered frame by frame.
+
+    0x58 (GUESS_CODES_RESPONSE): the first byte is the code count and every code takes 3 bytes (2 code bytes and a
+    0x20), which matches every 0x58 reply in the bundled dumps.
+"""
+DEFAULT_LENGTH_RULES = {
+    0x58: lambda payload: 1 + 3 * payload[0],
+}
+
+"""
+MessageReassembler:
+    Stitches responses that arrive split over several frames back into one logical message before it is handed to the
+    listeners. A message is keyed by (source, target, service ID); frames for the same key are appended until the
+    length rule for that service ID is satisfied, and only then is on_message called. Frames that are already complete
+    (or have no rule) go straight through without being copied.
+
+    Partial messages are held in a fixed pool of preallocated buffers, so a flood of broken frames can't grow memory.
+    A partial message that sees no new frame for timeout seconds is dropped, as is the oldest one when every buffer is
+    in use. Counters: delivered_count, reassembled_count, timed_out_count, evicted_count and overflow_count (messages
+    longer than a buffer).
+
+Parameters:
+    on_message: Called as on_message(service_id, payload, key) for every complete message. payload is a memoryview
+                that is only valid during the call.
+    max_pending (default=16): Number of messages that can be partially received at the same time.
+    max_message_size (default=1024): Size of each buffer (the longest message that can be reassembled).
+    timeout (default=1.0): Seconds (of frame time) a partial message waits for its next frame.
+    length_rules (default=DEFAULT_LENGTH_RULES): service ID -> length rule.
+"""
+class MessageReassembler:
+    def __init__(self, on_message, max_pending=16, max_message_size=1024, timeout=1.0, length_rules=None):
+        self.on_message = on_message
+        self.max_message_size = max_message_size
+        self.timeout = timeout
+        self.length_rules = dict(DEFAULT_LENGTH_RULES if length_rules is None else length_rules)
+
+        self._buffers = [bytearray(max_message_size) for _ in range(0, max_pending)]
+        self._free = list(range(max_pending - 1, -1, -1))
+        # key -> [slot, bytes received, expected length, time of the last frame]
+        self._pending = {}
+
+        self.delivered_count = 0
+        self.reassembled_count = 0
+        self.timed_out_count = 0
+        self.evicted_count = 0
+        self.overflow_count = 0
+
+    def register_length_rule(self, service_id, rule):
+        self.length_rules[service_id] = rule
+
+    def pending_count(self):
+        return self._pending.__len__()
+
+    def _deliver(self, service_id, payload, key):
+        self.delivered_count += 1
+        self.on_message(service_id, payload, key)
+
+    def _release(self, key):
+        slot = self._pending.pop(key)[0]
+        self._free.append(slot)
+
+    """
+    expire:
+        Drops partial messages that have waited longer than timeout. Called on every feed(); call it directly to time
+        out messages when no frames are coming in.
+    """
+    def expire(self, now=None):
+        if self._pending.__len__() == 0:
+            return
+        if now is None:
+            now = time.time()
+        for key in [k for k, entry in self._pending.items() if now - entry[3] > self.timeout]:
+            self._release(key)
+            self.timed_out_count += 1
+
+    def _expected_length(self, service_id, payload):
+        rule = self.length_rules.get(service_id)
+        if rule is None or payload.__len__() == 0:
+            return None
+        return rule(payload)
+
+    """
+    feed:
+        Takes one decoded frame (a KWPFrame from elmlib.decode_kwp_frame or KWPFramer).
+
+    Parameters:
+        decoded: The KWPFrame.
+        timestamp (default=now): Receive time of the frame, used for the timeouts.
+    """
+    def feed(self, decoded, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.expire(timestamp)
+
+        service_id = decoded.ServiceID_Raw
+        payload = decoded.payload
+        key = (decoded.MsgSource_Raw, decoded.MsgTarget_Raw, service_id)
+        entry = self._pending.get(key)
+
+        if entry is None:
+            expected = self._expected_length(service_id, payload)
+            if expected is None or payload.__len__() >= expected:
+                self._deliver(service_id, payload, key)
+                return
+            if expected > self.max_message_size:
+                self.overflow_count += 1
+                return
+            if self._free.__len__() == 0:
+                oldest = min(self._pending, key=lambda k: self._pending[k][3])
+                self._release(oldest)
+                self.evicted_count += 1
+            entry = [self._free.pop(), 0, expected, timestamp]
+            self._pending[key] = entry
+
+        slot, received, expected, _ = entry
+        if received + payload.__len__() > self.max_message_size:
+            self._release(key)
+            self.overflow_count += 1
+            return
+
+        buffer = self._buffers[slot]
+        buffer[received:received + payload.__len__()] = payload
+        received += payload.__len__()
+        entry[1] = received
+        entry[3] = timestamp
+
+        if received >= expected:
+            self.reassembled_count += 1
+            try:
+                self._deliver(service_id, memoryview(buffer)[:expected], key)
+            finally:
+                self._release(key)
+
+    def stats_string(self):
+        return "Messages delivered: {}; reassembled: {}; pending: {}; timed out: {}; evicted: {}; overflowed: {}".format(
+            self.delivered_count, self.reassembled_count, self._pending.__len__(), self.timed_out_count, self.evicted_count, self.overflow_count)
@@ -0,0 +1,160 @@
+import argparse
+import time
+
+from capture_format import frame_to_string_value
+from capture_json import iter_capture_file
+from elmlib import ELMRESPONSE
+
+REPLAY_ORIGINAL = "original"
+REPLAY_SCALED = "scaled"
+REPLAY_MAX = "max"
+REPLAY_MODES = [REPLAY_ORIGINAL, REPLAY_SCALED, REPLAY_MAX]
+
+"""
+ReplaySource:
+    Plays a recorded capture (dumps/*.json, .ndjson or .t1ncap) back as if it were coming off a live ELM327 in monitor
+    mode. It has the same read interface as ELM327 (try_read_serial, try_read_until_timeout, is_open, close), so it can
+    be handed to do_main_test's loop or MonitorData._threaded_read_loop in place of a real adapter.
+
+    Modes:
+        original: Frames are released with the gaps they were recorded with.
+        scaled:   Same, but the gaps are divided by speed (speed=2 plays twice as fast).
+        max:      No waiting at all; frames are returned as fast as they can be read.
+
+    Frames keep their recorded timestamps. Once the capture runs out (after repeat passes), try_read_serial returns
+    an empty response, like a read timeout on the real adapter, and finished is set.
+
+Parameters:
+    path: The capture file to play.
+    mode (default=original): One of REPLAY_MODES.
+    speed (default=1.0): Playback speed for the scaled mode.
+    repeat (default=1): Number of passes over the capture.
+"""
+class ReplaySource:
+    def __init__(self, path, mode=REPLAY_ORIGINAL, speed=1.0, repeat=1):
+        if mode not in REPLAY_MODES:
+            raise ValueError("Unknown replay mode '{}', expected one of {}".format(mode, REPLAY_MODES))
+        if mode == REPLAY_SCALED and speed <= 0:
+            raise ValueError("Replay speed must be greater than 0")
+
+        self.path = path
+        self.mode = mode
+        self.speed = speed if mode == REPLAY_SCALED else 1.0
+        self.repeat = repeat
+        self.finished = False
+        self.frame_count = 0
+        self.started_at = 0.0
+        self.finished_at = 0.0
+
+        self._open = True
+        self._frames = self._iter_frames()
+        self._capture_start = None
+        self._wall_start = 0.0
+
+    # Yields (timestamp, frame, pass_offset) where pass_offset shifts later passes to carry on after the previous one.
+    def _iter_frames(self):
+        pass_offset = 0.0
+        for _ in range(0, self.repeat):
+            first_timestamp = None
+            last_timestamp = None
+            for timestamp, frame in iter_capture_file(self.path):
+                if first_timestamp is None:
+                    first_timestamp = timestamp
+                last_timestamp = timestamp
+                yield timestamp, frame, pass_offset
+            if first_timestamp is None:
+                return
+            pass_offset += last_timestamp - first_timestamp
+
+    def _wait_until_due(self, timestamp, pass_offset):
+        if self._capture_start is None:
+            self._capture_start = timestamp
+            self._wall_start = time.perf_counter()
+            self.started_at = self._wall_start
+
+        if self.mode == REPLAY_MAX:
+            return
+        due = self._wall_start + (pass_offset + timestamp - self._capture_start) / self.speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    """
+    try_read_serial:
+        Returns the next recorded frame as an ELMRESPONSE once it is due, or an empty response once the capture has
+        been played through.
+    """
+    def try_read_serial(self, bytes_written=0, _parse_kwp=0):
+        if not self._open or self.finished:
+            # Nothing left to play; behave like a read timeout rather than letting a read loop spin.
+            time.sleep(0.05)
+            return ELMRESPONSE(b'')
+
+        try:
+            timestamp, frame, pass_offset = next(self._frames)
+        except StopIteration:
+            self.finished = True
+            self.finished_at = time.perf_counter()
+            return ELMRESPONSE(b'')
+
+        self._wait_until_due(timestamp, pass_offset)
+        self.frame_count += 1
+        return ELMRESPONSE(bytes(frame_to_string_value(frame), 'ascii'), _date=timestamp, _parse_kwp=_parse_kwp)
+
+    def try_read_until_timeout(self, timeout=5):
+        return ELMRESPONSE(b'')
+
+    def configure_monitor_mode(self):
+        return 0
+
+    def frames_per_second(self):
+        end = self.finished_at if self.finished else time.perf_counter()
+        if self.frame_count == 0 or end <= self.started_at:
+            return 0.0
+        return self.frame_count / (end - self.started_at)
+
+    def is_open(self):
+        return self._open
+
+    def close(self):
+        self._open = False
+
+"""
+run_replay:
+    Plays a capture through sprinter_obdii_monitor.process_response, the same decode and listener path do_main_test
+    uses, and returns the ReplaySource (frame_count, frames_per_second()) once it has finished.
+"""
+def run_replay(source):
+    from sprinter_obdii_monitor import process_response
+
+    while not source.finished:
+        received_response = source.try_read_serial(bytes_written=0)
+        if received_response.raw_value.__len__() > 0:
+            process_response(received_response)
+    return source
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded capture through the decode and listener path.")
+    parser.add_argument("capture", help="A capture file (dumps/*.json, .ndjson or .t1ncap)")
+    parser.add_argument("--mode", choices=REPLAY_MODES, default=REPLAY_ORIGINAL)
+    parser.add_argument("--speed", type=float, default=1.0, help="Playback speed for --mode scaled")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of passes over the capture")
+    parser.add_argument("--no-handlers", action="store_true", help="Dispatch to no-op listeners instead of the printing handlers")
+    args = parser.parse_args()
+
+    import sprinter_obdii_monitor
+    from sprinter_types import KnownServiceIDs
+    if args.no_handlers:
+        for service_id in [KnownServiceIDs.GUESS_REQUEST_CODES, KnownServiceIDs.GUESS_CODES_RESPONSE, KnownServiceIDs.GUESS_REQUEST_INFO_ON_CODE]:
+            sprinter_obdii_monitor.elm327_add_listener(service_id, lambda msg_byte, byte_args: None)
+    else:
+        sprinter_obdii_monitor.register_default_listeners()
+
+    source = run_replay(ReplaySource(args.capture, args.mode, args.speed, args.repeat))
+    print("Replayed {} frames in {:.3f}s ({:.0f} frames/s, mode: {})".format(
+        source.frame_count, source.finished_at - source.started_at, source.frames_per_second(), args.mode))
+    for line in sprinter_obdii_monitor.dispatch_bus.stats_lines():
+        print(line)
+    print(sprinter_obdii_monitor.request_correlator.stats_string())
+    for line in sprinter_obdii_monitor.request_correlator.report_lines():
+        print("  " + line)
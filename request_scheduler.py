@@ -0,0 +1,298 @@
+import argparse
+import heapq
+import threading
+import time
+
+from correlation import LatencyHistogram
+
+PRIORITY_KEEPALIVE = 0
+PRIORITY_REQUEST = 10
+
+"""
+ScheduledRequest:
+    One message the scheduler sends, either once or every interval seconds. Keeps its own timing statistics:
+    sent_count, missed_count (periodic slots skipped because the scheduler was too far behind), lateness (how long
+    after its due time each send actually went out) and interval_error (how far each gap between two sends of a
+    periodic request was from its interval), both LatencyHistograms.
+"""
+class ScheduledRequest:
+    def __init__(self, name, data_bytes, due, interval, priority):
+        self.name = name
+        self.data_bytes = list(data_bytes)
+        self.due = due
+        self.interval = interval
+        self.priority = priority
+        self.cancelled = False
+
+        self.sent_count = 0
+        self.missed_count = 0
+        self.last_sent = None
+        self.last_response = None
+        self.lateness = LatencyHistogram(min_latency=0.00001)
+        self.interval_error = LatencyHistogram(min_latency=0.00001)
+
+    def stats_string(self):
+        return "{:<16} sent={} missed={} late: {}; interval error: {}".format(
+            self.name, self.sent_count, self.missed_count, self.lateness.summary_string(), self.interval_error.summary_string())
+
+"""
+RequestScheduler:
+    Sends keepalives and diagnostic requests with controlled timing. Every request has a due time on the monotonic
+    clock; requests that are due go out in priority order (lower number first, so a keepalive due at the same time as
+    a request wins), with aging: each priority level is worth priority_step seconds of waiting, so a request that has
+    been due long enough goes ahead of a higher priority one that has only just come due. A keepalive that comes due
+    again every send can't starve the other requests that way. No two sends are ever closer together than
+    min_spacing, measured from the end of one send (the adapter has returned the reply) to the start of the next,
+    which keeps the K-line from being flooded.
+
+    Periodic requests are rescheduled from their due time, not from when they were actually sent, so a late send
+    doesn't push every later one back. If a periodic request falls more than a whole interval behind, the missed
+    slots are skipped (and counted) instead of being sent back to back.
+
+    The scheduler can be driven by hand with run_pending() (ex: from an existing loop), or started on its own thread
+    with start().
+
+Parameters:
+    send: Called as send(data_bytes) for every request (ex: ELM327.write_bytes, which picks monitoring back up after
+          the reply). Its return value is kept in ScheduledRequest.last_response.
+    min_spacing (default=0.055): Minimum gap in seconds between sends (the KWP2000 P3 minimum).
+    clock (default=time.monotonic): Time source.
+    priority_step (default=0.01): Seconds of waiting worth one priority level (a request is 0.1s "later" than a
+                                  keepalive due at the same time).
+    lock (default=None): Held around every send. Without one the scheduler has to be the adapter's only user; if
+                         another thread reads the same ELM327 (ex: MonitorData's read thread), pass the lock that
+                         thread reads under (MonitorData.elm_lock).
+"""
+class RequestScheduler:
+    def __init__(self, send, min_spacing=0.055, clock=time.monotonic, priority_step=0.01, lock=None):
+        self.send = send
+        self.min_spacing = min_spacing
+        self.clock = clock
+        self.priority_step = priority_step
+        self.adapter_lock = lock
+
+        self._heap = []
+        self._sequence = 0
+        self._requests = []
+        self._next_allowed = 0.0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._running = False
+
+        self.sent_count = 0
+        self.error_count = 0
+        # Lateness of every send, one-shot requests included.
+        self.lateness = LatencyHistogram(min_latency=0.00001)
+        # One-shot requests are dropped from requests() once sent, so their totals are kept here.
+        self.one_shot_sent_count = 0
+        self.one_shot_lateness = LatencyHistogram(min_latency=0.00001)
+
+    def _push(self, request):
+        self._sequence += 1
+        heapq.heappush(self._heap, (request.due, request.priority, self._sequence, request))
+
+    def _add(self, request):
+        with self._lock:
+            self._requests.append(request)
+            self._push(request)
+        self._wakeup.set()
+        return request
+
+    """
+    add_periodic:
+        Sends data_bytes every interval seconds, starting after delay (default: one interval from now).
+    """
+    def add_periodic(self, name, data_bytes, interval, priority=PRIORITY_REQUEST, delay=None):
+        if interval <= 0:
+            raise ValueError("The interval of a periodic request must be greater than 0")
+        due = self.clock() + (interval if delay is None else delay)
+        return self._add(ScheduledRequest(name, data_bytes, due, interval, priority))
+
+    """
+    add_keepalive:
+        Periodic tester present (0x3E) at the highest priority, to hold a diagnostic session open. The interval has to
+        leave room for other requests between keepalives, so it must be longer than min_spacing.
+    """
+    def add_keepalive(self, interval=2.0, data_bytes=(0x3E,)):
+        if interval <= self.min_spacing:
+            raise ValueError("A keepalive every {}s leaves no room for other requests (min_spacing is {}s)".format(interval, self.min_spacing))
+        return self.add_periodic("keepalive", data_bytes, interval, PRIORITY_KEEPALIVE)
+
+    """
+    add_once:
+        Sends data_bytes once, after delay seconds (default: as soon as the spacing allows).
+    """
+    def add_once(self, name, data_bytes, delay=0.0, priority=PRIORITY_REQUEST):
+        return self._add(ScheduledRequest(name, data_bytes, self.clock() + delay, None, priority))
+
+    def cancel(self, request):
+        request.cancelled = True
+        with self._lock:
+            if request in self._requests:
+                self._requests.remove(request)
+
+    def requests(self):
+        return list(self._requests)
+
+    """
+    next_wakeup:
+        When run_pending next has something to do: the earliest due time, held back by the spacing. None if nothing is
+        scheduled.
+    """
+    def next_wakeup(self):
+        with self._lock:
+            while self._heap.__len__() > 0 and self._heap[0][3].cancelled:
+                heapq.heappop(self._heap)
+            if self._heap.__len__() == 0:
+                return None
+            return max(self._heap[0][0], self._next_allowed)
+
+    def _pop_ready(self, now):
+        # Out of everything that is due, the earliest due goes first once each is held back priority_step seconds per
+        # priority level; ties go to the higher priority.
+        ready = []
+        while self._heap.__len__() > 0 and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if not entry[3].cancelled:
+                ready.append(entry)
+        if ready.__len__() == 0:
+            return None
+        ready.sort(key=lambda entry: (entry[0] + entry[1] * self.priority_step, entry[1], entry[2]))
+        for entry in ready[1:]:
+            heapq.heappush(self._heap, entry)
+        return ready[0][3]
+
+    """
+    run_pending:
+        Sends at most one request if one is due and the spacing allows it. Returns the ScheduledRequest that was sent,
+        or None.
+    """
+    def run_pending(self):
+        now = self.clock()
+        with self._lock:
+            if now < self._next_allowed:
+                return None
+            request = self._pop_ready(now)
+            if request is None:
+                return None
+
+            if request.interval is not None:
+                next_due = request.due + request.interval
+                if next_due <= now:
+                    skipped = int((now - next_due) // request.interval) + 1
+                    request.missed_count += skipped
+                    next_due += skipped * request.interval
+                scheduled_due = request.due
+                request.due = next_due
+                self._push(request)
+            else:
+                scheduled_due = request.due
+                if request in self._requests:
+                    self._requests.remove(request)
+
+        sent_at = self.clock()
+        request.lateness.add(max(0.0, sent_at - scheduled_due))
+        self.lateness.add(max(0.0, sent_at - scheduled_due))
+        if request.last_sent is not None and request.interval is not None:
+            request.interval_error.add(abs((sent_at - request.last_sent) - request.interval))
+        try:
+            if self.adapter_lock is not None:
+                with self.adapter_lock:
+                    request.last_response = self.send(request.data_bytes)
+            else:
+                request.last_response = self.send(request.data_bytes)
+        except Exception as e:
+            self.error_count += 1
+            request.last_response = e
+        finished_at = self.clock()
+
+        request.last_sent = sent_at
+        request.sent_count += 1
+        self.sent_count += 1
+        if request.interval is None:
+            self.one_shot_sent_count += 1
+            self.one_shot_lateness.add(max(0.0, sent_at - scheduled_due))
+        self._next_allowed = finished_at + self.min_spacing
+        return request
+
+    def _run(self):
+        while self._running:
+            self.run_pending()
+            wakeup = self.next_wakeup()
+            timeout = None if wakeup is None else max(0.0, wakeup - self.clock())
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    """
+    start / stop:
+        Run the scheduler on its own thread. The thread sleeps until the next request is due (or a new one is added).
+    """
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="RequestSchedulerThread", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._running = False
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+
+    def stats_lines(self):
+        lines = ["Sent: {}; errors: {}; late: {}".format(self.sent_count, self.error_count, self.lateness.summary_string())]
+        pending = [request for request in self.requests() if request.interval is None]
+        lines.append("One-shot requests: sent={} pending={} late: {}".format(
+            self.one_shot_sent_count, pending.__len__(), self.one_shot_lateness.summary_string()))
+        for request in self.requests():
+            lines.append(request.stats_string())
+        return lines
+
+if __name__ == "__main__":
+    from elmlib import ELM327, KWPFramer
+
+    parser = argparse.ArgumentParser(description="Hold a diagnostic session open with periodic tester present.")
+    parser.add_argument("device", help="The ELM327 serial device")
+    parser.add_argument("--baud", type=int, default=38400)
+    parser.add_argument("--header", default="81 12 F3", help="Message header (format, target, source)")
+    parser.add_argument("--keepalive", type=float, default=2.0, help="Seconds between tester present messages")
+    parser.add_argument("--request", action="append", default=[], help="Extra one-shot request, ex: '30 01 01'")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to run")
+    parser.add_argument("--monitor", action="store_true", help="Monitor the bus (AT MA) between requests and count the frames read")
+    args = parser.parse_args()
+
+    elm327 = ELM327(False, args.device, args.baud, 5)
+    elm327.set_kwp2000()
+    elm327.set_show_headers(True)
+    elm327.set_data_header([int(b, 16) for b in args.header.split()])
+
+    # This thread reads the monitor output while the scheduler thread sends, so both go through the same lock.
+    adapter_lock = threading.Lock()
+    scheduler = RequestScheduler(elm327.write_bytes, lock=adapter_lock)
+    scheduler.add_keepalive(args.keepalive)
+    for i, request in enumerate(args.request):
+        scheduler.add_once("request-{}".format(i), [int(b, 16) for b in request.split()], delay=0.1 * (i + 1))
+    framer = KWPFramer()
+    if args.monitor:
+        elm327.set_monitor_all()
+    scheduler.start()
+    try:
+        if args.monitor:
+            deadline = time.perf_counter() + args.duration
+            while time.perf_counter() < deadline:
+                with adapter_lock:
+                    received_response = elm327.try_read_serial(bytes_written=0)
+                framer.feed(received_response.raw_value)
+        else:
+            time.sleep(args.duration)
+    finally:
+        scheduler.stop()
+        for line in scheduler.stats_lines():
+            print(line)
+        if args.monitor:
+            print(framer.stats_string())
+        elm327.close()
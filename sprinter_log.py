@@ -0,0 +1,176 @@
+import atexit
+import datetime
+import os
+import queue
+import threading
+import time
+
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_ERROR = 40
+
+_LEVEL_NAMES = {LOG_DEBUG: "DEBUG", LOG_INFO: "INFO", LOG_WARNING: "WARNING", LOG_ERROR: "ERROR"}
+
+"""
+BatchedLogWriter:
+    Writes log lines from a background thread so callers never touch the file themselves. log() only checks the level
+    and drops the record into a bounded queue; formatting and writing happen on the writer thread, which pulls
+    everything queued (up to batch_size records) and writes it in one go. Once the file grows past max_bytes it is
+    rotated to filename.1, filename.2, ... keeping backup_count old files.
+    If the queue is full the record is dropped and counted in dropped_count rather than blocking the caller.
+
+Parameters:
+    filename: The log file to append to.
+    level (default=LOG_INFO): Records below this level are discarded before they are queued.
+    max_queue (default=10000): Maximum number of records waiting to be written.
+    batch_size (default=512): Maximum number of records written per batch.
+    flush_interval (default=0.25): Longest time (seconds) a record waits before the writer wakes up.
+    max_bytes (default=10 MiB): Size at which the file is rotated. 0 disables rotation.
+    backup_count (default=5): Number of rotated files to keep.
+"""
+class BatchedLogWriter:
+    def __init__(self, filename, level=LOG_INFO, max_queue=10000, batch_size=512, flush_interval=0.25, max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.filename = filename
+        self.level = level
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.dropped_count = 0
+        self.written_count = 0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._file = open(self.filename, 'a')
+        self._file_size = self._file.tell()
+        self._closed = False
+        self._thread = threading.Thread(target=self._writer_loop, name="LogWriterThread", daemon=True)
+        self._thread.start()
+
+    def is_enabled_for(self, level):
+        return level >= self.level
+
+    def log(self, level, *args, **kwargs):
+        if level < self.level or self._closed:
+            return
+        try:
+            self._queue.put_nowait((time.time(), level, args, kwargs))
+        except queue.Full:
+            self.dropped_count += 1
+
+    def debug(self, *args, **kwargs):
+        self.log(LOG_DEBUG, *args, **kwargs)
+
+    def info(self, *args, **kwargs):
+        self.log(LOG_INFO, *args, **kwargs)
+
+    def warning(self, *args, **kwargs):
+        self.log(LOG_WARNING, *args, **kwargs)
+
+    def error(self, *args, **kwargs):
+        self.log(LOG_ERROR, *args, **kwargs)
+
+    def _format_record(self, record):
+        timestamp, level, args, kwargs = record
+        return "[{}] [{}] {} {}\n".format(datetime.datetime.fromtimestamp(timestamp), _LEVEL_NAMES.get(level, level), args, kwargs)
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            older = "{}.{}".format(self.filename, i)
+            if os.path.exists(older):
+                os.replace(older, "{}.{}".format(self.filename, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.filename, self.filename + ".1")
+        else:
+            os.remove(self.filename)
+        self._file = open(self.filename, 'a')
+        self._file_size = 0
+
+    def _writer_loop(self):
+        while True:
+            try:
+                record = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            batch = []
+            stop = record is None
+            if not stop:
+                batch.append(record)
+            while not stop and batch.__len__() < self.batch_size:
+                try:
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                else:
+                    batch.append(record)
+
+            if batch.__len__() > 0:
+                chunk = "".join(map(self._format_record, batch))
+                self._file.write(chunk)
+                self._file.flush()
+                self._file_size += chunk.__len__()
+                self.written_count += batch.__len__()
+                if self.max_bytes > 0 and self._file_size >= self.max_bytes:
+                    self._rotate()
+
+            if stop:
+                break
+
+    """
+    close:
+        Writes out everything still queued and stops the writer thread.
+    """
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+_default_logger = None
+
+"""
+init_logging:
+    Creates the process-wide BatchedLogWriter used by log_debug/log_info/etc. The level can be overridden with the
+    SPRINTER_LOG_LEVEL environment variable (DEBUG, INFO, WARNING or ERROR). Debug output is off unless asked for.
+"""
+def init_logging(filename, level=LOG_INFO, **kwargs):
+    global _default_logger
+    env_level = os.environ.get("SPRINTER_LOG_LEVEL", "").upper()
+    for value, name in _LEVEL_NAMES.items():
+        if name == env_level:
+            level = value
+
+    if _default_logger is not None:
+        _default_logger.close()
+    _default_logger = BatchedLogWriter(filename, level, **kwargs)
+    atexit.register(_default_logger.close)
+    return _default_logger
+
+def get_logger():
+    return _default_logger
+
+# Cheap enough to leave on hot paths: with no logger, or debug disabled, this is a single comparison.
+def debug_enabled():
+    return _default_logger is not None and _default_logger.level <= LOG_DEBUG
+
+def log_debug(*args, **kwargs):
+    if _default_logger is not None:
+        _default_logger.log(LOG_DEBUG, *args, **kwargs)
+
+def log_info(*args, **kwargs):
+    if _default_logger is not None:
+        _default_logger.log(LOG_INFO, *args, **kwargs)
+
+def log_warning(*args, **kwargs):
+    if _default_logger is not None:
+        _default_logger.log(LOG_WARNING, *args, **kwargs)
+
+def log_error(*args, **kwargs):
+    if _default_logger is not None:
+        _default_logger.log(LOG_ERROR, *args, **kwargs)
@@ -12,8 +12,14 @@ import json
 
 from elmlib import *
 from sprinter_types import *
-
-handlers = {}
+from sprinter_log import init_logging, debug_enabled, log_debug, log_info
+from reassembly import MessageReassembler
+from correlation import RequestCorrelator
+from dispatch import DispatchBus
+import adapter_probe
+
+# Every listener lives on this bus (see dispatch.py); several can subscribe to the same service ID.
+dispatch_bus = DispatchBus()
 sniffed_packets = []
 elm327 = {}
 
@@ -25,12 +31,14 @@ _current_filename = "logs/" + get_current_date_string() + ".txt"
 if not os.path.isdir('logs/'):
     os.mkdir('logs/')
 
+# Log lines are queued and written in batches by a background thread (see sprinter_log.BatchedLogWriter).
+# Per-packet debug output goes through log_debug and is off unless SPRINTER_LOG_LEVEL=DEBUG is set.
+init_logging(_current_filename)
+
 def custom_decorator(func):
     def wrapped_func(*args, **kwargs):
         d = datetime.datetime.now()
-        with open(_current_filename, 'a') as outputfile:
-            asStr = "[{}] {} {}\n".format(d, args, kwargs)
-            outputfile.write(asStr)
+        log_info(*args, **kwargs)
         return func("[", d, "] ", *args, **kwargs)
     return wrapped_func
 
@@ -105,6 +113,9 @@ Parameters:
 def test_checksum(converted, header_msg_length):
     if header_msg_length != 0:
         return converted[3 + header_msg_length]
+    # A length of 0 in the format byte means the real length is in an extra fourth header byte.
+    if converted.__len__() > 4 and converted[3] != 0 and converted.__len__() > 4 + converted[3]:
+        return converted[4 + converted[3]]
     return None
 
 """
@@ -117,9 +128,11 @@ Parameters:
                        the checksum byte should be.
 """
 def test_service_id(converted, header_msg_length):
-    print("header_msg_length: {}; bytes: {}".format(header_msg_length, converted))
+    log_debug("header_msg_length:", header_msg_length, "; bytes:", converted)
     if header_msg_length != 0:
         return converted[2 + 1]
+    if converted.__len__() > 4:
+        return converted[4]
     return None
 
 def iterate_print(in_byte_arr):
@@ -176,21 +189,28 @@ def signal_handler(sig, frame):
     else: sys.exit(0)
 
 # handler_msg should be able to take the messagebyte and an array of arguments 
-def elm327_add_listener(message_byte, handler_msg):
-    handlers.update({message_byte.value: handler_msg})
+# Returns the Subscription; target/source filter on the address bytes and threaded runs the handler off the read path.
+def elm327_add_listener(message_byte, handler_msg, target=None, source=None, threaded=False):
+    return dispatch_bus.subscribe(message_byte, handler_msg, target, source, threaded)
+
+def elm327_remove_listener(subscription):
+    dispatch_bus.unsubscribe(subscription)
 
-def elm327_exec_listeners(message_byte, args_byte_array):
-    theHandler = handlers.get(message_byte)
-    if(theHandler):
-        theHandler(message_byte, args_byte_array)
+def elm327_exec_listeners(message_byte, args_byte_array, target=None, source=None):
+    dispatch_bus.publish(message_byte, args_byte_array, target, source)
+
+# Responses split over several frames are stitched back together here; listeners only ever see complete messages.
+message_reassembler = MessageReassembler(lambda service_id, payload, key: elm327_exec_listeners(service_id, payload, target=key[1], source=key[0]))
+# Pairs requests with their responses for the round-trip latency numbers (see correlation.py).
+request_correlator = RequestCorrelator()
 
 def handle_guess_request_codes(msg_byte, byte_args):
-        print("The DAD has requested a list of codes. Argument Bytes: ", byte_args)
+        print("The DAD has requested a list of codes. Argument Bytes: ", list(byte_args))
 
 def handle_guess_request_codes_response(msg_byte, byte_args):
     codes_stored = byte_args[0]
     codes = []
-    print("Codes Stored: {}; Byte_Args: {} Byte_Args Length: {}".format(codes_stored, byte_args, byte_args.__len__()))
+    print("Codes Stored: {}; Byte_Args: {} Byte_Args Length: {}".format(codes_stored, list(byte_args), byte_args.__len__()))
 
     for i in range(1, byte_args.__len__() - 1, 2):
         codes.append(hex(byte_args[i])[2:] + hex(byte_args[i + 1])[2:])
@@ -209,13 +229,69 @@ def get_serial_grep_by_plat():
     elif sys.platform == "win32":
         return "COM1" # Fuck, I don't know how Windows handles serial shit.
 
+# Devices listed in SPRINTER_SERIAL_DEVICES (separated like PATH) are used instead of the glob, ex: an elm_emulator pty.
 def get_serial_devices():
+    devices = os.environ.get("SPRINTER_SERIAL_DEVICES")
+    if devices:
+        return [device for device in devices.split(os.pathsep) if device]
     return glob.glob(get_serial_grep_by_plat())
 
-import ui_test
+"""
+process_response:
+    The decode and listener path for one response read from the ELM327 (or replayed from a capture, see replay.py).
+    Returns the decoded KWPFrame, or None if the response wasn't a KWP frame.
+
+Parameters:
+    received_response: An ELMRESPONSE holding one line of monitor output.
+"""
+def process_response(received_response):
+    # Decode the raw adapter output straight into the KWP header fields, payload and checksum.
+    decoded = decode_kwp_frame(received_response.raw_value)
+    # print("[elm327 loop] Stdin: {}; Response: {}; First: {}".format(stdin_response, received_response.raw_value, hex(((received_response.raw_value[0] << 8) | received_response.raw_value[1]))))
+    if debug_enabled():
+        log_debug("[elm327 loop] Response: {};".format(received_response.raw_value))
+
+    # KWP Header value extraction.
+    # a0 & a1 are boolean flags to describe HOW the packet is interpreted (functional mode, etc)
+    #    This value comes from the upper 2 bits of the first byte.
+    # The KWP message data length comes from the lower 6 bits of the first byte. If that is 0, an extra byte is dedicated to the length (0-255)
+    # Target & source are the receiver/sender bytes, the service ID is the byte that determines what data we're getting
+    # and, just for completeness, the checksum is the final byte of the message.
+    if decoded is not None:
+        # Debug Printing. (Only formatted when debug logging is on.)
+        if debug_enabled():
+            log_debug("  [test_data_length] Data Bytes Length: {}".format(decoded.HeaderMsgLength))
+            log_debug("  [test_format_byte] A1: {}, A0: {}".format(decoded.A1, decoded.A0))
+            log_debug("\t KWP MSG; TO: {}; FROM: {}".format(ConvertByteToTargetAddressByte(decoded.MsgTarget_Raw), ConvertByteToSourceAddressByte(decoded.MsgSource_Raw)))
+            log_debug("\t\tService ID: {} ({})".format(decoded.ServiceID_Raw, ConvertByteToKnownServiceIDs(decoded.ServiceID_Raw)))
+            log_debug("\t\tChecksum: {} ({})".format(hex(decoded.Checksum), decoded.Checksum))
+
+        # Finally, the frame goes through the reassembler, which calls elm327_exec_listeners with just the relevant
+        # bytes once the message is complete. If listeners are subscribed to the service_id we're passing, then they will be called.
+        #   The payload is everything after the header & service ID, up to the checksum, joined across frames when a
+        #   response is split (see reassembly.py).
+        message_reassembler.feed(decoded, received_response.timestamp)
+        request_correlator.feed(decoded, received_response.timestamp)
+    return decoded
+
+"""
+register_default_listeners:
+    My API: Setting up listeners based on Service ID byte values.
+    If a message comes through matching one of these service IDs, the handler will be called.
+"""
+def register_default_listeners():
+    elm327_add_listener(KnownServiceIDs.GUESS_REQUEST_CODES, handle_guess_request_codes)
+    elm327_add_listener(KnownServiceIDs.GUESS_CODES_RESPONSE, handle_guess_request_codes_response)
+    elm327_add_listener(KnownServiceIDs.GUESS_REQUEST_INFO_ON_CODE, handle_guess_request_code_info)
 
 def do_main_test():
-    ui_test.ui_init_graphics()
+    # The GUI connects on its own (Open Connection); the console read loop below is for SPRINTER_HEADLESS=1.
+    if os.environ.get("SPRINTER_HEADLESS") != "1":
+        # Imported here rather than at the top: ui_test imports from this module, and the decode path above shouldn't
+        # need the graphics stack (see replay.py).
+        import ui_test
+        ui_test.ui_init_graphics()
+        return
 
     print("Current File Name: ", _current_filename)
     # Set the INTERRUPT signal handler.
@@ -223,7 +299,7 @@ def do_main_test():
 
     serial_dev_glob = get_serial_grep_by_plat()
     print("Looking for USB Serial devices. Glob: ", serial_dev_glob)
-    matched_files = glob.glob(serial_dev_glob)
+    matched_files = get_serial_devices()
 
     print(matched_files, matched_files.__len__())
 
@@ -233,26 +309,16 @@ def do_main_test():
         exit()
 
 
-    # My API: Setting up listeners based on Service ID byte values.
-    # If a message comes through matching one of these service IDs, the handler will be called.
-    elm327_add_listener(KnownServiceIDs.GUESS_REQUEST_CODES, handle_guess_request_codes)
-    elm327_add_listener(KnownServiceIDs.GUESS_CODES_RESPONSE, handle_guess_request_codes_response)
-    elm327_add_listener(KnownServiceIDs.GUESS_REQUEST_INFO_ON_CODE, handle_guess_request_code_info)
-
-    # Initialize the ELM327 object with baud rate of 38400, timeout of 5s, and our first matched serial device.
-    elm327 = ELM327(True, matched_files[0], 38400, 5)
-
-    # Set KWP2000 protocol for the Sprinter.
-    elm327.set_kwp2000()
-    
-    # Show me the headers, I want to see it all.
-    elm327.set_show_headers(True)
-    
-    # Put into Monitor All Mode (AT MA)
-    elm327.set_monitor_all()
+    register_default_listeners()
 
-    # Flush the read buffer by trying to read for 1 second
-    elm327.try_read_until_timeout(timeout=1) # Flush
+    # Open the adapter (the cached one if it's still plugged in, otherwise whichever matched device answers as an ELM327),
+    # switch the UART up from 38400 if the adapter allows it, then set KWP2000 protocol for the Sprinter, show all headers
+    # and put it into Monitor All Mode (AT MA).
+    # Each command returns as soon as the adapter prompt comes back; the timings are printed once startup is done.
+    elm327 = adapter_probe.connect_monitor(matched_files, monitor_baud_rate=adapter_probe.MONITOR_BAUD_RATE)
+    if elm327 is None:
+        print("ERROR: None of the {0} matched devices answered as an ELM327.".format(matched_files.__len__()))
+        exit()
 
     print("Entering read loop.")
     while True: # TODO: Make this actually loop with a cause, not just forever.
@@ -262,50 +328,12 @@ def do_main_test():
         received_response = elm327.try_read_serial(bytes_written=0)
 
         # Only take action if the response actually has a length > 0. (AKA: Not an empty message.)
-        if received_response.tostring().__len__() > 0: #or stdin_response.__len__() > 0:
+        if received_response.raw_value.__len__() > 0: #or stdin_response.__len__() > 0:
             # Append our raw logged packet.
             sniffed_packets.append(received_response)
 
-            # Convert raw byte string to a sane byte array.
-            converted = convert_str_to_byte_array(received_response.raw_value.decode())
-            # print("[elm327 loop] Stdin: {}; Response: {}; First: {}".format(stdin_response, received_response.raw_value, hex(((received_response.raw_value[0] << 8) | received_response.raw_value[1]))))
-            print("[elm327 loop] Response: {};".format(received_response.raw_value))
-            
-            # KWP Header value extraction.
-            # a0 & a1 are boolean flags to describe HOW the packet is interpreted (functional mode, etc)
-            #    This value comes from the upper 2 bits of the first byte.
-            a0, a1 = test_format_byte(converted[0])
-            
-            # Gets the KWP message data length from the lower 6 bits of the first byte. If this is 0, an extra byte is dedicated to the length (0-255)
-            header_msg_length = test_data_length(converted[0])
-
-            # Functions to retrieve the target & source (receiver/sender) bytes from 
-            #  the received byte array.
-            target = test_target(converted)
-            source = test_source(converted)
-
-            # Retrieve the service ID, aka the byte that determines what data we're getting.
-            service_id = test_service_id(converted, header_msg_length)
-
-            # Finally, just for completeness, let's get the checksum from the message. 
-            checksum = test_checksum(converted, header_msg_length)
-
-            # Debug Printing.
-            print("  [test_data_length] Data Bytes Length: {}".format(header_msg_length))
-            print("  [test_format_byte] A1: {}, A0: {}".format(a1, a0))
-            if target and source and service_id and checksum:
-                print("\t KWP MSG; TO: {}; FROM: {}".format(target, source))
-                print("\t\tService ID: {} ({})".format(service_id, ConvertByteToKnownServiceIDs(service_id)))
-                print("\t\tChecksum: {} ({})".format(hex(checksum), checksum))
-
-                # Finally, we'll call the elm327_exec_listeners method and pass just the relevant bytes to our listeners.
-                # Is listeners are subscribed to the service_id we're passing, then they will be called.
-                #   The data is extracted from byte 4 onward (TODO: Handle multi-part messages.)
-                elm327_exec_listeners(service_id, converted[4:converted.__len__() - 1]) # From offset 0x04 onward, 4 bytes make up the header & service ID for the message
-
-            print("") # Printing new line just to put some space between packets.
-
-
+            # Decode it and hand the payload to the listeners.
+            process_response(received_response)
 
     # Exit and close safely
     if(elm327.is_open()):
@@ -21,20 +21,24 @@ class KnownServiceIDs(Enum):
     KEEPALIVE_PING = 0x3E # From DAD
     KEEPALIVE_PONG = 0x7E # From ECM
 
+# 256-entry lookup tables so the decode path never has to go through Enum construction (and its exception) per byte.
+_SERVICE_ID_TABLE = tuple(KnownServiceIDs._value2member_map_.get(b, KnownServiceIDs.UNKNOWN) for b in range(256))
+_ADDRESS_BYTE_TABLE = tuple(SourceAddressByte._value2member_map_.get(b, SourceAddressByte.UNKNOWN) for b in range(256))
+
 def ConvertByteToKnownServiceIDs(bbyte):
     try:
-        return KnownServiceIDs(bbyte)
+        return _SERVICE_ID_TABLE[bbyte]
     except:
         return KnownServiceIDs.UNKNOWN
 
 def ConvertByteToTargetAddressByte(bbyte):
     try:
-        return SourceAddressByte(bbyte)
+        return _ADDRESS_BYTE_TABLE[bbyte]
     except:
         return SourceAddressByte.UNKNOWN
 
 def ConvertByteToSourceAddressByte(bbyte):
     try:
-        return SourceAddressByte(bbyte)
+        return _ADDRESS_BYTE_TABLE[bbyte]
     except:
         return SourceAddressByte.UNKNOWN
@@ -0,0 +1,73 @@
+"""
+Tests that run AsyncELM327 against ELM327Emulator on a pseudo-terminal. Run with:
+
+    python3 -m unittest test_elm_async
+"""
+import asyncio
+import os
+import unittest
+
+from elm_async import AsyncELM327
+from elm_emulator import ELM327Emulator
+
+# Collects what frames() yields for duration seconds.
+async def _read_frames(elm327, duration):
+    frames = []
+
+    async def collect():
+        async for timestamp, decoded in elm327.frames():
+            frames.append(decoded)
+
+    task = asyncio.create_task(collect())
+    await asyncio.sleep(duration)
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return frames
+
+@unittest.skipIf(os.name != "posix", "The emulator needs a pty")
+class AsyncMonitorTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.emulator = ELM327Emulator(load_rate=200)
+        self.device = self.emulator.open()
+
+    def tearDown(self):
+        self.emulator.close()
+
+    async def test_frames_while_monitoring(self):
+        async with AsyncELM327(self.device, 38400) as elm327:
+            await elm327.configure_monitor_mode()
+            frames = await _read_frames(elm327, 1.0)
+            self.assertGreater(frames.__len__(), 150)
+            self.assertEqual(elm327.framer.bad_checksum_count, 0)
+            # The emulator's synthetic traffic: tester present, read DTCs and their replies.
+            self.assertEqual(set(decoded.ServiceID_Raw for decoded in frames), {0x3E, 0x7E, 0x18, 0x58})
+
+    async def test_set_monitor_all_while_monitoring(self):
+        async with AsyncELM327(self.device, 38400) as elm327:
+            await elm327.configure_monitor_mode()
+            await elm327.set_monitor_all()
+            self.assertTrue(elm327.monitor_all_mode)
+            self.assertEqual(self.emulator.interrupt_count, 1)
+            await asyncio.sleep(0.1)
+            self.assertTrue(self.emulator.monitor_all_mode)
+            frames = await _read_frames(elm327, 0.5)
+            self.assertGreater(frames.__len__(), 50)
+
+    async def test_message_during_monitoring(self):
+        async with AsyncELM327(self.device, 38400) as elm327:
+            await elm327.configure_monitor_mode()
+            await elm327.execute_command("AT SH 81 12 F3\r\n")
+            reply = await elm327.send_message([0x3E])
+            self.assertIn(b"7E", reply.raw_value)
+            self.assertTrue(elm327.monitor_all_mode)
+            # Each command stopped the monitor once and started it again.
+            self.assertEqual(self.emulator.interrupt_count, 2)
+            frames = await _read_frames(elm327, 0.5)
+            self.assertTrue(self.emulator.monitor_all_mode)
+            self.assertGreater(frames.__len__(), 50)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+"""
+Tests that run the real ELM327 driver against ELM327Emulator on a pseudo-terminal. Run with:
+
+    python3 -m unittest test_elm_emulator
+"""
+import os
+import time
+import unittest
+
+import serial
+
+from elm_emulator import ELM327_IDENTIFICATION, ELM327Emulator, check_baud_negotiation, measure_read_path
+from elmlib import ELM327, KWPFramer
+
+def _read_until(port, token, timeout=1.0):
+    reply = b""
+    deadline = time.perf_counter() + timeout
+    while token not in reply and time.perf_counter() < deadline:
+        reply += port.read(port.in_waiting or 1)
+    return reply
+
+@unittest.skipIf(os.name != "posix", "The emulator needs a pty")
+class BaudNegotiationTest(unittest.TestCase):
+    def test_check_baud_switches_rate(self):
+        with ELM327Emulator(load_rate=100, baud_rate=38400) as emulator:
+            negotiated, elapsed = check_baud_negotiation(emulator, 115200)
+            self.assertEqual(negotiated, 115200)
+            self.assertAlmostEqual(emulator.baud_rate, 4000000.0 / 0x23)
+            # The handshake waits out the 75 ms BRT window once, plus the command delays.
+            self.assertGreater(elapsed, 0.075)
+            self.assertLess(elapsed, 0.5)
+
+    def test_unreachable_rate_is_refused(self):
+        with ELM327Emulator(load_rate=100, baud_rate=38400) as emulator:
+            negotiated, _ = check_baud_negotiation(emulator, 1000000)
+            self.assertEqual(negotiated, 38400)
+            self.assertEqual(emulator.baud_rate, 38400)
+
+    def test_handshake_without_return_reverts(self):
+        with ELM327Emulator(load_rate=100, baud_rate=38400) as emulator:
+            with serial.Serial(emulator.device, 38400, timeout=0.05) as port:
+                port.write(b"AT BRD 23\r")
+                reply = _read_until(port, b">")
+                self.assertIn(b"OK\r" + ELM327_IDENTIFICATION + b"\r", reply)
+                self.assertEqual(emulator.baud_rate, 38400)
+                port.write(b"ATI\r")
+                self.assertIn(ELM327_IDENTIFICATION, _read_until(port, b">"))
+
+@unittest.skipIf(os.name != "posix", "The emulator needs a pty")
+class MonitorTest(unittest.TestCase):
+    def test_interrupting_byte_is_dropped(self):
+        with ELM327Emulator(load_rate=100) as emulator:
+            with serial.Serial(emulator.device, 38400, timeout=0.05) as port:
+                port.write(b"AT MA\r")
+                time.sleep(0.1)
+                # A command sent into a running monitor loses its first character to the interrupt, like on the adapter.
+                port.write(b"ATI\r")
+                reply = _read_until(port, b"?", timeout=0.5)
+                self.assertIn(b"STOPPED", reply)
+                self.assertIn(b"?", reply)
+                self.assertNotIn(ELM327_IDENTIFICATION, reply.partition(b"STOPPED")[2])
+                self.assertEqual(emulator.interrupt_count, 1)
+
+    def test_buffer_full_restarts_monitoring(self):
+        # 700 frames/s is about 16 kB/s of text; a 38400 baud UART drains 3840 B/s, so the buffer keeps overflowing.
+        with ELM327Emulator(load_rate=700, baud_rate=38400) as emulator:
+            elm327 = ELM327(False, emulator.device, 38400, 0.1)
+            try:
+                elm327.configure_monitor_mode()
+                framer = KWPFramer()
+                frames_at_overflow = None
+                deadline = time.perf_counter() + 3.0
+                while time.perf_counter() < deadline:
+                    framer.feed(elm327.try_read_serial(bytes_written=0).raw_value)
+                    if frames_at_overflow is None and elm327.buffer_full_count > 0:
+                        frames_at_overflow = framer.good_count
+                self.assertGreater(emulator.buffer_full_count, 0)
+                # The driver saw every overflow but (maybe) the one still on its way when the time was up.
+                self.assertGreaterEqual(elm327.buffer_full_count, emulator.buffer_full_count - 1)
+                self.assertIsNotNone(frames_at_overflow)
+                # Monitoring came back after every overflow, so frames kept arriving.
+                self.assertGreater(framer.good_count, frames_at_overflow + 100)
+                self.assertEqual(framer.bad_checksum_count, 0)
+            finally:
+                elm327.close()
+
+    def test_write_bytes_resumes_monitoring(self):
+        with ELM327Emulator(load_rate=200) as emulator:
+            elm327 = ELM327(False, emulator.device, 38400, 0.1)
+            try:
+                elm327.configure_monitor_mode()
+                elm327.set_data_header([0x81, 0x12, 0xF3])
+                self.assertTrue(emulator.monitor_all_mode)
+                reply = elm327.write_bytes([0x3E])
+                self.assertIn(b"7E", reply.raw_value)
+                self.assertTrue(elm327.monitor_all_mode)
+
+                framer = KWPFramer()
+                deadline = time.perf_counter() + 0.5
+                while time.perf_counter() < deadline:
+                    framer.feed(elm327.try_read_serial(bytes_written=0).raw_value)
+                self.assertTrue(emulator.monitor_all_mode)
+                self.assertGreater(framer.good_count, 50)
+            finally:
+                elm327.close()
+
+@unittest.skipIf(os.name != "posix", "The emulator needs a pty")
+class ReadPathTest(unittest.TestCase):
+    def test_measure_read_path_counts_every_frame(self):
+        with ELM327Emulator(load_rate=1000, record_send_times=True) as emulator:
+            received, frames_per_second, latency = measure_read_path(emulator, 1.0)
+            # Everything sent gets read, except what was still in flight when the measurement stopped.
+            self.assertGreater(received, 900)
+            self.assertLessEqual(received, emulator.frames_sent)
+            self.assertGreater(received, emulator.frames_sent - 20)
+            self.assertEqual(latency.count, received)
+            self.assertGreater(frames_per_second, 900)
+
+if __name__ == "__main__":
+    unittest.main()
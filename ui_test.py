@@ -1,5 +1,6 @@
 import os
 from time import sleep
+import time
 from sdl2 import *
 import ctypes
 import OpenGL.GL as gl
@@ -8,12 +9,20 @@ import imgui
 from imgui.integrations.sdl2 import SDL2Renderer
 
 from sprinter_obdii_monitor import convert_str_to_byte_array, get_serial_devices, test_format_byte, test_data_length, test_target, test_source, test_service_id, test_checksum
-from elmlib import ELM327, ELMRESPONSE, KWPacket
+from elmlib import ELM327, ELMRESPONSE, KWPacket, KWPFramer
+from packet_buffer import FrameQueue, PacketRingBuffer
+from capture_format import CaptureWriter
+from capture_json import CaptureIOJob, deserialize_packets, export_capture_job, import_capture_job, serialize_packet_buffer
+from capture_store import CAPTURE_STORE_EXTENSION, CaptureStore, CaptureStoreWriter
+from sprinter_log import debug_enabled, log_debug
+from replay import REPLAY_ORIGINAL, ReplaySource
+from correlation import RequestCorrelator
+from plot_series import PlotSeries, PlotSet
+import adapter_probe
 
 import threading 
 import json
-
-from functools import reduce
+import sqlite3
 
 class AtomicBool:
     value = False
@@ -35,36 +44,17 @@ class AtomicBool:
             self.value = newVal
 
 #_tracked_packets = [ELMRESPONSE(b"81 12 F3 3E C4 \r", _parse_kwp=True), ELMRESPONSE(b"81 F3 12 7E 04 \r", _parse_kwp=True), ELMRESPONSE(b"84 12 F3 18 02 FF 00 A2 \r", _parse_kwp=True), ELMRESPONSE(b"85 F3 12 58 01 20 43 20 66 \r", _parse_kwp=True)]
-_tracked_packets = []
-_tracked_packets_lock = threading.Lock()
+# Bounded so a long monitoring session can't grow without limit; the oldest frames are evicted once it's full.
+# Only the UI thread touches this; the read thread hands frames over through MonitorData.frame_queue.
+TRACKED_PACKET_CAPACITY = 500000
+_tracked_packets = PacketRingBuffer(TRACKED_PACKET_CAPACITY)
 _keep_elm_alive = AtomicBool(True)
 
 def serialize_packets():
-    rval = []
-    with _tracked_packets_lock:
-        for p in _tracked_packets:
-            if p is not None:
-                converted_bytes = convert_str_to_byte_array(p.raw_value.decode())
-                rval.append({"date": p.date.timestamp(), "string_value": p.tostring(), "raw_byte_packet": converted_bytes})
-    return rval
+    return serialize_packet_buffer(_tracked_packets)
 
 def deserialize_ser_packets(serialized_packets):
-    from datetime import datetime
-    rval = []
-    for p in serialized_packets:
-        if len(p["raw_byte_packet"]) > 0:
-            print("Packet: ", p["raw_byte_packet"])
-            converted_packets = numbers_to_bytestr(p["raw_byte_packet"])
-            print("Converted Packet: ", converted_packets)
-            rval.append(ELMRESPONSE(converted_packets, _date=datetime.fromtimestamp(p["date"]), _parse_kwp=True))
-            print("\n\n")
-    return rval
-
-def numbers_to_bytestr(input_num_arr):
-    rval = ''
-    for n in input_num_arr:
-        rval += "{0:#0{1}X}".format(n, 4)[2:] + " "
-    return bytes(rval + "\r", "ascii")
+    return deserialize_packets(serialized_packets)
 
 class MonitorData:
     class ByteConverterData:
@@ -79,25 +69,91 @@ class MonitorData:
     current_serial_device = ""
     connection_active = False
     debug_monitor_win_active = True
-    debug_monitor_list_selected = []
+    debug_monitor_list_selected = set()
+    debug_monitor_row_cache = {}
     byte_win_active = False
+    plot_win_active = False
+    # Every frame drained from the read (or import) queue is offered to these; see plot_window_loop.
+    plot_set = PlotSet()
+    plot_window_seconds = 60.0
+    plot_new_name = "value"
+    plot_new_service_id = "61"
+    plot_new_offset = 0
+    plot_new_length = 1
+    plot_new_signed = False
+    plot_new_scale = 1.0
     elm327 = 0
+    # The UART rate asked for with AT BRD on connect (None stays at the rate the adapter was found at). At 38400 a busy
+    # bus overflows the adapter's buffer (BUFFER FULL).
+    monitor_baud_rate = adapter_probe.MONITOR_BAUD_RATE
     elm_read_thread = 0
     elm_lock = threading.Lock()
     export_filename = "dumps/exported_json.json"
     import_filename = "dumps/exported_json.json"
     byte_win_data = ByteConverterData()
-
-    def init_elm327(self, device_string, baud_rate, timeout=5):
-        self.elm327 = ELM327(True, device_string, baud_rate, timeout)
-        self.elm327.set_kwp2000()
-        self.elm327.set_show_headers(True)
-        self.elm327.set_monitor_all()
-        self.elm327.try_read_until_timeout(timeout=1)
-
+    frame_queue = FrameQueue()
+    # Only used by the read thread; splits what the adapter sends into checksum-validated frames.
+    kwp_framer = KWPFramer()
+    # Fed by the read thread, read by the Debug Monitor.
+    request_correlator = RequestCorrelator()
+    import_queue = FrameQueue()
+    capture_job = None
+    # A .t1ncap file to keep the frames evicted from _tracked_packets in instead of dropping them (set in the Debug
+    # Monitor, or with SPRINTER_SPILL_FILE). It's opened when a connection, replay or import starts and closed (so
+    # nothing stays buffered) when the connection is closed or the app quits.
+    spill_filename = os.environ.get("SPRINTER_SPILL_FILE", "")
+    spill_enabled = spill_filename != ""
+    spill_writer = None
+    # A .sqlite file to store every frame the read thread decodes in (see capture_store.py; set in the Debug Monitor,
+    # or with SPRINTER_CAPTURE_STORE). The Debug Monitor can then page through the whole session, filtered by service
+    # ID, instead of only what fits in _tracked_packets. Recording starts with the next connection or replay and the
+    # writer is closed (storing whatever it still has queued) when the connection is closed or the app quits.
+    capture_store_filename = os.environ.get("SPRINTER_CAPTURE_STORE", "")
+    capture_store_enabled = capture_store_filename != ""
+    capture_store_writer = None
+    capture_store = None
+    store_browse_active = False
+    store_service_filter = ""
+    store_row_count = 0
+    store_count_refreshed_at = 0.0
+    store_page_cache = {}
+    store_list_selected = set()
+
+    """
+    init_elm327:
+        Connects through adapter_probe.connect_monitor: the cached adapter straight away if it's still plugged in,
+        otherwise whichever device answers as an ELM327 (current_serial_device is tried first), switched up to
+        monitor_baud_rate if the adapter allows it. Returns False if no adapter answered.
+    """
+    def init_elm327(self, timeout=5):
+        devices = [self.current_serial_device] + [device for device in self.serial_devices if device != self.current_serial_device]
+        elm327 = adapter_probe.connect_monitor(devices, timeout=timeout, monitor_baud_rate=self.monitor_baud_rate)
+        if elm327 is None:
+            return False
+        self.elm327 = elm327
+        self.current_serial_device = elm327.serial.port
+        self._start_read_thread()
+        return True
+
+    """
+    init_replay:
+        Plays a recorded capture through the read thread instead of a live ELM327 (see replay.ReplaySource).
+    """
+    def init_replay(self, capture_path, mode=REPLAY_ORIGINAL, speed=1.0):
+        self.elm327 = ReplaySource(capture_path, mode, speed)
+        self.plot_set.clear()
+        self._start_read_thread()
+
+    def _start_read_thread(self):
+        # A thread can only be started once, so make a fresh one after a previous connection was closed.
+        if self.elm_read_thread.ident is not None:
+            self.elm_read_thread = threading.Thread(target=self._threaded_read_loop, name="ElmReadThread")
+        _keep_elm_alive.setVal(True)
+
+        self.open_spill_writer()
+        self.open_capture_store_writer()
         print("Starting Read Thread...")
         self.elm_read_thread.start()
-        # return self.elm327.try_read_until_timeout(timeout=1)
 
     def kill_elm327(self):
         print("Requesting to kill Read Thread...")
@@ -105,6 +161,11 @@ class MonitorData:
         self.elm_read_thread.join()
 
         print("Read Thread Finished!")
+        # Whatever the read thread queued last still has to go through _tracked_packets (and spill) before the writer
+        # is closed.
+        self.drain_read_queue()
+        self.close_spill_writer()
+        self.close_capture_store_writer()
         if self.elm327.is_open():
             print("!!! Closing ELM327.")
             self.elm327.close()
@@ -113,6 +174,57 @@ class MonitorData:
             else:
                 print("Hmmmm Elm327 is not successfully closed.")
 
+    def open_spill_writer(self):
+        if self.spill_writer is not None or not self.spill_enabled or self.spill_filename == "":
+            return
+        try:
+            self.spill_writer = CaptureWriter(self.spill_filename, append=True)
+        except (OSError, ValueError) as e:
+            print("Can't spill evicted frames to {}: {}".format(self.spill_filename, e))
+            self.spill_enabled = False
+            return
+        _tracked_packets.on_evict = self.spill_writer.write_frame
+
+    def close_spill_writer(self):
+        if self.spill_writer is None:
+            return
+        _tracked_packets.on_evict = None
+        self.spill_writer.close()
+        print("Spilled {} evicted frames to {}".format(self.spill_writer.frame_count, self.spill_filename))
+        self.spill_writer = None
+
+    def open_capture_store_writer(self):
+        if self.capture_store_writer is not None or not self.capture_store_enabled or self.capture_store_filename == "":
+            return
+        try:
+            self.capture_store_writer = CaptureStoreWriter(self.capture_store_filename)
+        except sqlite3.Error as e:
+            print("Can't record to {}: {}".format(self.capture_store_filename, e))
+            self.capture_store_enabled = False
+            return
+        self.open_capture_store(self.capture_store_filename)
+
+    # Only once the read thread has stopped: it's the one writing.
+    def close_capture_store_writer(self):
+        if self.capture_store_writer is None:
+            return
+        self.capture_store_writer.close()
+        print(self.capture_store_writer.stats_string())
+        self.capture_store_writer = None
+
+    """
+    shutdown:
+        Closes the connection (or replay) and every writer, so nothing still buffered is lost. Called on Quit and when
+        the window is closed.
+    """
+    def shutdown(self):
+        if self.connection_active:
+            self.kill_elm327()
+            self.connection_active = False
+        self.drain_read_queue()
+        self.close_spill_writer()
+        self.close_capture_store_writer()
+
     def refresh_serial_devices(self):
         self.serial_devices = get_serial_devices()
         if self.serial_devices.__len__() > 0:
@@ -129,23 +241,64 @@ class MonitorData:
             received_response = 0
             with self.elm_lock:
                 # Read ELM327
-                received_response = self.elm327.try_read_serial(bytes_written=0, _parse_kwp=True)
+                received_response = self.elm327.try_read_serial(bytes_written=0)
 
-                if received_response.raw_value.__len__() > -1:
-                    print("[THREAD] RECEIVED: ", received_response.raw_value.__len__(), "; ", received_response.raw_value, "; ", received_response.tostring())
+                if debug_enabled():
+                    log_debug("[THREAD] RECEIVED: ", received_response.raw_value.__len__(), "; ", received_response.raw_value)
             # Unlock ELM327 
 
-            # Lock Tracked Variables
+            # Decode here, off the UI thread, and hand the frames over without locking. The UI drains the queue once per frame.
             if received_response != 0:
-                with _tracked_packets_lock: 
-                    print("appending: ", received_response)
-                    _tracked_packets.append(received_response)
-            # Unlock Tracked Variables
+                for decoded in self.kwp_framer.feed(received_response.raw_value):
+                    self.frame_queue.push((received_response.timestamp, decoded.frame))
+                    self.request_correlator.feed(decoded, received_response.timestamp)
+                    if self.capture_store_writer is not None:
+                        self.capture_store_writer.write_frame(received_response.timestamp, decoded.frame)
+
+    """
+    drain_read_queue:
+        Moves every frame the read thread (or a running import) has queued since the last call into _tracked_packets.
+        Called once per UI frame.
+    """
+    def drain_read_queue(self):
+        for timestamp, frame in self.frame_queue.drain():
+            _tracked_packets.append(timestamp, frame)
+            self.plot_set.feed(timestamp, frame)
+        for timestamp, frame in self.import_queue.drain():
+            _tracked_packets.append(timestamp, frame)
+            self.plot_set.feed(timestamp, frame)
 
     def __init__(self):
         self.refresh_serial_devices()
         self.elm_read_thread = threading.Thread(target=self._threaded_read_loop, name="ElmReadThread")
 
+    """
+    open_capture_store:
+        Opens a capture store for the Debug Monitor to page through (the one being recorded, or an imported .sqlite).
+    """
+    def open_capture_store(self, path):
+        if self.capture_store is not None:
+            self.capture_store.close()
+        self.capture_store = CaptureStore(path)
+        self.store_browse_active = True
+        self.store_count_refreshed_at = 0.0
+        self.store_page_cache = {}
+        self.store_list_selected = set()
+
+    """
+    store_service_ids:
+        The service ID filter typed into the Debug Monitor (hex, separated by spaces or commas), or None for no
+        filter. Anything that isn't hex is ignored.
+    """
+    def store_service_ids(self):
+        service_ids = []
+        for value in self.store_service_filter.replace(",", " ").split():
+            try:
+                service_ids.append(int(value, 16) & 0xFF)
+            except ValueError:
+                pass
+        return service_ids if service_ids.__len__() > 0 else None
+
 
 def impl_pysdl2_init():
     width, height = 1280, 720
@@ -205,7 +358,7 @@ def ui_init_graphics():
     while _running:
         while SDL_PollEvent(ctypes.byref(event)) != 0:
             if event.type == SDL_QUIT:
-                running = False
+                _running = False
                 break
             _impl.process_event(event)
         _impl.process_inputs()
@@ -216,6 +369,7 @@ def ui_init_graphics():
         # ui_check_elm327(_appData)
         
     
+    _appData.shutdown()
     ui_quit(_impl, _gl_context)
 
 def to_locale_string(dtObj):
@@ -226,7 +380,7 @@ def ui_check_elm327(appData):
     if appData.connection_active:
         received_response = appData.elm327.try_read_serial(bytes_written=0)
         if received_response.tostring().__len__() > 0:
-            _tracked_packets.append(received_response)
+            _tracked_packets.append_response(received_response)
 
 def toggle_elm327_conn(appData, shouldConnect):
     if appData.serial_devices.__len__() == 0:
@@ -236,25 +390,66 @@ def toggle_elm327_conn(appData, shouldConnect):
 
     if shouldConnect:
         print("Connecting to ELM327...")
-        appData.init_elm327(appData.current_serial_device, 38400, 5)
+        if not appData.init_elm327(5):
+            print("None of the serial devices answered as an ELM327: ", appData.serial_devices)
+            appData.connection_active = False
     else:
         appData.kill_elm327()
 
+"""
+ui_import_json:
+    Starts streaming the import file (.json, .ndjson or .t1ncap) into _tracked_packets on a background thread. Frames
+    arrive through appData.import_queue and are drained once per UI frame, so memory stays flat however big the file is.
+    A capture store (.sqlite) isn't copied at all; it's opened for the Debug Monitor to page through.
+"""
 def ui_import_json(appData, _window):
-    if os.path.exists(appData.import_filename):
-        with open(appData.import_filename) as imported_json:
-            json_str = imported_json.readlines()
-            json_full_str = reduce((lambda x, y: x + y), json_str)
-
-            parsed_json = json.loads(json_full_str)
-            deserialized_packets = deserialize_ser_packets(parsed_json)
-            if deserialized_packets.__len__() > 0:
-                with _tracked_packets_lock:
-                    _tracked_packets.clear()
-                    for x in deserialized_packets:
-                        _tracked_packets.append(x)
-            else:
-                SDL_ShowSimpleMessageBox(SDL_MESSAGEBOX_ERROR, b"Error Parsing JSON", b"Could not deserialize JSON", _window)
+    if appData.capture_job is not None or not os.path.exists(appData.import_filename):
+        return
+    if appData.import_filename.endswith(CAPTURE_STORE_EXTENSION):
+        appData.open_capture_store(appData.import_filename)
+        return
+
+    _tracked_packets.clear()
+    appData.import_queue.drain()
+    # The imported timestamps start over from the capture's, so the plots have to as well.
+    appData.plot_set.clear()
+    appData.open_spill_writer()
+    appData.capture_job = CaptureIOJob("Import", import_capture_job, appData.import_filename, appData.import_queue)
+
+"""
+ui_export_packets:
+    Writes a snapshot of _tracked_packets to the export file on a background thread. The format follows the file
+    extension: .t1ncap (binary), .ndjson (one packet per line) or anything else for the regular JSON dump.
+"""
+def ui_export_packets(appData, _window):
+    if appData.capture_job is not None:
+        return
+    appData.capture_job = CaptureIOJob("Export", export_capture_job, appData.export_filename, _tracked_packets.copy())
+
+# Shows progress for a running import/export and reports the outcome once it finishes.
+def ui_capture_job_status(appData, _window):
+    job = appData.capture_job
+    if job is None:
+        return
+
+    if not job.done:
+        imgui.progress_bar(job.progress, (0, 0), "{} {:.0f}%".format(job.name, job.progress * 100.0))
+        imgui.same_line()
+        if imgui.button("Cancel"):
+            job.cancel()
+        return
+
+    # Let the UI drain the last imported frames before the job is cleared.
+    if appData.import_queue.__len__() > 0:
+        return
+
+    appData.capture_job = None
+    if not appData.connection_active:
+        appData.close_spill_writer()
+    if job.error is not None:
+        SDL_ShowSimpleMessageBox(SDL_MESSAGEBOX_ERROR, bytes("{} Failed".format(job.name), "utf-8"), bytes(str(job.error), "utf-8"), _window)
+    else:
+        print("{} finished: {} packets in {:.1f}s".format(job.name, job.result, job.elapsed))
 
 import struct 
 
@@ -290,27 +485,182 @@ def byte_window_loop(appData, _window):
 
     imgui.end()
 
+"""
+plot_window_loop:
+    Plots chosen payload bytes of a service ID live. Each series is drawn min/max decimated to one pair of points per
+    two pixels of the plot's width (see PlotSeries.decimate), so drawing costs the same after five minutes or five
+    hours.
+"""
+def plot_window_loop(appData, _window):
+    if appData.plot_win_active is False: return
+    imgui.begin("Live Plot", True)
+
+    # New series: which service ID, which payload bytes, and how to read them.
+    _, appData.plot_new_name = imgui.input_text("Name", appData.plot_new_name, 64, 0)
+    _, appData.plot_new_service_id = imgui.input_text("Service ID", appData.plot_new_service_id, 8, imgui.INPUT_TEXT_CHARS_HEXADECIMAL)
+    _, appData.plot_new_offset = imgui.input_int("Payload Offset", appData.plot_new_offset)
+    _, appData.plot_new_length = imgui.input_int("Bytes", appData.plot_new_length)
+    _, appData.plot_new_signed = imgui.checkbox("Signed", appData.plot_new_signed)
+    imgui.same_line()
+    _, appData.plot_new_scale = imgui.input_float("Scale", appData.plot_new_scale)
+    if imgui.button("Add Series") and appData.plot_new_service_id:
+        try:
+            appData.plot_set.add(PlotSeries(appData.plot_new_name, int(appData.plot_new_service_id, 16) & 0xFF,
+                                            max(0, appData.plot_new_offset), appData.plot_new_length,
+                                            appData.plot_new_signed, scale=appData.plot_new_scale))
+        except ValueError as e:
+            print("Can't plot that: ", e)
+
+    _, appData.plot_window_seconds = imgui.slider_float("Seconds Shown", appData.plot_window_seconds, 1.0, 3600.0, "%.0f")
+    imgui.separator()
+
+    width = imgui.get_content_region_available()[0]
+    for series in list(appData.plot_set.series):
+        imgui.push_id(str(id(series)))
+        points = series.decimate(max(1, int(width) // 2), appData.plot_window_seconds)
+        if points is None:
+            imgui.text("{} ({:#04x}): waiting for data".format(series.name, series.service_id))
+        else:
+            imgui.plot_lines("##plot", points, overlay_text="{} ({:#04x}): {}".format(series.name, series.service_id, series.last_value),
+                             graph_size=(width, 80))
+        imgui.text(series.stats_string())
+        imgui.same_line()
+        if imgui.button("Remove"):
+            appData.plot_set.remove(series)
+        imgui.pop_id()
+
+    imgui.end()
+
+# The rows selected in whichever list the Debug Monitor is showing: the capture store's or the packets in memory.
 def get_count_selected(appData):
-     return filter(lambda s: s, appData.debug_monitor_list_selected)
+    if appData.capture_store is not None and appData.store_browse_active:
+        return iter(sorted(appData.store_list_selected))
+    return iter(sorted(appData.debug_monitor_list_selected))
+
+"""
+get_selected_packets:
+    The selected packets as ELMRESPONSEs (with their parsed KWPacket), oldest first.
+"""
+def get_selected_packets(appData):
+    if appData.capture_store is not None and appData.store_browse_active:
+        return [appData.capture_store.get_packet(seq) for seq in get_count_selected(appData)]
+    return [_tracked_packets.get_packet(seq) for seq in get_count_selected(appData)]
+
+"""
+get_packet_row_strings:
+    Returns the six display strings (time, to, from, service ID, packet, data only) for a tracked packet. They are
+    formatted the first time the row is shown and then served from appData.debug_monitor_row_cache, which is trimmed
+    (oldest first) once it holds more than ROW_CACHE_SIZE rows.
+"""
+ROW_CACHE_SIZE = 4096
+
+def packet_row_strings(packet):
+    parsed = packet.parsed_packet
+    return (to_locale_string(packet.date), parsed.msg_target_string(), parsed.msg_source_string(),
+            parsed.service_id_string(), packet.tostring(), packet.data_only_tostring())
+
+def get_packet_row_strings(appData, seq):
+    row_cache = appData.debug_monitor_row_cache
+    row_strings = row_cache.get(seq)
+    if row_strings is None:
+        row_strings = packet_row_strings(_tracked_packets.get_packet(seq))
+        if row_cache.__len__() >= ROW_CACHE_SIZE:
+            del row_cache[next(iter(row_cache))]
+        row_cache[seq] = row_strings
+    return row_strings
+
+"""
+get_store_rows:
+    Returns (seq, row strings) for rows first to last (by position in the filtered capture store). Rows are fetched a
+    page of STORE_PAGE_SIZE at a time and the formatted pages are kept (up to STORE_PAGE_CACHE_SIZE of them), so
+    scrolling costs one query per page rather than one per row or per UI frame.
+"""
+STORE_PAGE_SIZE = 256
+STORE_PAGE_CACHE_SIZE = 64
+
+def get_store_rows(appData, first, last):
+    page_cache = appData.store_page_cache
+    rows = []
+    for page_index in range(first // STORE_PAGE_SIZE, (last - 1) // STORE_PAGE_SIZE + 1 if last > first else 0):
+        page = page_cache.get(page_index)
+        if page is None:
+            page = []
+            for seq, timestamp, frame in appData.capture_store.query(service_ids=appData.store_service_ids(),
+                                                                     offset=page_index * STORE_PAGE_SIZE, limit=STORE_PAGE_SIZE):
+                packet = ELMRESPONSE(bytes(frame.hex(' ').upper() + ' \r', 'ascii'), _date=timestamp, _parse_kwp=True)
+                page.append((seq, packet_row_strings(packet)))
+            if page_cache.__len__() >= STORE_PAGE_CACHE_SIZE:
+                del page_cache[next(iter(page_cache))]
+            page_cache[page_index] = page
+        page_start = page_index * STORE_PAGE_SIZE
+        rows.extend(page[max(0, first - page_start):max(0, last - page_start)])
+    return rows
+
+"""
+refresh_store_row_count:
+    Re-counts the filtered rows of the capture store at most twice a second (counting isn't free on a big store). If
+    the store grew (it's being recorded), the cached page that held the old last row is dropped so it gets refetched.
+"""
+def refresh_store_row_count(appData):
+    now = time.perf_counter()
+    if now - appData.store_count_refreshed_at < 0.5:
+        return
+    appData.store_count_refreshed_at = now
+    row_count = appData.capture_store.count(service_ids=appData.store_service_ids())
+    if row_count != appData.store_row_count:
+        last_page = appData.store_row_count // STORE_PAGE_SIZE
+        for page_index in [page_index for page_index in appData.store_page_cache if page_index >= last_page]:
+            del appData.store_page_cache[page_index]
+        appData.store_row_count = row_count
+
+# Pushes the cursor down by height in every column of a columns() block so the next row starts below it.
+def ui_table_spacer(height):
+    if height <= 0:
+        return
+    imgui.dummy(1, height)
+    for _ in range(0, 6):
+        imgui.next_column()
 
 def debug_monitor_window_loop(appData, _window):
     if appData.debug_monitor_win_active:
         imgui.begin("Debug Monitor Window", True)
-        with _tracked_packets_lock:
-            imgui.text("Total Tracked Packets: {}".format(_tracked_packets.__len__()))
+        imgui.text("Total Tracked Packets: {}".format(_tracked_packets.__len__()))
+        imgui.text(appData.frame_queue.stats_string())
+        imgui.text(appData.kwp_framer.stats_string())
+        imgui.text(appData.request_correlator.stats_string())
+        for line in appData.request_correlator.report_lines():
+            imgui.text(line)
+        # Record every frame the read thread decodes to a capture store (from the next connection or replay on).
+        _, appData.capture_store_enabled = imgui.checkbox("Record to Capture Store", appData.capture_store_enabled)
+        imgui.same_line()
+        didChange, _newStoreFilen = imgui.input_text("Capture Store (.sqlite)", appData.capture_store_filename, 1024, 0)
+        if didChange and appData.capture_store_writer is None:
+            appData.capture_store_filename = _newStoreFilen
+        if appData.capture_store_writer is not None:
+            imgui.text(appData.capture_store_writer.stats_string())
         btnText = ""
 
-        # Export Button
-        if imgui.button("Export JSON"):
-            serialized_packets = serialize_packets()
-            json_str = json.dumps(serialized_packets, indent=4)
-            # TODO: Make a friendly date string for this.
-            if not os.path.exists('dumps'):
-                os.mkdir('dumps')
-            
-            with open("dumps/exported_packets.json", "w") as file:
-                file.write(json_str)
-            SDL_ShowSimpleMessageBox(SDL_MESSAGEBOX_INFORMATION, b"Wrote JSON", b"Exported Packets to dumps/exported_packets.json", _window)
+        # Page through the capture store (the whole session) instead of the packets held in memory.
+        browsing_store = False
+        if appData.capture_store is not None:
+            _, appData.store_browse_active = imgui.checkbox("Browse Capture Store", appData.store_browse_active)
+            imgui.same_line()
+            didChange, _newServiceFilter = imgui.input_text("Service IDs (hex)", appData.store_service_filter, 64, 0)
+            if didChange:
+                appData.store_service_filter = _newServiceFilter
+                appData.store_page_cache = {}
+                appData.store_count_refreshed_at = 0.0
+                appData.store_row_count = 0
+            browsing_store = appData.store_browse_active
+            if browsing_store:
+                refresh_store_row_count(appData)
+                imgui.text("{}: {} matching packets".format(appData.capture_store.path, appData.store_row_count))
+
+        ui_capture_job_status(appData, _window)
+
+        # Export Button (.json, .ndjson or the binary .t1ncap format, by file extension)
+        if imgui.button("Export"):
+            ui_export_packets(appData, _window)
         imgui.same_line()
         
         didChange, _newExportFilen = imgui.input_text("Export Filename", appData.export_filename, 1024, 0)
@@ -318,14 +668,28 @@ def debug_monitor_window_loop(appData, _window):
             appData.export_filename = _newExportFilen
         
 
-        # Import Button
-        if imgui.button("Import JSON"):
+        # Import Button (.json, .ndjson or .t1ncap)
+        if imgui.button("Import"):
             ui_import_json(appData, _window)
         imgui.same_line()
         didChange, _newImportFilen = imgui.input_text("Import Filename", appData.import_filename, 1024, 0)
         if didChange:
             appData.import_filename = _newImportFilen
 
+        # Frames evicted from the packets held in memory go to the spill file instead of being dropped.
+        didChange, appData.spill_enabled = imgui.checkbox("Spill Evicted Frames", appData.spill_enabled)
+        if didChange:
+            if not appData.spill_enabled:
+                appData.close_spill_writer()
+            elif appData.connection_active or appData.capture_job is not None:
+                appData.open_spill_writer()
+        imgui.same_line()
+        didChange, _newSpillFilen = imgui.input_text("Spill Filename (.t1ncap)", appData.spill_filename, 1024, 0)
+        if didChange and appData.spill_writer is None:
+            appData.spill_filename = _newSpillFilen
+        if appData.spill_writer is not None:
+            imgui.text("Spilled {} frames to {}".format(appData.spill_writer.frame_count, appData.spill_filename))
+
         if appData.connection_active:
             btnText = "Close Connection"
         else:
@@ -378,79 +742,91 @@ def debug_monitor_window_loop(appData, _window):
         imgui.set_column_width(from_col, 80)
         #imgui.set_column_width(packet_col, 700)
         # imgui.set_column_width(data_col, 500)
-        
-        
-        # imgui.set_column_offset(1, 40)
-        with _tracked_packets_lock:
+        imgui.columns(1)
+        imgui.separator()
+
+        # Only the rows that are actually on screen get formatted and drawn. Everything above and below them is
+        # replaced by a spacer of the same height so the scrollbar still covers the whole capture.
+        imgui.begin_child("PacketRows", 0, 0, False)
+        imgui.columns(6, 'ListBox1Rows', False)
+        imgui.set_column_width(to_col, 80)
+        imgui.set_column_width(from_col, 80)
+
+        row_height = imgui.get_text_line_height_with_spacing()
+        first_seq = _tracked_packets.first_seq
+        if browsing_store:
+            _selected = appData.store_list_selected
+            total_rows = appData.store_row_count
+        else:
             _selected = appData.debug_monitor_list_selected
-            if _selected.__len__() < _tracked_packets.__len__():
-                _selected = [False] * _tracked_packets.__len__()
-
-            none_amount = 0
-            for p in range(0, _tracked_packets.__len__()):
-                if _tracked_packets[p].parsed_packet is not None and _tracked_packets[p].parsed_packet.HeaderMsgLength > 0:
-                    imgui.next_column()
-                    # imgui.text("Date Test")
-
-                    # Time
-                    _,_selected[p] = imgui.selectable(to_locale_string(_tracked_packets[p].date), _selected[p])
-                    imgui.next_column()
-                    
-                    # To
-                    _,_selected[p] = imgui.selectable(_tracked_packets[p].parsed_packet.msg_target_string(), _selected[p])
-                    imgui.next_column()
-
-                    # From
-                    _,_selected[p] = imgui.selectable(_tracked_packets[p].parsed_packet.msg_source_string(), _selected[p])
-                    imgui.next_column()
-
-                    # Service ID
-                    _,_selected[p] = imgui.selectable(_tracked_packets[p].parsed_packet.service_id_string(), _selected[p])
-                    imgui.next_column()
-
-                    # Raw Packet
-                    _,_selected[p] = imgui.selectable(_tracked_packets[p].tostring(), _selected[p])
-                    imgui.next_column()
-
-                    # Data Packet, if applicable
-                    _,_selected[p] = imgui.selectable(_tracked_packets[p].data_only_tostring(), _selected[p])
-                else: none_amount += 1
-        
-        # if none_amount > 0:
-            # print("None amount: ", none_amount)
+            total_rows = _tracked_packets.__len__()
+        first_visible = min(total_rows, int(imgui.get_scroll_y() / row_height))
+        last_visible = min(total_rows, first_visible + int(imgui.get_window_height() / row_height) + 2)
+        if browsing_store:
+            visible_rows = get_store_rows(appData, first_visible, last_visible)
+        else:
+            visible_rows = []
+            for seq in range(first_seq + first_visible, first_seq + last_visible):
+                visible_rows.append((seq, get_packet_row_strings(appData, seq)))
+
+        ui_table_spacer(first_visible * row_height)
+        for seq, row_strings in visible_rows:
+            imgui.push_id(str(seq))
+            is_selected = seq in _selected
+            for column_index in range(0, 6):
+                clicked, _ = imgui.selectable(row_strings[column_index], is_selected)
+                if clicked:
+                    is_selected = not is_selected
+                    if is_selected:
+                        _selected.add(seq)
+                    else:
+                        _selected.discard(seq)
+                imgui.next_column()
+            imgui.pop_id()
+        ui_table_spacer((total_rows - last_visible) * row_height)
+
         imgui.columns(1)
+        imgui.end_child()
 
         imgui.end()
 
-        appData.debug_monitor_list_selected = _selected
-        selected_list = list(get_count_selected(appData))
-        if clicked_interpret_data and selected_list.__len__() > 0:
-            print("call with data")
+        # Forget selections that have been evicted from the capture.
+        if not browsing_store and _selected.__len__() > 0:
+            appData.debug_monitor_list_selected = set(seq for seq in _selected if seq >= first_seq)
+        if clicked_interpret_data:
+            selected_packets = get_selected_packets(appData)
+            if selected_packets.__len__() > 0:
+                print("call with data: ", [packet.tostring() for packet in selected_packets])
 
         s.columns_min_spacing = initial
 
 
 def ui_loop(appData, _window):
+    appData.drain_read_queue()
+
     if imgui.begin_main_menu_bar():
         if imgui.begin_menu("File", True):
             clicked_quit, selected_quit = imgui.menu_item("Quit", "Cmd + Q", False, True)
             clicked_refresh_dev, _ = imgui.menu_item("Refresh Devices", "Cmd + R", False, True)
+            clicked_replay, _ = imgui.menu_item("Replay Import File", None, False, not appData.connection_active)
 
             if clicked_refresh_dev:
                 appData.refresh_serial_devices()
 
+            if clicked_replay and os.path.exists(appData.import_filename):
+                appData.connection_active = True
+                appData.init_replay(appData.import_filename)
+
             if clicked_quit:
-                if appData.connection_active:
-                    appData.kill_elm327()
-                    exit(1)
-                else:
-                    exit(1)
+                appData.shutdown()
+                exit(1)
                 
             imgui.end_menu()
         
         if imgui.begin_menu("Window", True):
             clicked_debug_monitor, _ = imgui.menu_item("Debug Monitor Mode", "Cmd + M", False, True)
             clicked_byte_converter, _ = imgui.menu_item("Simple Byte Converter", "Cmd + B", False, True)
+            clicked_live_plot, _ = imgui.menu_item("Live Plot", "Cmd + P", False, True)
 
             if clicked_debug_monitor:
                 appData.debug_monitor_win_active = not appData.debug_monitor_win_active
@@ -458,6 +834,9 @@ def ui_loop(appData, _window):
             
             if clicked_byte_converter:
                 appData.byte_win_active = not appData.byte_win_active
+
+            if clicked_live_plot:
+                appData.plot_win_active = not appData.plot_win_active
             
             imgui.end_menu()
             
@@ -467,10 +846,10 @@ def ui_loop(appData, _window):
                 imgui.menu_item("<No Devices>", None, False, False)
             else:
                 for dev in appData.serial_devices:
-                    if dev == appData.current_serial_device:
-                        imgui.menu_item(dev, None, True, not appData.connection_active)
-                    else:
-                        imgui.menu_item(dev, None, False, not appData.connection_active)
+                    # The selected device is the one Open Connection tries first.
+                    clicked_dev, _ = imgui.menu_item(dev, None, dev == appData.current_serial_device, not appData.connection_active)
+                    if clicked_dev:
+                        appData.current_serial_device = dev
             imgui.end_menu()
 
         imgui.end_main_menu_bar()
@@ -481,6 +860,7 @@ def ui_loop(appData, _window):
 
     debug_monitor_window_loop(appData, _window)
     byte_window_loop(appData, _window)
+    plot_window_loop(appData, _window)
 
 
 def ui_clear_and_render(impl, win):